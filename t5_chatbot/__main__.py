@@ -4,7 +4,9 @@ Chinese T5 Pegasus Chatbot for muvtuber
 
 import argparse
 import logging
-from t5 import T5ChatbotFactory, T5ChatbotConfig
+import os
+from t5 import T5ChatbotFactory, T5ChatbotConfig, autotune_settings_path
+from model_manager import parse_size
 from muvtuber_chatbot_api import serve_grpc, MuvtuberGrpcServerConfig
 
 
@@ -13,17 +15,36 @@ def main():
         description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument("--muvtb-grpc-serv", type=str, default="localhost:50053",
                         help="gRPC server address: host:port (e.g. localhost:50053)")
+    parser.add_argument("--model-memory-budget", type=str, default=None,
+                        help="max total size of the loaded models (e.g. 2G), "
+                             "least recently used idle models are evicted. Default: no limit")
+    parser.add_argument("--settings", type=str, default=None,
+                        help="settings JSON written by autotune.py "
+                             "(default: model/autotune.json if it exists)")
+    parser.add_argument("--session-store", type=str, default=None,
+                        help="directory to spill idle sessions to (and keep them across restarts). "
+                             "Default: sessions live in memory only")
     args = parser.parse_args()
 
+    settings_file = args.settings
+    if settings_file is None and os.path.exists(autotune_settings_path):
+        settings_file = autotune_settings_path
+
+    model_memory_budget = None
+    if args.model_memory_budget:
+        model_memory_budget = parse_size(args.model_memory_budget)
+
     config = MuvtuberGrpcServerConfig(
-        chatbot_factory=T5ChatbotFactory(),
+        chatbot_factory=T5ChatbotFactory(model_memory_budget, settings_file),
         chatbot_config_class=T5ChatbotConfig,
         max_sessions=10,
         address=args.muvtb_grpc_serv,
         timeout=60*60*24,
         zombie_timeout=60*60*25,
         check_timeout_interval=60*60,
-        add_reflection_service=True)
+        add_reflection_service=True,
+        session_store_dir=args.session_store,
+        settings_file=settings_file)
 
     serve_grpc(config)
 
@@ -0,0 +1,232 @@
+"""
+Autotune threads / processes / batching for CPU inference
+
+    python autotune.py --config '{"model": "chat"}' --slo-p95 1.0 --clients 16
+
+用真实模型、模拟并发负载，扫一遍这些设置：
+  - processes：起几个 serve_grpc 副本（配合 ReplicaBalancer），负载平均分给它们；
+  - torch_threads / torch_interop_threads：每个进程的 torch 线程数；
+  - max_concurrency：FairScheduler 同时放进推理的请求数；
+  - max_batch：流水线里一次 generate 最多几个 prompt。
+每组设置起 processes 个进程，每个进程里 clients / processes 个客户端线程，
+各用自己的会话不停地问（走 FairScheduler -> T5Chatbot，和 gRPC 服务一样的路径），
+测 duration 秒的吞吐量和延迟。
+
+先扫 (processes, torch_threads)，再在最好的那组上扫 (max_concurrency, max_batch)。
+选 p95 延迟不超过 --slo-p95 的设置里吞吐量最高的，写到 ./model/autotune.json：
+
+    {"serve_grpc": {"max_workers": ..., "max_concurrency": ...},
+     "t5": {"torch_threads": ..., "torch_interop_threads": ..., "max_batch": ...},
+     "processes": ..., "measured": {...}, "results": [...]}
+
+python t5_chatbot（__main__.py）启动时会读这个文件；processes 只是建议，需要自己起那么多个副本。
+"""
+
+import argparse
+from dataclasses import fields
+from itertools import cycle, product
+import json
+import math
+import multiprocessing
+import os
+import threading
+import time
+from muvtuber_chatbot_api import FairScheduler, LatencyWindow, MuvtuberGrpcServerConfig
+from t5 import T5ChatbotConfig, T5ChatbotFactory, set_torch_threads, autotune_settings_path
+from batch_infer import read_records
+from corpus import load_data_luge
+
+_this_dir = os.path.dirname(os.path.realpath(__file__))
+
+FALLBACK_PROMPTS = ['你好', '你是谁', '你叫什么名字', '你是哪国人', '你比较擅长什么才艺？',
+                    '可以点歌吗', '今天天气怎么样', '晚上吃什么好呢', '你喜欢什么音乐', '晚安']
+
+
+# serve_grpc 的默认设置：测的时候按这些排队上限，max_workers 也按它们算
+SERVER_DEFAULTS = {f.name: f.default for f in fields(MuvtuberGrpcServerConfig)}
+
+
+def max_workers_for(sessions, max_concurrency):
+    """gRPC threads for sessions busy sessions (see MuvtuberGrpcServerConfig.max_workers):
+    every queued or running request holds one, plus a few for NewSession & co
+    """
+    per_session = (SERVER_DEFAULTS['max_inflight_per_session']
+                   + SERVER_DEFAULTS['max_queue_per_session'])
+    needed = max(sessions * per_session, max_concurrency) + 4
+    return max(SERVER_DEFAULTS['max_workers'], needed)
+
+
+def load_prompts(prompts_file, data_dir, n=200):
+    if prompts_file:
+        return [r['prompt'] for r in read_records(prompts_file)][:n]
+    valid_file = os.path.join(data_dir, 'valid.txt')
+    if os.path.exists(valid_file):
+        return [q for _, q in load_data_luge(valid_file, shuffle=False)][:n]
+    return FALLBACK_PROMPTS
+
+
+def _bench_process(settings, config_json, prompts, clients, warmup, duration, barrier, results):
+    """one replica: clients threads asking through FairScheduler -> T5Chatbot"""
+    set_torch_threads(settings['torch_threads'], settings['torch_interop_threads'])
+    chatbot = T5ChatbotFactory(max_batch=settings['max_batch']).create_chatbot(
+        T5ChatbotConfig.from_json(config_json))
+    scheduler = FairScheduler(max_concurrency=settings['max_concurrency'],
+                              max_inflight_per_session=SERVER_DEFAULTS['max_inflight_per_session'],
+                              max_queue_per_session=SERVER_DEFAULTS['max_queue_per_session'])
+    for prompt in prompts[:warmup]:
+        chatbot.ask('', prompt)
+
+    barrier.wait()  # 所有进程都加载完、预热完再一起开始计时
+    start = time.time()
+    stop_at = start + duration
+    latencies = []
+    lock = threading.Lock()
+
+    def client(i):
+        session_id = f'client-{i}'
+        for prompt in cycle(prompts[i % len(prompts):] + prompts[:i % len(prompts)]):
+            t0 = time.time()
+            if t0 >= stop_at:
+                return
+            scheduler.run(session_id, lambda: chatbot.ask(session_id, prompt))
+            with lock:
+                latencies.append(time.time() - t0)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    results.put((latencies, time.time() - start))
+
+
+def bench(settings, args, prompts):
+    """{"requests_per_second", "p50", "p95"} of settings under args.clients concurrent clients"""
+    ctx = multiprocessing.get_context('spawn')  # torch 的线程数要在新进程里设
+    processes = settings['processes']
+    barrier = ctx.Barrier(processes)
+    results = ctx.Queue()
+    clients = [args.clients // processes + (i < args.clients % processes)
+               for i in range(processes)]
+    workers = [ctx.Process(target=_bench_process,
+                           args=(settings, args.config, prompts, clients[i],
+                                 args.warmup, args.duration, barrier, results))
+               for i in range(processes)]
+    for w in workers:
+        w.start()
+    window = LatencyWindow(maxlen=1 << 20)
+    n, seconds = 0, 0.0
+    for _ in workers:
+        latencies, elapsed = results.get()
+        for latency in latencies:
+            window.add(latency)
+        n += len(latencies)
+        seconds = max(seconds, elapsed)
+    for w in workers:
+        w.join()
+    return {'requests_per_second': n / seconds if seconds else 0.0,
+            'p50': window.percentile(50),
+            'p95': window.percentile(95),
+            'requests': n}
+
+
+def best_of(results, slo_p95):
+    """highest throughput within the SLO, or the lowest p95 if none is"""
+    within = [r for r in results if r['measured']['p95'] <= slo_p95]
+    if within:
+        return max(within, key=lambda r: r['measured']['requests_per_second'])
+    return min(results, key=lambda r: r['measured']['p95'])
+
+
+def _ints(s):
+    return [int(x) for x in s.split(',')]
+
+
+def main():
+    cpu_count = os.cpu_count() or 1
+    powers = [2 ** i for i in range(int(math.log2(cpu_count)) + 1)]
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--config", type=str, default='{"model": "chat"}',
+                        help="T5ChatbotConfig JSON, the same as NewSession's config")
+    parser.add_argument("--slo-p95", type=float, default=1.0,
+                        help="latency SLO: p95 seconds per request")
+    parser.add_argument("--clients", type=int, default=16,
+                        help="concurrent clients (sessions) of the synthetic load")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="seconds to measure each setting")
+    parser.add_argument("--warmup", type=int, default=3,
+                        help="asks per process before measuring")
+    parser.add_argument("--prompts", type=str, default=None,
+                        help="prompts .jsonl / .tsv (default: LUGE valid set, or a few built-in ones)")
+    parser.add_argument("--data", type=str, default="./data/luge_Diamante/",
+                        help="LUGE Diamante data dir")
+    parser.add_argument("--processes", type=_ints, default=[p for p in powers if p <= 4])
+    parser.add_argument("--torch-threads", type=_ints, default=powers)
+    parser.add_argument("--concurrency", type=_ints, default=[1, 2, 4, 8])
+    parser.add_argument("--batch", type=_ints, default=[1, 8, 32])
+    parser.add_argument("--output", type=str, default=autotune_settings_path)
+    args = parser.parse_args()
+
+    prompts = load_prompts(args.prompts, args.data)
+    results = []
+
+    def run(settings):
+        measured = bench(settings, args, prompts)
+        result = {'settings': settings, 'measured': measured}
+        results.append(result)
+        print(f'{settings}: {measured["requests_per_second"]:.2f} req/s, '
+              f'p50 {measured["p50"]:.3f}s, p95 {measured["p95"]:.3f}s')
+        return result
+
+    # 第一轮：进程数 x torch 线程数（不超过 CPU 核数）
+    stage = []
+    for processes, torch_threads in product(args.processes, args.torch_threads):
+        if processes * torch_threads > cpu_count:
+            continue
+        stage.append(run({'processes': processes,
+                          'torch_threads': torch_threads,
+                          'torch_interop_threads': 1,
+                          'max_concurrency': 2,
+                          'max_batch': 8}))
+    best = best_of(stage, args.slo_p95)['settings']
+
+    # 第二轮：在最好的进程 / 线程数上扫调度并发数 x batch 大小
+    stage = [run(dict(best, max_concurrency=c, max_batch=b))
+             for c, b in product(args.concurrency, args.batch)]
+    best_result = best_of(stage, args.slo_p95)
+    best = best_result['settings']
+    within_slo = best_result['measured']['p95'] <= args.slo_p95
+    if not within_slo:
+        print(f'WARNING: no setting meets the p95 SLO of {args.slo_p95}s, '
+              f'picked the one with the lowest p95')
+
+    clients_per_process = math.ceil(args.clients / best['processes'])
+    output = {
+        'serve_grpc': {
+            'max_workers': max_workers_for(clients_per_process, best['max_concurrency']),
+            'max_concurrency': best['max_concurrency'],
+        },
+        't5': {
+            'torch_threads': best['torch_threads'],
+            'torch_interop_threads': best['torch_interop_threads'],
+            'max_batch': best['max_batch'],
+        },
+        'processes': best['processes'],
+        'measured': best_result['measured'],
+        'within_slo': within_slo,
+        'slo_p95': args.slo_p95,
+        'clients': args.clients,
+        'cpu_count': cpu_count,
+        'config': args.config,
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(output, f, ensure_ascii=False, indent=2)
+    print(f'best: {best}: {best_result["measured"]}')
+    print(f'saved: {args.output}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+Batch / offline inference for large prompt files
+
+    python batch_infer.py prompts.jsonl replies.jsonl --config '{"model": "chat"}' --workers 4
+
+输入：
+  - .jsonl：每行 {"prompt": "...", "reference": "...（可选）", "id": ...（可选）}
+  - .tsv：每行 prompt<TAB>reference（reference 可选）
+输出：.jsonl，每行 {"id": ..., "prompt": "...", "response": "...", "reference": ...}
+（没给 id 的用输入的行号）。
+
+输入按 --chunk-size 行切块分给多个 worker 进程，块内按 prompt 长度排序后
+按 --batch-size 做批量 generate。每写完一块就记一条进度到 <output>.progress，
+中断后用同样的命令重跑会跳过已完成的块接着跑。
+模型用和 gRPC 服务一样的 T5ChatbotConfig / T5ChatbotFactory 加载。
+结束时报告吞吐量；输入带 reference 的话同时报告 ROUGE。
+"""
+
+import argparse
+from collections import deque
+from itertools import count, islice
+import json
+import multiprocessing
+import os
+import time
+import torch
+from evaluation import compute_rouge
+from t5 import T5ChatbotConfig, T5ChatbotFactory
+
+ROUGE_KEYS = ('rouge-1', 'rouge-2', 'rouge-l')
+
+
+def read_records(filename):
+    """yields {"id", "prompt", "reference"} from a .jsonl or .tsv file"""
+    is_tsv = filename.endswith('.tsv')
+    with open(filename, encoding='utf-8') as f:
+        for line_no, l in enumerate(f):
+            l = l.rstrip('\n')
+            if not l.strip():
+                continue
+            if is_tsv:
+                fields = l.split('\t')
+                record = {'prompt': fields[0],
+                          'reference': fields[1] if len(fields) > 1 else None}
+            else:
+                record = json.loads(l)
+            yield {'id': record.get('id', line_no),
+                   'prompt': record['prompt'],
+                   'reference': record.get('reference')}
+
+
+def read_chunks(filename, chunk_size):
+    """yields (chunk_index, [records])"""
+    records = read_records(filename)
+    for i in count():
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        yield i, chunk
+
+
+# worker 进程里的 chatbot，由 _init_worker 加载
+_chatbot = None
+_batch_size = None
+
+
+def _init_worker(config_json, batch_size, torch_threads):
+    global _chatbot, _batch_size
+    if torch_threads:
+        torch.set_num_threads(torch_threads)
+    _chatbot = T5ChatbotFactory().create_chatbot(
+        T5ChatbotConfig.from_json(config_json))
+    _batch_size = batch_size
+
+
+def _run_chunk(chunk):
+    """(chunk_index, records) -> (chunk_index, records with "response", seconds)"""
+    index, records = chunk
+    start = time.perf_counter()
+    # 按长度排序，同一批里 padding 少
+    order = sorted(range(len(records)), key=lambda i: len(records[i]['prompt']))
+    for b in range(0, len(order), _batch_size):
+        batch = [records[i] for i in order[b:b + _batch_size]]
+        responses = _chatbot.ask_batch(
+            [''] * len(batch), [r['prompt'] for r in batch])
+        for record, response in zip(batch, responses):
+            record['response'] = response
+    return index, records, time.perf_counter() - start
+
+
+def imap_bounded(pool, func, iterable, max_pending):
+    """pool.imap, but reads at most max_pending items of iterable ahead
+    (pool.imap would read the whole input file into its task queue).
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def load_progress(progress_file):
+    """done chunk indices, progress entries
+
+    A torn last line (killed while writing it) is dropped and truncated away,
+    so that the next entry is appended after the last complete one.
+    """
+    entries = []
+    if not os.path.exists(progress_file):
+        return set(), entries
+    good = 0  # 最后一条完整记录之后的位置
+    with open(progress_file, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            if line.strip():
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break
+            good += len(line)
+    if good != os.path.getsize(progress_file):
+        print(f'{progress_file}: dropping a partial entry at byte {good}')
+        with open(progress_file, 'ab') as f:
+            f.truncate(good)
+    return {e['chunk'] for e in entries}, entries
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("input", type=str, help="prompts: .jsonl or .tsv")
+    parser.add_argument("output", type=str, help="results: .jsonl")
+    parser.add_argument("--config", type=str, default='{"model": "chat"}',
+                        help="T5ChatbotConfig JSON, the same as NewSession's config")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--chunk-size", type=int, default=1024,
+                        help="prompts per work unit (and per progress checkpoint)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes, each loads its own model")
+    parser.add_argument("--torch-threads", type=int, default=0,
+                        help="torch intra-op threads per worker (0: cpu_count // workers)")
+    args = parser.parse_args()
+
+    torch_threads = args.torch_threads or max(
+        1, (os.cpu_count() or 1) // args.workers)
+    progress_file = args.output + '.progress'
+    done, entries = load_progress(progress_file)
+
+    # 上次写了输出但没来得及记进度的部分不算数
+    offset = max((e['offset'] for e in entries), default=0)
+    with open(args.output, 'ab') as f:
+        f.truncate(offset)
+    if done:
+        print(f'resume: {len(done)} chunks done, '
+              f'{sum(e["n"] for e in entries)} prompts')
+
+    todo = ((i, chunk) for i, chunk in read_chunks(args.input, args.chunk_size)
+            if i not in done)
+    init_args = (args.config, args.batch_size, torch_threads)
+    if args.workers > 1:
+        pool = multiprocessing.Pool(
+            args.workers, initializer=_init_worker, initargs=init_args)
+        results = imap_bounded(pool, _run_chunk, todo, 2 * args.workers)
+    else:
+        pool = None
+        _init_worker(*init_args)
+        results = map(_run_chunk, todo)
+
+    start = time.perf_counter()
+    n = 0
+    with open(args.output, 'a', encoding='utf-8') as out, \
+            open(progress_file, 'a', encoding='utf-8') as progress:
+        for index, records, seconds in results:
+            rouge = dict.fromkeys(ROUGE_KEYS, 0.0)
+            n_ref = 0
+            for record in records:
+                out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                if record['reference']:
+                    score = compute_rouge(record['response'], record['reference'])
+                    for k in ROUGE_KEYS:
+                        rouge[k] += score[k]
+                    n_ref += 1
+            out.flush()
+            os.fsync(out.fileno())
+
+            entry = {'chunk': index, 'n': len(records), 'n_ref': n_ref,
+                     'rouge': rouge, 'seconds': seconds, 'offset': out.tell()}
+            progress.write(json.dumps(entry) + '\n')
+            progress.flush()
+            os.fsync(progress.fileno())
+            entries.append(entry)
+
+            n += len(records)
+            elapsed = time.perf_counter() - start
+            print(f'chunk {index}: {len(records)} prompts in {seconds:.1f}s, '
+                  f'total {n} prompts, {n / elapsed:.2f} prompts/s')
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    elapsed = time.perf_counter() - start
+    n_ref = sum(e['n_ref'] for e in entries)
+    report = {
+        'prompts': sum(e['n'] for e in entries),
+        'this_run_prompts': n,
+        'this_run_seconds': elapsed,
+        'prompts_per_second': n / elapsed if elapsed else 0.0,
+        'rouge': {k: sum(e['rouge'][k] for e in entries) / n_ref for k in ROUGE_KEYS}
+        if n_ref else None,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
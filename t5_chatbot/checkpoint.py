@@ -0,0 +1,128 @@
+# 训练的 checkpoint：后台线程写盘，断点续训，保留最近 K 个和 ROUGE-L 最好的一个。
+#
+# checkpoint_dir/
+#   step-00001200.ckpt   torch.save 的 dict：模型、优化器、数据位置等（内容由 train.py 决定）
+#   state.json           {"checkpoints": [{"step", "file", "rouge_l"}, ...]}，按 step 排序
+#
+# 写盘都是先写临时文件再 os.replace，写到一半被杀掉也不会留下坏文件。
+
+import copy
+import json
+import logging
+import os
+from threading import Thread
+import time
+from typing import Dict, List, Optional
+import torch
+
+
+class CheckpointManager:
+    """Save training checkpoints in the background, keep the last keep_last
+    and the best (by ROUGE-L) of them, load the latest to resume.
+    """
+
+    def __init__(self, directory: str, keep_last=3):
+        self.directory = directory
+        self.keep_last = keep_last
+        os.makedirs(directory, exist_ok=True)
+
+        self._writer: Optional[Thread] = None
+        self._error: Optional[BaseException] = None
+        self.checkpoints: List[Dict] = self._read_state()
+
+    def _state_file(self):
+        return os.path.join(self.directory, 'state.json')
+
+    def _read_state(self) -> List[Dict]:
+        if not os.path.exists(self._state_file()):
+            return []
+        with open(self._state_file(), encoding='utf-8') as f:
+            return json.load(f)['checkpoints']
+
+    def _write_state(self):
+        tmp = self._state_file() + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'checkpoints': self.checkpoints}, f, indent=2)
+        os.replace(tmp, self._state_file())
+
+    def load_latest(self) -> Optional[Dict]:
+        """The latest checkpoint dict, None if there is none"""
+        if not self.checkpoints:
+            return None
+        latest = self.checkpoints[-1]
+        logging.info(f'CheckpointManager: loading {latest["file"]}')
+        return torch.load(os.path.join(self.directory, latest['file']))
+
+    def save(self, step: int, state: Dict, rouge_l: float = None,
+             model: torch.nn.Module = None, model_path: str = None):
+        """Write a checkpoint of state in the background.
+
+        state is copied here (on the training thread), so training can go on
+        updating the model while it is written. With model and model_path,
+        torch.save(model, model_path) is done in the same background write
+        (a new best model and its checkpoint, without waiting in between).
+        """
+        state = copy.deepcopy(state)
+        model = copy.deepcopy(model) if model is not None else None
+
+        def write():
+            if model is not None:
+                _atomic_save(model, model_path)
+            self._write_checkpoint(step, state, rouge_l)
+
+        self._run_async(write)
+
+    def wait(self):
+        """Wait for the pending write, raise its error if it failed"""
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run_async(self, write):
+        # 同一时间只写一个：上一个还没写完就等它（内存里最多多一份拷贝）
+        self.wait()
+
+        def run():
+            try:
+                write()
+            except BaseException as e:
+                logging.error(f'CheckpointManager: write failed: {e}')
+                self._error = e
+
+        self._writer = Thread(target=run, name='checkpoint-writer')
+        self._writer.start()
+
+    def _write_checkpoint(self, step, state, rouge_l):
+        start = time.perf_counter()
+        file = f'step-{step:08d}.ckpt'
+        _atomic_save(state, os.path.join(self.directory, file))
+
+        self.checkpoints = [c for c in self.checkpoints if c['step'] != step]
+        self.checkpoints.append({'step': step, 'file': file, 'rouge_l': rouge_l})
+        self.checkpoints.sort(key=lambda c: c['step'])
+        removed = self._prune()
+        self._write_state()
+        for c in removed:
+            os.remove(os.path.join(self.directory, c['file']))
+
+        logging.info(f'CheckpointManager: saved {file} in '
+                     f'{time.perf_counter() - start:.1f}s')
+
+    def _prune(self) -> List[Dict]:
+        """Drop all but the last keep_last and the best, return the dropped"""
+        keep = {c['file'] for c in self.checkpoints[-self.keep_last:]}
+        evaluated = [c for c in self.checkpoints if c['rouge_l'] is not None]
+        if evaluated:
+            keep.add(max(evaluated, key=lambda c: c['rouge_l'])['file'])
+        removed = [c for c in self.checkpoints if c['file'] not in keep]
+        self.checkpoints = [c for c in self.checkpoints if c['file'] in keep]
+        return removed
+
+
+def _atomic_save(obj, path):
+    tmp = path + '.tmp'
+    torch.save(obj, tmp)
+    os.replace(tmp, path)
@@ -0,0 +1,38 @@
+# 数据集的加载，train.py 和各种离线工具（prune_vocab.py 等）共用。
+
+import json
+import random
+
+
+def load_data_tsv(filename):
+    """加载数据
+    单条格式：(标题, 正文)
+    """
+    D = []
+    with open(filename, encoding='utf-8') as f:
+        for l in f:
+            title, content = l.strip().split('\t')
+            D.append((title, content))
+    return D
+
+
+def load_data_luge(filename, shuffle=True):
+    """加载 luge 的数据
+    {"id": "dialogue-00000", "conversation": [{"role": "speaker1", "utterance": "你的朋友会找你讨论感情问题吗，我现在一个头两个大", "response_candidates": ["不会，我都是直接把我的感情经历讲给他们听", "会，而且都是找我诉苦", ...]}, ...]}
+
+    shuffle=False 则保持文件里的顺序。
+    """
+    D = []
+    with open(filename, encoding='utf-8') as f:
+        for l in f:
+            data = json.loads(l)
+            for conversation in data['conversation']:
+                # role = conversation['role']
+                utterance  = conversation['utterance']
+                response_candidates = conversation['response_candidates']
+
+                for response in response_candidates:
+                    D.append((response, utterance))  # 注意是反过来的，A 在前 Q 在后
+    if shuffle:
+        random.shuffle(D)
+    return D
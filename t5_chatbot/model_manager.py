@@ -0,0 +1,246 @@
+"""
+Model manager: loaded models shared by all the sessions, within a memory budget
+
+会话配置里的 model 可以是任何 ./model/<name>.pt，每种模型只加载一份，所有会话共用；
+总大小超过预算时，把最近最少使用的、当前没人在用的模型卸载掉（LRU）。
+
+    models = ModelManager(budget_bytes=parse_size("4G"))
+    with models.acquire("./model/chat.pt") as model:
+        model.generate(...)
+
+  - 同一个模型同时被多个会话请求时只加载一次，其他请求等它加载完；
+  - 正在用（acquire 着）的模型不会被卸载；腾不出地方就等别人用完，
+    等 wait_timeout 秒还不行就抛 ModelBudgetExceeded，先到了请求的 deadline 就抛 DeadlineExceeded；
+  - 卸载后的 gc.collect() 不拿着锁做，不挡着别的会话用已经加载好的模型；
+  - 加载 / 卸载都会打日志并记录耗时，stats() 给出当前状态。
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import gc
+import logging
+import os
+from threading import Condition
+import time
+from typing import Callable, Dict, List, Optional
+import torch
+from muvtuber_chatbot_api import ChatbotError, DeadlineExceeded
+from muvtuber_chatbot_api.metrics import Counters, LatencyWindow
+
+
+def parse_size(size: str) -> int:
+    """ "512M" / "4G" / "1073741824" => bytes"""
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def model_nbytes(model: torch.nn.Module) -> int:
+    """memory held by the parameters and buffers of a model"""
+    tensors = {id(t): t for t in model.parameters()}  # tied weights only once
+    tensors.update({id(t): t for t in model.buffers()})
+    return sum(t.nelement() * t.element_size() for t in tensors.values())
+
+
+class _Entry:
+    def __init__(self, path: str, nbytes: int):
+        self.path = path
+        self.model = None
+        self.nbytes = nbytes  # file size until loaded
+        self.loading = True
+        self.refs = 0
+        self.last_used = time.time()
+        self.load_seconds = 0.0
+
+
+class ModelManager:
+    """Load models on demand, share them, evict the LRU idle ones
+    to keep the total under budget_bytes.
+    """
+
+    def __init__(self, budget_bytes: Optional[int] = None, loader: Callable = torch.load, wait_timeout=30.0):
+        """
+        Args:
+            budget_bytes: memory budget of all the loaded models, None: no limit
+            loader: path -> model
+            wait_timeout: seconds to wait for busy models to become idle
+                when there is no room for a new one
+        """
+        self.budget_bytes = budget_bytes
+        self.loader = loader
+        self.wait_timeout = wait_timeout
+
+        self._cond = Condition()
+        self._entries: Dict[str, _Entry] = OrderedDict()  # LRU first
+        self._evicted: List[_Entry] = []  # evicted, not yet gc.collect()-ed (see _collect_evicted)
+
+        # {"hits": n, "loads": n, "evictions": n, "load_failures": n}
+        self.counters = Counters()
+        self.load_times = LatencyWindow(maxlen=100)
+        self.evict_times = LatencyWindow(maxlen=100)
+
+    @contextmanager
+    def acquire(self, path: str, deadline: Optional[float] = None):
+        """Loaded model of path, not evicted until the with block exits.
+
+        Raises:
+            FileNotFoundError: no such model
+            ModelBudgetExceeded: no room for the model within wait_timeout
+            DeadlineExceeded: no room for the model before deadline
+        """
+        entry = self._acquire(path, deadline)
+        try:
+            yield entry.model
+        finally:
+            self._release(entry)
+
+    def _acquire(self, path, deadline) -> _Entry:
+        give_up_at = time.time() + self.wait_timeout
+        if deadline is not None:
+            give_up_at = min(give_up_at, deadline)
+
+        try:
+            with self._cond:
+                while True:
+                    entry = self._entries.get(path)
+                    if entry is not None and not entry.loading:
+                        entry.refs += 1
+                        entry.last_used = time.time()
+                        self._entries.move_to_end(path)
+                        self.counters.inc("hits")
+                        return entry
+                    if entry is None:
+                        # 加载前用文件大小估计内存占用
+                        estimate = os.path.getsize(path)
+                        if self._make_room(estimate):
+                            break
+                    # 别人正在加载同一个模型，或者腾不出地方：等
+                    timeout = give_up_at - time.time()
+                    if timeout <= 0:
+                        if deadline is not None and time.time() >= deadline:
+                            raise DeadlineExceeded(deadline)
+                        raise ModelBudgetExceeded(path, self.budget_bytes)
+                    self._cond.wait(timeout)
+
+                entry = _Entry(path, estimate)
+                entry.refs = 1
+                self._entries[path] = entry
+        finally:
+            self._collect_evicted()
+
+        start = time.perf_counter()
+        try:
+            model = self.loader(path)
+        except BaseException:
+            with self._cond:
+                del self._entries[path]
+                self.counters.inc("load_failures")
+                self._cond.notify_all()
+            raise
+        seconds = time.perf_counter() - start
+
+        with self._cond:
+            entry.model = model
+            entry.nbytes = model_nbytes(model)
+            entry.loading = False
+            entry.load_seconds = seconds
+            self.counters.inc("loads")
+            self.load_times.add(seconds)
+            # 实际大小可能比文件大
+            self._make_room(0)
+            self._cond.notify_all()
+        self._collect_evicted()
+        logging.info(f'ModelManager: loaded {path} '
+                     f'({entry.nbytes / (1 << 20):.1f} MiB) in {seconds:.2f}s, '
+                     f'{self._used_bytes() / (1 << 20):.1f} MiB in use')
+        return entry
+
+    def _release(self, entry: _Entry):
+        with self._cond:
+            entry.refs -= 1
+            entry.last_used = time.time()
+            if entry.refs == 0:
+                self._cond.notify_all()
+
+    def _used_bytes(self) -> int:
+        return sum(e.nbytes for e in self._entries.values())
+
+    def _make_room(self, nbytes) -> bool:
+        """Evict LRU idle models until nbytes more fit in the budget.
+        Must hold self._cond.
+
+        Returns False if the models in use leave no room.
+        A model bigger than the whole budget is still allowed when it
+        would be the only one.
+        """
+        if self.budget_bytes is None:
+            return True
+        used = self._used_bytes()
+        while used + nbytes > self.budget_bytes:
+            idle = next((e for e in self._entries.values()
+                         if e.refs == 0 and not e.loading), None)
+            if idle is None:
+                if not self._entries:
+                    logging.warning(
+                        f'ModelManager: a model of {nbytes / (1 << 20):.1f} MiB '
+                        f'exceeds the budget of {self.budget_bytes / (1 << 20):.1f} MiB')
+                    return True
+                return False
+            used -= idle.nbytes
+            self._evict(idle)
+        return True
+
+    def _evict(self, entry: _Entry):
+        """Must hold self._cond. The memory is freed by _collect_evicted (without the lock)."""
+        del self._entries[entry.path]
+        entry.model = None
+        self._evicted.append(entry)
+        self.counters.inc("evictions")
+
+    def _collect_evicted(self):
+        """gc.collect() after evictions. Must NOT hold self._cond:
+        a full collection takes a while, the loaded models stay usable meanwhile.
+        """
+        if not self._evicted:
+            return
+        with self._cond:
+            evicted, self._evicted = self._evicted, []
+        if not evicted:
+            return  # 别的线程已经收过了
+        start = time.perf_counter()
+        gc.collect()
+        seconds = time.perf_counter() - start
+
+        self.evict_times.add(seconds)
+        for entry in evicted:
+            logging.info(f'ModelManager: evicted {entry.path} '
+                         f'({entry.nbytes / (1 << 20):.1f} MiB, idle for '
+                         f'{time.time() - entry.last_used:.0f}s), gc in {seconds:.2f}s')
+
+    def stats(self) -> Dict:
+        """budget, usage, per model {bytes, refs, load_seconds, last_used}, counters"""
+        with self._cond:
+            return {
+                'budget_bytes': self.budget_bytes,
+                'used_bytes': self._used_bytes(),
+                'models': {e.path: {'bytes': e.nbytes,
+                                    'refs': e.refs,
+                                    'loading': e.loading,
+                                    'load_seconds': e.load_seconds,
+                                    'last_used': e.last_used}
+                           for e in self._entries.values()},
+                'counters': self.counters.snapshot(),
+                'mean_load_seconds': self.load_times.mean(),
+                'mean_evict_seconds': self.evict_times.mean(),
+            }
+
+
+class ModelBudgetExceeded(ChatbotError):
+    def __init__(self, path: str, budget_bytes: int):
+        self.path = path
+        self.budget_bytes = budget_bytes
+        super().__init__(
+            f"No room for {path} within the model memory budget of {budget_bytes} bytes, "
+            f"all the loaded models are in use")
@@ -1,3 +1,10 @@
 from .chatbot import *
 from .cooldown import *
+from .metrics import *
+from .settings import *
+from .capture import *
+from .session_store import *
+from .scheduler import *
+from .overload import *
 from .grpc_server import *
+from .balancer import *
@@ -0,0 +1,151 @@
+# ReplicaBalancer: 客户端的负载均衡小工具，用于多个 serve_grpc 副本。
+#
+# 会话只存在于某个副本的内存里（MultiChatbot.chatbots），所以：
+#  - NewSession 挑负载最低的健康副本（grpc.health.v1 + LoadReport）；
+#  - 之后同一个会话的 Chat / DeleteSession 都发到创建它的副本（stickiness）。
+#
+#     balancer = ReplicaBalancer(['localhost:50053', 'localhost:50054'])
+#     session_id = balancer.new_session('{"model": "chat"}')
+#     balancer.chat(session_id, '你是谁')
+
+import logging
+from threading import Lock
+import time
+from typing import Dict, List, Optional
+
+import grpc
+
+from .protos import chatbot_pb2, chatbot_pb2_grpc
+
+SERVICE_NAME = chatbot_pb2.DESCRIPTOR.services_by_name['ChatbotService'].full_name
+
+
+class _Replica:
+    def __init__(self, address: str):
+        from grpc_health.v1 import health_pb2_grpc
+
+        self.address = address
+        self.channel = grpc.insecure_channel(address)
+        self.stub = chatbot_pb2_grpc.ChatbotServiceStub(self.channel)
+        self.health_stub = health_pb2_grpc.HealthStub(self.channel)
+
+        self.healthy = False
+        self.report: Optional[chatbot_pb2.LoadReportResponse] = None
+
+    def load_key(self):
+        """smaller is less loaded"""
+        r = self.report
+        return (r.overload_level != 'normal',
+                r.queue_depth + r.inflight,
+                r.p95_latency_seconds,
+                -r.free_sessions)
+
+
+class ReplicaBalancer:
+    """Client-side balancing across serve_grpc replicas by reported load,
+    with session stickiness.
+    """
+
+    def __init__(self, addresses: List[str], refresh_interval=2.0, timeout=1.0):
+        """
+        Args:
+            refresh_interval: seconds a load report is trusted
+            timeout: seconds for health checks and load reports
+        """
+        self.replicas = [_Replica(address) for address in addresses]
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+
+        self.sessions: Dict[str, _Replica] = {}  # session_id -> replica
+        self._refreshed_at = 0.0
+        self._lock = Lock()
+
+    def refresh(self):
+        """Health check and LoadReport every replica"""
+        from grpc_health.v1 import health_pb2
+
+        # RPC 不拿锁（可能要等 timeout），拿到结果再一起换上去
+        results = []
+        for replica in self.replicas:
+            try:
+                health = replica.health_stub.Check(
+                    health_pb2.HealthCheckRequest(service=SERVICE_NAME),
+                    timeout=self.timeout)
+                report = replica.stub.LoadReport(
+                    chatbot_pb2.LoadReportRequest(), timeout=self.timeout)
+                results.append((replica, health.status == health_pb2.HealthCheckResponse.SERVING,
+                                report))
+            except grpc.RpcError as e:
+                logging.warning(
+                    f'ReplicaBalancer: {replica.address} unavailable: {e.code()}')
+                results.append((replica, False, replica.report))
+        with self._lock:
+            for replica, healthy, report in results:
+                replica.healthy = healthy
+                replica.report = report
+            self._refreshed_at = time.time()
+
+    def pick(self) -> List[_Replica]:
+        """Healthy replicas with free sessions, least loaded first"""
+        with self._lock:
+            stale = time.time() - self._refreshed_at > self.refresh_interval
+        if stale:
+            self.refresh()
+        with self._lock:
+            candidates = [r for r in self.replicas
+                          if r.healthy and r.report is not None and r.report.free_sessions > 0]
+            return sorted(candidates, key=_Replica.load_key)
+
+    def new_session(self, config: str, **call_kwargs) -> str:
+        """NewSession on the least loaded replica, return session_id.
+
+        Falls back to the next replica if one is out of sessions.
+
+        Raises:
+            grpc.RpcError: RESOURCE_EXHAUSTED if no replica can take a session
+        """
+        last_error = None
+        for replica in self.pick():
+            try:
+                resp = replica.stub.NewSession(
+                    chatbot_pb2.NewSessionRequest(config=config), **call_kwargs)
+            except grpc.RpcError as e:
+                if e.code() not in (grpc.StatusCode.RESOURCE_EXHAUSTED, grpc.StatusCode.UNAVAILABLE):
+                    raise
+                last_error = e
+                continue
+            # 本地先记一笔，不用等下次 LoadReport
+            with self._lock:
+                replica.report.free_sessions = max(0, replica.report.free_sessions - 1)
+                replica.report.active_sessions += 1
+                self.sessions[resp.session_id] = replica
+            return resp.session_id
+        if last_error is not None:
+            raise last_error
+        raise NoReplicaAvailable()
+
+    def stub(self, session_id: str) -> chatbot_pb2_grpc.ChatbotServiceStub:
+        """The stub of the replica that holds the session"""
+        if session_id not in self.sessions:
+            raise KeyError(f'unknown session {session_id}')
+        return self.sessions[session_id].stub
+
+    def chat(self, session_id: str, prompt: str, **call_kwargs) -> str:
+        resp = self.stub(session_id).Chat(
+            chatbot_pb2.ChatRequest(session_id=session_id, prompt=prompt), **call_kwargs)
+        return resp.response
+
+    def delete_session(self, session_id: str, **call_kwargs):
+        self.stub(session_id).DeleteSession(
+            chatbot_pb2.DeleteSessionRequest(session_id=session_id), **call_kwargs)
+        with self._lock:
+            self.sessions.pop(session_id, None)
+
+    def close(self):
+        for replica in self.replicas:
+            replica.channel.close()
+
+
+class NoReplicaAvailable(Exception):
+    def __init__(self):
+        super().__init__("No healthy replica with free sessions")
@@ -0,0 +1,184 @@
+# TrafficRecorder: 把线上的请求（匿名化后）录下来，给 replay 压测用。
+#
+# 开销很小：请求线程里只是把一个 tuple 放进队列（满了就丢，不阻塞），
+# 匿名化、序列化、压缩都在后台线程里批量做。
+#
+# 格式：gzip 的 JSON lines。第一行是头 {"v": 1, "start": unix 时间, "prompts": 模式}，
+# 之后每行一个请求，key 都很短：
+#   {"t": 相对 start 的秒数, "k": "n"(NewSession) / "c"(Chat) / "b"(BatchChat 的一项),
+#    "s": 会话的匿名 id, "p": prompt, "h": prompt 的哈希(prompts="hash" 时), "n": prompt 长度,
+#    "c": gRPC 状态码, "l": 延迟秒数, "cfg": NewSession 的配置, "hi": 高优先级,
+#    "b": BatchChat 的编号（同一次 BatchChat 的各项相同，每次录制从头编号）}
+#
+# 匿名化：
+#  - 会话 id 用每次录制随机生成（不落盘）的盐做哈希，同一次录制里能分组，但对不回原 id；
+#  - prompt 三种模式：
+#      "hash"（默认）：只留长度和加盐哈希（能看出重复，看不到内容），replay 时按长度生成占位文本；
+#      "masked"：字母、数字打码（用户名、号码、链接），中文原文保留——只在中文内容可以外传时用；
+#      "text"：原文。
+
+import gzip
+import hashlib
+import itertools
+import json
+import logging
+import os
+from queue import Empty, Full, Queue
+import random
+import re
+from threading import Thread
+import time
+from typing import Dict, Iterator
+
+from .metrics import Counters
+
+PROMPT_MODES = ('hash', 'masked', 'text')
+
+_ascii_letters = re.compile(r'[A-Za-z]')
+_digits = re.compile(r'[0-9]')
+
+
+def mask_prompt(prompt: str) -> str:
+    """字母 -> a，数字 -> 0，其余（中文、标点、emoji）不变"""
+    return _digits.sub('0', _ascii_letters.sub('a', prompt))
+
+
+class TrafficRecorder:
+    """Record requests, anonymised, to a compact gzip JSON lines file in the background"""
+
+    def __init__(self, path: str, sample_rate: float = 1.0, prompts: str = 'hash',
+                 max_pending: int = 10000, flush_interval: float = 1.0):
+        """
+        Args:
+            path: capture file (.jsonl.gz), appended to if it exists
+            sample_rate: fraction of sessions recorded (whole sessions, keeps their shape)
+            prompts: "hash", "masked" or "text", see above
+            max_pending: records waiting for the writer; more are dropped
+            flush_interval: seconds between writes
+        """
+        if prompts not in PROMPT_MODES:
+            raise ValueError(f'prompts must be one of {PROMPT_MODES}')
+        self.path = path
+        self.sample_rate = sample_rate
+        self.prompts = prompts
+        self.flush_interval = flush_interval
+
+        self._salt = os.urandom(16)
+        self._start = time.time()
+        self._queue: Queue = Queue(maxsize=max_pending)
+        self._batch_ids = itertools.count(1)
+
+        # {"recorded": n, "dropped": n}
+        self.counters = Counters()
+
+        Thread(target=self._write_loop, name='traffic-recorder', daemon=True).start()
+
+    def _hash(self, s: str) -> str:
+        return hashlib.blake2b(s.encode('utf-8'), digest_size=8, key=self._salt).hexdigest()
+
+    def _sampled(self, session_id: str) -> bool:
+        if self.sample_rate >= 1.0:
+            return True
+        # 按会话采样：同一个会话要么全录，要么全不录
+        return int(self._hash(session_id), 16) / 2 ** 64 < self.sample_rate
+
+    def new_batch_id(self) -> int:
+        """an id for the items of one BatchChat (record(..., batch=id))"""
+        return next(self._batch_ids)
+
+    def record(self, kind: str, session_id: str, prompt: str = None, at: float = None,
+               code: int = 0, latency: float = None, config: str = None, high_priority=False,
+               batch: int = None):
+        """Queue a request for the writer, never blocks.
+
+        kind: "n" NewSession, "c" Chat, "b" an item of BatchChat
+        at: arrival time (time.time()), default now
+        batch: new_batch_id() of the BatchChat, for "b"
+        """
+        if not self._sampled(session_id or ''):
+            return
+        try:
+            self._queue.put_nowait((kind, session_id, prompt, at or time.time(),
+                                    code, latency, config, high_priority, batch))
+        except Full:
+            self.counters.inc("dropped")
+
+    def _anonymise(self, kind, session_id, prompt, at, code, latency, config, high_priority, batch) -> Dict:
+        record = {'t': round(at - self._start, 3), 'k': kind,
+                  's': self._hash(session_id or ''), 'c': code}
+        if latency is not None:
+            record['l'] = round(latency, 4)
+        if config is not None:
+            record['cfg'] = config
+        if high_priority:
+            record['hi'] = 1
+        if batch is not None:
+            record['b'] = batch
+        if prompt is not None:
+            record['n'] = len(prompt)
+            if self.prompts == 'text':
+                record['p'] = prompt
+            elif self.prompts == 'masked':
+                record['p'] = mask_prompt(prompt)
+            else:
+                record['h'] = self._hash(prompt)
+        return record
+
+    def _write_loop(self):
+        self._append([json.dumps({'v': 1, 'start': self._start, 'prompts': self.prompts})])
+        while True:
+            time.sleep(self.flush_interval)
+            lines = []
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except Empty:
+                    break
+                lines.append(json.dumps(self._anonymise(*item),
+                                        ensure_ascii=False, separators=(',', ':')))
+            if lines:
+                self._append(lines)
+                self.counters.inc("recorded", len(lines))
+
+    def _append(self, lines):
+        # 每批写成一个完整的 gzip member（多个 member 接起来还是合法的 gzip）：
+        # 进程被杀掉时已经写的部分读得出来，重启后追加的新录制也读得出来
+        with open(self.path, 'ab') as f:
+            f.write(gzip.compress(''.join(line + '\n' for line in lines).encode('utf-8')))
+
+
+def read_capture(path: str) -> Iterator[Dict]:
+    """Yields the records of a capture file, with "t" made absolute (unix time).
+
+    A capture can hold several recordings (restarts append a new header):
+    "rec" is the index of the recording a record belongs to (batch ids "b"
+    restart in each). A truncated tail (the recorder was killed) is ignored.
+    """
+    start = 0.0
+    recording = -1
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # 最后一行写了一半
+                if 'v' in record:
+                    start = record['start']
+                    recording += 1
+                    continue
+                record['t'] += start
+                record['rec'] = recording
+                yield record
+        except EOFError:
+            logging.warning(f'read_capture: {path} is truncated')
+
+
+def placeholder_prompt(record: Dict) -> str:
+    """the prompt of a record, or a stable text of the same length for prompts="hash" captures"""
+    if 'p' in record:
+        return record['p']
+    rng = random.Random(record.get('h', ''))
+    return ''.join(chr(rng.randint(0x4e00, 0x9fa5)) for _ in range(record.get('n', 1)))
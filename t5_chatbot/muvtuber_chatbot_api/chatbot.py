@@ -5,35 +5,90 @@
 #    - create_chatbot(config) ->
 # - ChatbotConfig: config for ChatbotFactory & Chatbot
 
-from dataclasses import dataclass
+from collections import deque
+from dataclasses import asdict, dataclass
 import json
 import logging
-from threading import Timer
+from threading import Lock, Timer
 import time
-from typing import Dict
+from typing import Callable, Dict, List, Optional, Tuple, Type, Union
 import uuid
 from tokenizer import T5PegasusTokenizer
 from transformers.models.mt5.modeling_mt5 import MT5ForConditionalGeneration
 import torch
 from abc import ABCMeta, abstractmethod
+from .cooldown import CooldownException
+from .session_store import SessionState, SessionStore
 
 
 class Chatbot(metaclass=ABCMeta):
+    # True if Chatbots created from equal configs answer the same way
+    # (no per-session state), so MultiChatbot.ask_batch may run prompts
+    # of different sessions together on one of them.
+    batch_shareable = False
+
     @abstractmethod
     def ask(self, session_id, prompt, **kwargs):
         """Ask Chatbot with prompt, return response text
 
+        Optional kwargs:
+            deadline (float): absolute time.time() after which
+                nobody will read the response.
+            is_active (Callable[[], bool]): returns False once the
+                caller has gone away (e.g. gRPC client disconnected).
+
+        A Chatbot doing long work should call check_cancelled() with
+        these to give up early.
+
+        Under load the server may also pass generation budget hints
+        (see overload.DegradationLevel): max_length, greedy, retrieval_only.
+
         Raises:
             ChatbotError: Chatbot error
+            DeadlineExceeded: deadline passed before the response was ready
+            RequestCancelled: caller went away before the response was ready
+        """
+        pass
+
+    def ask_batch(self, session_ids: List[str], prompts: List[str], **kwargs) -> List[str]:
+        """Ask many prompts at once, return response texts in order.
+
+        Override it if the Chatbot can do better than asking one by one
+        (e.g. one batched model.generate).
+
+        Raises:
+            ChatbotError: Chatbot error, for the whole batch
+        """
+        return [self.ask(session_id, prompt, **kwargs)
+                for session_id, prompt in zip(session_ids, prompts)]
+
+    def restore_history(self, history: List[Tuple[str, str]]):
+        """Called with the recent (prompt, response) turns when a session
+        is restored from a SessionStore. Override it if the Chatbot keeps
+        conversation context.
         """
         pass
 
 
-# ChatbotConfig: {access_token, initial_prompt}
+def check_cancelled(deadline: Optional[float] = None, is_active: Optional[Callable[[], bool]] = None):
+    """Raise if the request should be abandoned.
+
+    Raises:
+        DeadlineExceeded: time.time() is past deadline
+        RequestCancelled: is_active() returns False
+    """
+    if deadline is not None and time.time() >= deadline:
+        raise DeadlineExceeded(deadline)
+    if is_active is not None and not is_active():
+        raise RequestCancelled()
+
+
+# ChatbotConfig: {access_token, initial_prompt, weight}
 @dataclass
 class ChatbotConfig:
     model: str = None
     initial_prompt: str = None
+    weight: float = 1.0  # share of inference under contention (FairScheduler)
 
     @classmethod
     def from_json(cls, json_str: str):
@@ -52,7 +107,7 @@ class ChatbotFactory(metaclass=ABCMeta):
 class ChatbotProxy(Chatbot):
     """ChatbotProxy is a Chatbot (Factory + Proxy) used by MultiChatbot."""
 
-    def __init__(self, session_id: str, config: ChatbotConfig, factory: ChatbotFactory, create_now=True):
+    def __init__(self, session_id: str, config: ChatbotConfig, factory: ChatbotFactory, create_now=True, history_turns=0):
         """A ChatbotProxy is represent to a session of MultiChatbot.
         (Maybe I should rename it ChatbotSession.)
 
@@ -68,6 +123,9 @@ class ChatbotProxy(Chatbot):
         the MultiChatbot & the ChatbotServer).
         It avoids loooong conversations (which holding tons of history context)
         accumulates and costs tokens ($0.002 / 1K tokens) over and over again.
+
+        history_turns: keep the last n (prompt, response) turns, saved
+        with the session state (see to_state).
         """
         self.session_id = session_id
         self.config = config
@@ -78,10 +136,42 @@ class ChatbotProxy(Chatbot):
         self.create_at = 0
         self.touch_at = 0
 
+        self.history = deque(maxlen=history_turns)
+
+        # asks running on this session, counted by MultiChatbot (under its lock):
+        # a session with an ask in flight is never spilled
+        self.inflight = 0
+
         self.Chatbot: Chatbot = None
         if create_now:
             self.renew()
 
+    def to_state(self) -> SessionState:
+        """the serializable state of this session"""
+        return SessionState(session_id=self.session_id,
+                            config=asdict(self.config),
+                            create_at=self.create_at,
+                            # 还没问过的会话 touch_at 是 0，按创建时间算
+                            touch_at=max(self.touch_at, self.create_at),
+                            initial_response=self.initial_response or "",
+                            history=[list(turn) for turn in self.history])
+
+    @classmethod
+    def from_state(cls, state: SessionState, config_class: Type[ChatbotConfig],
+                   factory: ChatbotFactory, history_turns=0) -> 'ChatbotProxy':
+        """re-create a session (and a new underlying Chatbot) from its state"""
+        proxy = cls(state.session_id, config_class(**state.config), factory,
+                    create_now=True, history_turns=history_turns)
+        proxy.touch_at = state.touch_at
+        proxy.initial_response = state.initial_response
+        proxy.history.extend(tuple(turn) for turn in state.history)
+        if proxy.history:
+            proxy.Chatbot.restore_history(list(proxy.history))
+        return proxy
+
+    def add_turn(self, prompt: str, response: str):
+        self.history.append((prompt, response))
+
     def renew(self):
         """re-create the underlying (real) Chatbot instance"""
         self.Chatbot = self.factory.create_chatbot(self.config)
@@ -100,29 +190,74 @@ class ChatbotProxy(Chatbot):
         self.touch_at = time.time()
         return self.Chatbot.ask(session_id, prompt, **kwargs)
 
+    def ask_batch(self, session_ids, prompts, **kwargs):
+        """ask_batch the underlying (real) Chatbot"""
+        self.touch_at = time.time()
+        return self.Chatbot.ask_batch(session_ids, prompts, **kwargs)
+
 
 # MultiChatbot: {session_id: Chatbot}:
 #  - new(config) -> session_id
 #  - ask(session_id, prompt) -> response
 #  - delete(session_id)
 class MultiChatbot(Chatbot):
-    """MultiChatbot: {session_id: Chatbot}"""
-
-    def __init__(self, chatbot_factory: ChatbotFactory, max_sessions=10, timeout=900, zombie_timeout=1800, check_timeout_interval=60):
+    """MultiChatbot: {session_id: Chatbot}
+
+    With a SessionStore, sessions idle for idle_timeout seconds (or the
+    least recently used ones, when max_sessions are in memory) are spilled
+    to the store and restored on their next ask. Every session is written
+    to the store when created, so a restarted server (with the same store)
+    still knows them. max_sessions then limits the sessions in memory,
+    the store keeps the rest until its ttl. Sessions with an ask in flight
+    are never spilled. The idle check runs at least every idle_timeout / 2.
+    """
+
+    def __init__(self, chatbot_factory: ChatbotFactory, max_sessions=10, timeout=900, zombie_timeout=1800, check_timeout_interval=60,
+                 store: SessionStore = None, config_class: Type[ChatbotConfig] = ChatbotConfig, idle_timeout=600, history_turns=0):
         self.chatbot_factory = chatbot_factory
-        self.chatbots: Dict[str, ChatbotProxy] = {}  # XXX: 话说这东西线程安全嘛
+        self.chatbots: Dict[str, ChatbotProxy] = {}  # 增删都要拿着 self._store_lock
+
+        # 落盘：None 则所有会话只在内存里
+        self.store = store
+        self.config_class = config_class  # to re-create configs from the store
+        self.idle_timeout = idle_timeout  # spill after idle in seconds: 10 min
+        self.history_turns = history_turns
+        self._store_lock = Lock()  # self.chatbots 的增删、spill / restore、会话的 inflight 计数
+        self._restoring: List[str] = []  # 正在从盘上恢复的会话：已经占了位置，还没放进 self.chatbots
 
         self.max_sessions = max_sessions
         self.timeout = timeout  # timeout in seconds: 15 min
         self.zombie_timeout = zombie_timeout  # zombie timeout in seconds: 30 min
         # interval time to check timeout session in sec
         self.check_timeout_interval = check_timeout_interval
+        if store is not None:
+            # 闲置会话要按 idle_timeout 及时挪到盘上，不能等一个很长的检查周期
+            self.check_timeout_interval = min(
+                check_timeout_interval, max(1, idle_timeout / 2))
+
+        self._schedule_renew()
 
-        Timer(self.check_timeout_interval, self.renew_timeout_sessions).start()
+    def _schedule_renew(self):
+        # daemon: 不挡着进程退出（SIGTERM 之后 serve_grpc 返回就该退出了）
+        timer = Timer(self.check_timeout_interval, self.renew_timeout_sessions)
+        timer.daemon = True
+        timer.start()
 
     def renew_timeout_sessions(self):
-        now = time.time()
-        for Chatbot in self.chatbots.values():
+        try:
+            self._renew_timeout_sessions()
+        finally:
+            self._schedule_renew()
+
+    def _renew_timeout_sessions(self):
+        if self.store is not None:
+            self.spill_idle_sessions()
+            with self._store_lock:
+                # 内存里的会话盘上的文件可能很久没更新了，不能按 mtime 删
+                self.store.expire(keep=set(self.chatbots) | set(self._restoring))
+        with self._store_lock:
+            chatbots = list(self.chatbots.values())
+        for Chatbot in chatbots:
             if Chatbot.is_zombie(timeout=self.zombie_timeout):
                 logging.debug(
                     f"MultiChatbot: zombie Chatbot: {Chatbot.session_id}, skip renew.")
@@ -131,17 +266,153 @@ class MultiChatbot(Chatbot):
                 logging.info(
                     f"MultiChatbot: renew a timeout Chatbot session {Chatbot.session_id}")
                 Chatbot.renew()
-        Timer(self.check_timeout_interval, self.renew_timeout_sessions).start()
 
     def clean_zombie_sessions(self):
+        with self._store_lock:
+            self._clean_zombie_sessions()
+
+    def _clean_zombie_sessions(self):
         session_ids_to_del = []
         for Chatbot in self.chatbots.values():
-            if Chatbot.is_zombie(timeout=self.timeout*2):
+            if Chatbot.inflight == 0 and Chatbot.is_zombie(timeout=self.timeout*2):
                 session_ids_to_del.append(Chatbot.session_id)
         logging.info(
             f"MultiChatbot: delete zombie Chatbots: {session_ids_to_del}")
         for s in session_ids_to_del:
-            self.delete(s)
+            self._delete(s)
+
+    def spill(self, session_id: str):
+        """Move an in-memory session to the store (drops its Chatbot)"""
+        with self._store_lock:
+            self._spill(session_id)
+
+    def _spill(self, session_id: str):
+        proxy = self.chatbots.get(session_id)
+        if proxy is None or proxy.inflight:
+            return
+        # 先写盘再从内存里拿掉：任何时候都能在其中一处找到这个会话
+        self.store.save(proxy.to_state())
+        del self.chatbots[session_id]
+
+    def _make_room(self):
+        """spill least recently used sessions (without asks in flight)
+        until there is room for one more, as far as possible
+        """
+        while len(self.chatbots) + len(self._restoring) >= self.max_sessions:
+            idle = [c for c in self.chatbots.values() if not c.inflight]
+            if not idle:
+                return
+            lru = min(idle, key=lambda c: max(c.touch_at, c.create_at))
+            logging.info(f"MultiChatbot: spill session {lru.session_id} to make room")
+            self._spill(lru.session_id)
+
+    def spill_idle_sessions(self):
+        """Spill the sessions not asked for idle_timeout seconds to the store"""
+        now = time.time()
+        with self._store_lock:
+            idle = [c.session_id for c in self.chatbots.values()
+                    if not c.inflight and now - max(c.touch_at, c.create_at) > self.idle_timeout]
+            for session_id in idle:
+                self._spill(session_id)
+        if idle:
+            logging.info(
+                f"MultiChatbot: spilled {len(idle)} idle sessions, {len(self.chatbots)} in memory")
+
+    def snapshot(self):
+        """Save the state of all in-memory sessions to the store (e.g. before shutdown)"""
+        start = time.perf_counter()
+        with self._store_lock:
+            for proxy in list(self.chatbots.values()):
+                self.store.save(proxy.to_state())
+        logging.info(f"MultiChatbot: snapshot of {len(self.chatbots)} sessions "
+                     f"in {time.perf_counter() - start:.3f}s")
+
+    def has_session(self, session_id: str) -> bool:
+        """in memory or in the store"""
+        if session_id in self.chatbots:
+            return True
+        return self.store is not None and self.store.contains(session_id)
+
+    def session_count(self) -> int:
+        """sessions in memory or in the store"""
+        with self._store_lock:
+            in_memory = set(self.chatbots)
+        if self.store is None:
+            return len(in_memory)
+        return len(in_memory | set(self.store.session_ids()))
+
+    def free_sessions(self) -> int:
+        """how many more sessions new_session can take now
+
+        With a store, new sessions spill the least recently used ones
+        (those without asks in flight) instead of counting against max_sessions.
+        """
+        with self._store_lock:
+            if self.store is None:
+                return max(0, self.max_sessions - len(self.chatbots))
+            busy = sum(1 for c in self.chatbots.values() if c.inflight)
+        return max(0, self.max_sessions - busy)
+
+    def get_session(self, session_id: str) -> ChatbotProxy:
+        """The session, restored from the store if it was spilled
+
+        Raises:
+            SessionNotFound: Session not found
+            ChatbotError: Chatbot error when re-creating the Chatbot
+        """
+        return self._get_session(session_id)
+
+    def _get_session(self, session_id: str, checkout=False) -> ChatbotProxy:
+        """get_session; checkout: also count an ask in flight on it
+
+        Takes self._store_lock itself, but not while re-creating the Chatbot
+        of a spilled session (that may load a model): the slot is reserved
+        before, the session installed after. If another restore of the same
+        session won meanwhile, this one is dropped.
+        """
+        with self._store_lock:
+            proxy = self.chatbots.get(session_id)
+            if proxy is not None:
+                if checkout:
+                    proxy.inflight += 1
+                return proxy
+            state = self.store.load(session_id) if self.store is not None else None
+            if state is None:
+                raise SessionNotFound(session_id)
+            self._make_room()
+            self._restoring.append(session_id)
+
+        start = time.perf_counter()
+        try:
+            restored = ChatbotProxy.from_state(state, self.config_class, self.chatbot_factory,
+                                               history_turns=self.history_turns)
+        except BaseException:
+            with self._store_lock:
+                self._restoring.remove(session_id)
+            raise
+
+        with self._store_lock:
+            self._restoring.remove(session_id)
+            proxy = self.chatbots.get(session_id)
+            if proxy is None:
+                if not self.store.contains(session_id):
+                    raise SessionNotFound(session_id)  # 恢复的时候被删了
+                proxy = self.chatbots[session_id] = restored
+                logging.info(f"MultiChatbot: restored session {session_id} "
+                             f"in {time.perf_counter() - start:.3f}s")
+            # 恢复它就是要问了：请求可能还要在调度器里排一会儿，别按旧的 touch_at 被挪回盘上
+            proxy.touch_at = time.time()
+            if checkout:
+                proxy.inflight += 1
+            return proxy
+
+    def _checkout(self, session_id: str) -> ChatbotProxy:
+        """get_session, and count an ask in flight on it (not spilled until _checkin)"""
+        return self._get_session(session_id, checkout=True)
+
+    def _checkin(self, proxy: ChatbotProxy):
+        with self._store_lock:
+            proxy.inflight -= 1
 
     # raises TooManySessions, ChatbotError
     def new_session(self, config: ChatbotConfig) -> str:
@@ -153,45 +424,126 @@ class MultiChatbot(Chatbot):
             TooManySessions: Too many sessions
             ChatbotError: Chatbot error when asking initial prompt
         """
-        if len(self.chatbots) >= self.max_sessions:
-            self.clean_zombie_sessions()
-        if len(self.chatbots) >= self.max_sessions:
-            raise TooManySessions(self.max_sessions)
+        with self._store_lock:
+            self._make_room_for_new()
 
+        # 创建 Chatbot 可能很慢，不拿着锁
         session_id = str(uuid.uuid4())
+        proxy = ChatbotProxy(session_id, config, self.chatbot_factory,
+                             create_now=True, history_turns=self.history_turns)
 
-        self.chatbots[session_id] = ChatbotProxy(
-            session_id, config, self.chatbot_factory, create_now=True)
+        with self._store_lock:
+            # 创建的时候别的线程可能又占满了
+            self._make_room_for_new()
+            if self.store is not None:
+                self.store.save(proxy.to_state())
+            self.chatbots[session_id] = proxy
 
         return session_id
 
+    def _make_room_for_new(self):
+        """Raises TooManySessions if there is no room for a new session"""
+        if len(self.chatbots) + len(self._restoring) >= self.max_sessions and self.store is not None:
+            # 落盘的话不删会话，把最久没用的挪到盘上
+            self._make_room()
+        if len(self.chatbots) + len(self._restoring) >= self.max_sessions:
+            self._clean_zombie_sessions()
+        if len(self.chatbots) + len(self._restoring) >= self.max_sessions:
+            raise TooManySessions(self.max_sessions)
+
     def ask(self, session_id: str, prompt: str, **kwargs) -> str:  # raises ChatbotError
         """Ask Chatbot with session_id and prompt, return response text
 
+        kwargs are passed to the underlying Chatbot. The request is
+        dropped without asking if it's already expired or cancelled
+        (see check_cancelled).
+
         Raises:
             SessionNotFound: Session not found
             ChatbotError: Chatbot error when asking
+            DeadlineExceeded, RequestCancelled: request abandoned
         """
-        if session_id not in self.chatbots:
-            raise SessionNotFound(session_id)
+        proxy = self._checkout(session_id)
+        try:
+            check_cancelled(kwargs.get('deadline'), kwargs.get('is_active'))
 
-        resp = self.chatbots[session_id].ask(session_id, prompt)
+            resp = proxy.ask(session_id, prompt, **kwargs)
+            proxy.add_turn(prompt, resp)
+        finally:
+            self._checkin(proxy)
 
         return resp
 
+    def ask_batch(self, items: List[Tuple[str, str]], **kwargs) -> List[Union[str, Exception]]:
+        """Ask many (session_id, prompt) at once.
+
+        Items of the same session are asked together. Sessions of a
+        batch_shareable Chatbot with equal configs are asked together too,
+        on one of them.
+
+        Returns one result per item, in order: the response text, or the
+        exception of that item (SessionNotFound, ChatbotError, CooldownException).
+        """
+        results: List[Union[str, Exception]] = [None] * len(items)
+
+        proxies: Dict[str, ChatbotProxy] = {}
+        try:
+            self._ask_batch(items, results, proxies, **kwargs)
+        finally:
+            for proxy in proxies.values():
+                self._checkin(proxy)
+        return results
+
+    def _ask_batch(self, items, results, proxies: Dict[str, ChatbotProxy], **kwargs):
+        """fills results; proxies: the checked out sessions, to be checked in by the caller"""
+        groups: Dict[object, List[int]] = {}
+        for i, (session_id, prompt) in enumerate(items):
+            try:
+                proxy = proxies.get(session_id) or self._checkout(session_id)
+            except (SessionNotFound, ChatbotError) as e:
+                results[i] = e
+                continue
+            proxies[session_id] = proxy
+            if proxy.Chatbot.batch_shareable:
+                key = (type(proxy.Chatbot), repr(proxy.config))
+            else:
+                key = session_id
+            groups.setdefault(key, []).append(i)
+
+        for indices in groups.values():
+            session_ids = [items[i][0] for i in indices]
+            prompts = [items[i][1] for i in indices]
+            for session_id in set(session_ids):
+                proxies[session_id].touch_at = time.time()
+            try:
+                check_cancelled(kwargs.get('deadline'), kwargs.get('is_active'))
+                responses = proxies[session_ids[0]].ask_batch(
+                    session_ids, prompts, **kwargs)
+            except (ChatbotError, CooldownException) as e:
+                responses = [e] * len(indices)
+            for i, response in zip(indices, responses):
+                results[i] = response
+                if not isinstance(response, Exception):
+                    proxies[items[i][0]].add_turn(items[i][1], response)
+
     def delete(self, session_id: str):  # raises SessionNotFound
         """Delete Chatbot session
 
         Raises:
             SessionNotFound: Session not found
         """
-        if session_id not in self.chatbots:
-            raise SessionNotFound(session_id)
+        with self._store_lock:
+            self._delete(session_id)
 
-        del self.chatbots[session_id]
+    def _delete(self, session_id: str):
+        in_memory = self.chatbots.pop(session_id, None) is not None
+        in_store = self.store is not None and self.store.delete(session_id)
+        if not (in_memory or in_store):
+            raise SessionNotFound(session_id)
 
 
 # Exceptions: TooManySessions, SessionNotFound, ChatbotError
+#  - ChatbotError: DeadlineExceeded, RequestCancelled, Overloaded
 
 class TooManySessions(Exception):
     def __init__(self, max_sessions: int):
@@ -211,3 +563,20 @@ class ChatbotError(Exception):
     def __init__(self, message=""):
         self.message = message
         super().__init__(self.message)
+
+
+class DeadlineExceeded(ChatbotError):
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+        super().__init__(
+            f"Deadline exceeded ({time.time() - deadline:.3f}s ago)")
+
+
+class RequestCancelled(ChatbotError):
+    def __init__(self):
+        super().__init__("Request cancelled by client")
+
+
+class Overloaded(ChatbotError):
+    def __init__(self, message="Overloaded, try again later"):
+        super().__init__(message)
@@ -1,18 +1,68 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields, replace
 import logging
 from concurrent import futures
+import signal
+import threading
+import time
 from typing import Type
 import grpc
 
 from .protos import chatbot_pb2, chatbot_pb2_grpc
 from .cooldown import CooldownException
-from .chatbot import MultiChatbot, ChatbotFactory, ChatbotConfig, ChatbotError, TooManySessions, SessionNotFound
+from .chatbot import MultiChatbot, ChatbotFactory, ChatbotConfig, ChatbotError, TooManySessions, SessionNotFound, DeadlineExceeded, RequestCancelled
+from .metrics import Counters, LatencyWindow
+from .overload import OverloadController
+from .settings import load_settings
+from .capture import TrafficRecorder
+from .session_store import SessionStore
+from .scheduler import FairScheduler, TooManyRequests, PRIORITY_HIGH, PRIORITY_NORMAL
+
+# gRPC metadata: "muvtuber-priority: high" for e.g. streamer-initiated prompts
+PRIORITY_METADATA_KEY = 'muvtuber-priority'
+
+
+def rpc_deadline(context):
+    """RPC deadline as an absolute time.time(), None if the client set no deadline."""
+    remaining = context.time_remaining()
+    if remaining is None:
+        return None
+    return time.time() + remaining
+
+
+def rpc_priority(context):
+    """PRIORITY_HIGH if the client sent "muvtuber-priority: high" metadata"""
+    for key, value in context.invocation_metadata() or ():
+        if key == PRIORITY_METADATA_KEY and value == 'high':
+            return PRIORITY_HIGH
+    return PRIORITY_NORMAL
 
 
 class ChatbotGrpcServer(chatbot_pb2_grpc.ChatbotServiceServicer):
-    def __init__(self, multichatbot: MultiChatbot, chatbot_config: ChatbotConfig):
+    def __init__(self, multichatbot: MultiChatbot, chatbot_config: ChatbotConfig, scheduler: FairScheduler = None, max_batch_size=64,
+                 overload: OverloadController = None, recorder: TrafficRecorder = None):
         self.multichatbot = multichatbot
         self.chatbot_config = chatbot_config
+        self.scheduler = scheduler or FairScheduler()
+        self.max_batch_size = max_batch_size
+        self.overload = overload  # None: never degrade
+        self.recorder = recorder  # None: no traffic capture
+
+        # abandoned work: {"expired": n, "cancelled": n}
+        self.abandoned = Counters()
+        # end-to-end latency of recent Chat / BatchChat calls
+        self.latencies = LatencyWindow()
+
+    def _budget(self):
+        """ask kwargs of the current degradation level"""
+        if self.overload is None:
+            return {}
+        return self.overload.current().ask_kwargs()
+
+    def _observe(self, start):
+        seconds = time.time() - start
+        self.latencies.add(seconds)
+        if self.overload is not None:
+            self.overload.observe(seconds)
 
     def NewSession(self, request, context):
         """NewSession creates a new session with Chatbot.
@@ -31,6 +81,7 @@ class ChatbotGrpcServer(chatbot_pb2_grpc.ChatbotServiceServicer):
 
         # new session
         session_id = None
+        start = time.time()
         try:
             session_id = self.multichatbot.new_session(config)
         except TooManySessions as e:
@@ -46,6 +97,9 @@ class ChatbotGrpcServer(chatbot_pb2_grpc.ChatbotServiceServicer):
         else:
             logging.info(
                 f'ChatbotGrpcServer.NewSession: (OK) session_id={session_id}')
+        if self.recorder is not None and session_id is not None:
+            self.recorder.record('n', session_id, at=start,
+                                 latency=time.time() - start, config=request.config)
 
         # XXX: deprecate initial_response?
         initial_response = None
@@ -73,19 +127,48 @@ class ChatbotGrpcServer(chatbot_pb2_grpc.ChatbotServiceServicer):
             logging.warn('ChatbotGrpcServer.Chat: prompt is required')
             return chatbot_pb2.ChatResponse()
 
+        start = time.time()
         response = None
         try:
-            response = self.multichatbot.ask(
-                request.session_id, request.prompt)
+            session = self.multichatbot.get_session(request.session_id)
+            deadline = rpc_deadline(context)
+            response = self.scheduler.run(
+                request.session_id,
+                lambda: self.multichatbot.ask(
+                    request.session_id, request.prompt,
+                    deadline=deadline,
+                    is_active=context.is_active,
+                    **self._budget()),
+                weight=session.config.weight,
+                priority=rpc_priority(context),
+                deadline=deadline,
+                is_active=context.is_active)
         except SessionNotFound as e:
             context.set_code(grpc.StatusCode.NOT_FOUND)
             context.set_details(str(e))
+        except DeadlineExceeded as e:
+            self.abandoned.inc("expired")
+            context.set_code(grpc.StatusCode.DEADLINE_EXCEEDED)
+            context.set_details(str(e))
+        except RequestCancelled as e:
+            self.abandoned.inc("cancelled")
+            context.set_code(grpc.StatusCode.CANCELLED)
+            context.set_details(str(e))
         except ChatbotError as e:
             context.set_code(grpc.StatusCode.UNAVAILABLE)
             context.set_details(str(e))
         except CooldownException as e:
             context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
             context.set_details(str(e))
+        except TooManyRequests as e:
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+            context.set_details(str(e))
+        self._observe(start)
+        if self.recorder is not None:
+            code = context.code() or grpc.StatusCode.OK
+            self.recorder.record('c', request.session_id, request.prompt, at=start,
+                                 code=code.value[0], latency=time.time() - start,
+                                 high_priority=rpc_priority(context) == PRIORITY_HIGH)
 
         if context.code() != grpc.StatusCode.OK and context.code() != None:
             logging.warn(
@@ -96,6 +179,116 @@ class ChatbotGrpcServer(chatbot_pb2_grpc.ChatbotServiceServicer):
 
         return chatbot_pb2.ChatResponse(response=response)
 
+    def BatchChat(self, request, context):
+        """BatchChat sends many (session_id, prompt) pairs in one call.
+        Input: items (repeated ChatRequest).
+        Output: results (repeated BatchChatResult), one per item, in order,
+        each with its own status code.
+
+        The batch is scheduled as one request charged to every session in it
+        (by their weights and inflight limits), and asked as few batched
+        generate()s as possible.
+        """
+        if len(request.items) > self.max_batch_size:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(
+                f'too many items: {len(request.items)}, max {self.max_batch_size}')
+            logging.warn(f'ChatbotGrpcServer.BatchChat: {context.details()}')
+            return chatbot_pb2.BatchChatResponse()
+
+        results = [None] * len(request.items)
+        items, indices = [], []
+        for i, item in enumerate(request.items):
+            if not item.session_id:
+                results[i] = (grpc.StatusCode.INVALID_ARGUMENT,
+                              'session_id is required', None)
+            elif not item.prompt:
+                results[i] = (grpc.StatusCode.INVALID_ARGUMENT,
+                              'prompt is required', None)
+            else:
+                items.append((item.session_id, item.prompt))
+                indices.append(i)
+
+        start = time.time()
+        responses = []
+        # 找不到的会话不排队，ask_batch 里会给它们 NOT_FOUND
+        weights = {}
+        for session_id, _ in items:
+            if session_id in weights:
+                continue
+            try:
+                weights[session_id] = self.multichatbot.get_session(
+                    session_id).config.weight
+            except (SessionNotFound, ChatbotError):
+                pass
+        try:
+            deadline = rpc_deadline(context)
+            responses = self.scheduler.run_batch(
+                [session_id for session_id, _ in items if session_id in weights],
+                lambda: self.multichatbot.ask_batch(
+                    items, deadline=deadline, is_active=context.is_active,
+                    **self._budget()),
+                weights=weights,
+                priority=rpc_priority(context),
+                deadline=deadline,
+                is_active=context.is_active)
+        except (ChatbotError, TooManyRequests) as e:
+            responses = [e] * len(items)
+        self._observe(start)
+
+        for i, response in zip(indices, responses):
+            if not isinstance(response, Exception):
+                results[i] = (grpc.StatusCode.OK, '', response)
+                continue
+            if isinstance(response, SessionNotFound):
+                code = grpc.StatusCode.NOT_FOUND
+            elif isinstance(response, DeadlineExceeded):
+                self.abandoned.inc("expired")
+                code = grpc.StatusCode.DEADLINE_EXCEEDED
+            elif isinstance(response, RequestCancelled):
+                self.abandoned.inc("cancelled")
+                code = grpc.StatusCode.CANCELLED
+            elif isinstance(response, (CooldownException, TooManyRequests)):
+                code = grpc.StatusCode.RESOURCE_EXHAUSTED
+            else:
+                code = grpc.StatusCode.UNAVAILABLE
+            results[i] = (code, str(response), None)
+
+        if self.recorder is not None:
+            latency = time.time() - start
+            batch = self.recorder.new_batch_id()
+            high_priority = rpc_priority(context) == PRIORITY_HIGH
+            for item, (code, _, _) in zip(request.items, results):
+                self.recorder.record('b', item.session_id, item.prompt, at=start,
+                                     code=code.value[0], latency=latency,
+                                     high_priority=high_priority, batch=batch)
+
+        n_ok = sum(code == grpc.StatusCode.OK for code, _, _ in results)
+        logging.info(
+            f'ChatbotGrpcServer.BatchChat: {n_ok}/{len(results)} OK')
+
+        return chatbot_pb2.BatchChatResponse(results=[
+            chatbot_pb2.BatchChatResult(session_id=item.session_id,
+                                        response=response,
+                                        code=code.value[0],
+                                        details=details)
+            for item, (code, details, response) in zip(request.items, results)])
+
+    def LoadReport(self, request, context):
+        """LoadReport reports the load of this server (replica),
+        for client-side load balancing across replicas.
+        Input: none.
+        Output: sessions, queue depth, recent p95 latency and free capacity.
+        """
+        return chatbot_pb2.LoadReportResponse(
+            active_sessions=self.multichatbot.session_count(),
+            max_sessions=self.multichatbot.max_sessions,
+            free_sessions=self.multichatbot.free_sessions(),
+            queue_depth=self.scheduler.queue_depth(),
+            inflight=self.scheduler.inflight(),
+            p95_latency_seconds=self.latencies.percentile(95),
+            overload_level=self.overload.current().name if self.overload else 'normal')
+
     def DeleteSession(self, request, context):
         """DeleteSession deletes a session with Chatbot.
         Input: session_id (string).
@@ -111,6 +304,7 @@ class ChatbotGrpcServer(chatbot_pb2_grpc.ChatbotServiceServicer):
 
         try:
             self.multichatbot.delete(request.session_id)
+            self.scheduler.forget(request.session_id)
         except SessionNotFound as e:
             context.set_code(grpc.StatusCode.NOT_FOUND)
             context.set_details(str(e))
@@ -135,20 +329,95 @@ class MuvtuberGrpcServerConfig():
     zombie_timeout: int = 60*60*2  # seconds
     check_timeout_interval: int = 60  # seconds
     add_reflection_service: bool = True
+    add_health_service: bool = True  # grpc.health.v1.Health
+    # gRPC worker threads. Queued requests hold a thread while waiting, so keep
+    # it above max_sessions-ish * (max_inflight_per_session + max_queue_per_session)
+    # to leave room for quiet sessions.
+    max_workers: int = 32
+    # FairScheduler
+    max_concurrency: int = 2  # requests running inference at the same time
+    max_inflight_per_session: int = 1
+    max_queue_per_session: int = 4
+    max_batch_size: int = 64  # items per BatchChat
+    scheduler_report_interval: float = 60  # seconds, FairScheduler 的统计多久打一次日志，None 则不打
+    # OverloadController: 延迟或排队超标时逐级降低生成预算。None 则不启用。
+    overload_target_p99: float = None  # seconds
+    overload_max_queue_depth: int = 8
+    overload_check_interval: float = 1.0  # seconds
+    # 流量录制（给 replay 压测用）：录到这个文件（.jsonl.gz）。None 则不录。
+    capture_file: str = None
+    capture_sample_rate: float = 1.0  # 录多少比例的会话
+    capture_prompts: str = 'hash'  # "hash" / "masked" / "text"，见 capture.py
+    # 会话落盘：闲置的会话存到这个目录，下次 Chat 时再恢复；重启后也能接着用。None 则不落盘。
+    session_store_dir: str = None
+    session_idle_timeout: int = 60*10  # seconds, 闲置多久落盘
+    session_store_ttl: int = 60*60*24  # seconds, 落盘的会话多久没用就删掉
+    session_history_turns: int = 0  # 每个会话随状态一起存最近几轮对话
+    # JSON 文件，其中 "serve_grpc" 对象里的字段覆盖上面的配置（例如 autotune 写出来的）。None 则不用。
+    settings_file: str = None
+
+    def with_settings(self) -> 'MuvtuberGrpcServerConfig':
+        """A copy with the fields overridden by the "serve_grpc" object of settings_file"""
+        if not self.settings_file:
+            return self
+        overrides = load_settings(self.settings_file, 'serve_grpc')
+        known = {f.name for f in fields(self)}
+        for key in overrides.keys() - known:
+            logging.warning(
+                f'MuvtuberGrpcServerConfig: unknown setting {key} in {self.settings_file}, ignored.')
+        overrides = {k: v for k, v in overrides.items() if k in known}
+        logging.info(
+            f'MuvtuberGrpcServerConfig: settings from {self.settings_file}: {overrides}')
+        return replace(self, **overrides)
 
 
 def serve_grpc(config: MuvtuberGrpcServerConfig):
     """Starts a gRPC server at the specified address 'host:port'."""
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    config = config.with_settings()
+
+    server = grpc.server(futures.ThreadPoolExecutor(
+        max_workers=config.max_workers))
+
+    store = None
+    if config.session_store_dir:
+        store = SessionStore(config.session_store_dir, ttl=config.session_store_ttl)
+        logging.info(f'Session store enabled: {config.session_store_dir} '
+                     f'({store.count()} stored sessions)')
 
     multichatbot = MultiChatbot(config.chatbot_factory,
                                 max_sessions=config.max_sessions,
                                 timeout=config.timeout,
                                 zombie_timeout=config.zombie_timeout,
-                                check_timeout_interval=config.check_timeout_interval)
+                                check_timeout_interval=config.check_timeout_interval,
+                                store=store,
+                                config_class=config.chatbot_config_class,
+                                idle_timeout=config.session_idle_timeout,
+                                history_turns=config.session_history_turns)
+
+    scheduler = FairScheduler(max_concurrency=config.max_concurrency,
+                              max_inflight_per_session=config.max_inflight_per_session,
+                              max_queue_per_session=config.max_queue_per_session,
+                              report_interval=config.scheduler_report_interval)
+
+    overload = None
+    if config.overload_target_p99:
+        overload = OverloadController(scheduler,
+                                      target_p99=config.overload_target_p99,
+                                      max_queue_depth=config.overload_max_queue_depth,
+                                      check_interval=config.overload_check_interval)
+        overload.start()
+
+    recorder = None
+    if config.capture_file:
+        recorder = TrafficRecorder(config.capture_file,
+                                   sample_rate=config.capture_sample_rate,
+                                   prompts=config.capture_prompts)
+        logging.info(f'Traffic capture enabled: {config.capture_file} '
+                     f'(sample_rate={config.capture_sample_rate}, prompts={config.capture_prompts})')
 
     chatbot_grpc_server = ChatbotGrpcServer(
-        multichatbot, config.chatbot_config_class())
+        multichatbot, config.chatbot_config_class(), scheduler,
+        max_batch_size=config.max_batch_size, overload=overload, recorder=recorder)
 
     chatbot_pb2_grpc.add_ChatbotServiceServicer_to_server(
         chatbot_grpc_server, server)
@@ -156,6 +425,15 @@ def serve_grpc(config: MuvtuberGrpcServerConfig):
     SERVICE_NAMES = [
         chatbot_pb2.DESCRIPTOR.services_by_name['ChatbotService'].full_name]
 
+    if config.add_health_service:
+        from grpc_health.v1 import health, health_pb2, health_pb2_grpc
+        health_servicer = health.HealthServicer()
+        health_pb2_grpc.add_HealthServicer_to_server(health_servicer, server)
+        for service in SERVICE_NAMES + ['']:
+            health_servicer.set(service, health_pb2.HealthCheckResponse.SERVING)
+        SERVICE_NAMES.append(health.SERVICE_NAME)
+        logging.info(f'gRPC health service enabled.')
+
     if config.add_reflection_service:
         from grpc_reflection.v1alpha import reflection
         SERVICE_NAMES.append(reflection.SERVICE_NAME)
@@ -166,4 +444,12 @@ def serve_grpc(config: MuvtuberGrpcServerConfig):
     server.start()
     print(f'Chatbot gRPC server started at {config.address}.')
     print(f'Services: {SERVICE_NAMES}')
-    server.wait_for_termination()
+
+    if store is not None and threading.current_thread() is threading.main_thread():
+        # 部署时的 SIGTERM：停止接收请求，把内存里的会话存盘后再退出
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop(grace=5))
+    try:
+        server.wait_for_termination()
+    finally:
+        if store is not None:
+            multichatbot.snapshot()
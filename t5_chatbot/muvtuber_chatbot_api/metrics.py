@@ -0,0 +1,56 @@
+from collections import Counter, deque
+import math
+from threading import Lock
+from typing import Dict
+
+
+class Counters:
+    """Counters: thread-safe named counters (e.g. abandoned requests)"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counts = Counter()
+
+    def inc(self, name: str, n: int = 1):
+        with self._lock:
+            self._counts[name] += n
+
+    def get(self, name: str) -> int:
+        with self._lock:
+            return self._counts[name]
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+
+class LatencyWindow:
+    """LatencyWindow: thread-safe window of the most recent latencies (seconds)"""
+
+    def __init__(self, maxlen: int = 1000):
+        self._lock = Lock()
+        self._samples = deque(maxlen=maxlen)
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._samples)
+
+    def mean(self) -> float:
+        """mean of the window, 0 if empty"""
+        with self._lock:
+            if not self._samples:
+                return 0.0
+            return sum(self._samples) / len(self._samples)
+
+    def percentile(self, p: float) -> float:
+        """p in [0, 100], nearest-rank percentile of the window, 0 if empty"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return 0.0
+        k = min(len(samples) - 1, max(0, math.ceil(p / 100 * len(samples)) - 1))
+        return samples[k]
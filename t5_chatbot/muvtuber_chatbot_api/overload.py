@@ -0,0 +1,141 @@
+# OverloadController: 流量高峰时逐级降低生成预算，保住延迟。
+#
+# 看最近请求的 p99 延迟和 FairScheduler 的排队深度：
+#  - 超过目标就升一级（更短的 max_length、只用贪心、只用检索回答……）；
+#  - 连续 patience 次检查都明显低于目标就降一级，回到正常。
+# 每次升降级都会打日志、计数，并通知 listeners。
+
+from dataclasses import dataclass
+import logging
+from threading import Lock, Timer
+from typing import Callable, Dict, List, Optional
+
+from .metrics import Counters, LatencyWindow
+
+
+@dataclass
+class DegradationLevel:
+    """A generation budget, passed to Chatbot.ask as kwargs (hints that
+    Chatbots may ignore):
+
+        max_length (int): max reply length (tokens)
+        greedy (bool): greedy decoding only, no beam search / sampling
+        retrieval_only (bool): answer only from cache / retrieval,
+            raise Overloaded instead of generating
+    """
+    name: str
+    max_length: Optional[int] = None  # None: the Chatbot's default
+    greedy: bool = False
+    retrieval_only: bool = False
+
+    def ask_kwargs(self) -> Dict:
+        kwargs = {}
+        if self.max_length is not None:
+            kwargs['max_length'] = self.max_length
+        if self.greedy:
+            kwargs['greedy'] = True
+        if self.retrieval_only:
+            kwargs['retrieval_only'] = True
+        return kwargs
+
+
+DEFAULT_LEVELS = [
+    DegradationLevel('normal'),
+    DegradationLevel('short', max_length=20),
+    DegradationLevel('shorter-greedy', max_length=12, greedy=True),
+    DegradationLevel('retrieval-only', max_length=12,
+                     greedy=True, retrieval_only=True),
+]
+
+
+class OverloadController:
+    """Step generation budgets down under load to keep p99 under target_p99."""
+
+    min_samples = 5  # 少于这么多样本的 p99 不作数
+
+    def __init__(self, scheduler, target_p99=2.0, max_queue_depth=8, check_interval=1.0,
+                 recover_ratio=0.5, patience=3, levels: List[DegradationLevel] = None):
+        """
+        Args:
+            scheduler: FairScheduler, for its queue_depth()
+            target_p99: seconds, end-to-end latency target
+            max_queue_depth: queued requests considered overloaded
+            check_interval: seconds between checks
+            recover_ratio: step down when p99 < target_p99 * recover_ratio
+                (and the queue is at most half of max_queue_depth)
+            patience: consecutive calm checks needed to step down
+        """
+        self.scheduler = scheduler
+        self.target_p99 = target_p99
+        self.max_queue_depth = max_queue_depth
+        self.check_interval = check_interval
+        self.recover_ratio = recover_ratio
+        self.patience = patience
+        self.levels = levels or DEFAULT_LEVELS
+
+        self.latencies = LatencyWindow(maxlen=500)
+        self.level = 0
+        self._calm_checks = 0
+        self._lock = Lock()
+
+        # level changes: {"normal->short": n, ...}
+        self.changes = Counters()
+        # listeners(old: DegradationLevel, new: DegradationLevel, reason: str)
+        self.listeners: List[Callable] = []
+
+    def current(self) -> DegradationLevel:
+        return self.levels[self.level]
+
+    def observe(self, seconds: float):
+        """Record the end-to-end latency of a request"""
+        self.latencies.add(seconds)
+
+    def start(self):
+        """check() every check_interval seconds"""
+        self._schedule_check()
+
+    def _schedule_check(self):
+        # daemon: 不挡着进程退出
+        timer = Timer(self.check_interval, self._check_loop)
+        timer.daemon = True
+        timer.start()
+
+    def _check_loop(self):
+        try:
+            self.check()
+        finally:
+            self._schedule_check()
+
+    def check(self):
+        depth = self.scheduler.queue_depth()
+        enough = len(self.latencies) >= self.min_samples
+        p99 = self.latencies.percentile(99) if enough else 0.0
+        reason = f'p99={p99:.3f}s (target {self.target_p99}s), queue_depth={depth}'
+
+        with self._lock:
+            if (enough and p99 > self.target_p99) or depth > self.max_queue_depth:
+                self._calm_checks = 0
+                if self.level < len(self.levels) - 1:
+                    self._set_level(self.level + 1, reason)
+            elif not enough and depth <= self.max_queue_depth // 2:
+                # 样本不够（比如刚换了级别）：看不出延迟降没降，不算一次平静，计数也不清零
+                pass
+            elif enough and p99 < self.target_p99 * self.recover_ratio and depth <= self.max_queue_depth // 2:
+                self._calm_checks += 1
+                if self._calm_checks >= self.patience and self.level > 0:
+                    self._calm_checks = 0
+                    self._set_level(self.level - 1, reason)
+            else:
+                self._calm_checks = 0
+
+    def _set_level(self, level: int, reason: str):
+        old, new = self.levels[self.level], self.levels[level]
+        self.level = level
+        # 新级别下的延迟重新统计
+        self.latencies = LatencyWindow(maxlen=500)
+
+        self.changes.inc(f'{old.name}->{new.name}')
+        logging.warning(
+            f'OverloadController: level {old.name} -> {new.name}: {reason}')
+        for listener in self.listeners:
+            listener(old, new, reason)
@@ -13,7 +13,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n!muvtuber/chatbot/v2/chatbot.proto\x12\x13muvtuber.chatbot.v2\"R\n\x11NewSessionRequest\x12\x16\n\x06\x63onfig\x18\x01 \x01(\tR\x06\x63onfig\x12%\n\x0einitial_prompt\x18\x02 \x01(\tR\rinitialPrompt\"^\n\x12NewSessionResponse\x12\x1d\n\nsession_id\x18\x01 \x01(\tR\tsessionId\x12)\n\x10initial_response\x18\x02 \x01(\tR\x0finitialResponse\"5\n\x14\x44\x65leteSessionRequest\x12\x1d\n\nsession_id\x18\x01 \x01(\tR\tsessionId\"6\n\x15\x44\x65leteSessionResponse\x12\x1d\n\nsession_id\x18\x01 \x01(\tR\tsessionId\"D\n\x0b\x43hatRequest\x12\x1d\n\nsession_id\x18\x01 \x01(\tR\tsessionId\x12\x16\n\x06prompt\x18\x02 \x01(\tR\x06prompt\"*\n\x0c\x43hatResponse\x12\x1a\n\x08response\x18\x02 \x01(\tR\x08response2\xa4\x02\n\x0e\x43hatbotService\x12]\n\nNewSession\x12&.muvtuber.chatbot.v2.NewSessionRequest\x1a\'.muvtuber.chatbot.v2.NewSessionResponse\x12K\n\x04\x43hat\x12 .muvtuber.chatbot.v2.ChatRequest\x1a!.muvtuber.chatbot.v2.ChatResponse\x12\x66\n\rDeleteSession\x12).muvtuber.chatbot.v2.DeleteSessionRequest\x1a*.muvtuber.chatbot.v2.DeleteSessionResponseB\xc7\x01\n\x17\x63om.muvtuber.chatbot.v2B\x0c\x43hatbotProtoP\x01Z0muvtuberdriver/gen/muvtuber/chatbot/v2;chatbotv2\xa2\x02\x03MCX\xaa\x02\x13Muvtuber.Chatbot.V2\xca\x02\x13Muvtuber\\Chatbot\\V2\xe2\x02\x1fMuvtuber\\Chatbot\\V2\\GPBMetadata\xea\x02\x15Muvtuber::Chatbot::V2b\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n!muvtuber/chatbot/v2/chatbot.proto\x12\x13muvtuber.chatbot.v2\"R\n\x11NewSessionRequest\x12\x16\n\x06\x63onfig\x18\x01 \x01(\tR\x06\x63onfig\x12%\n\x0einitial_prompt\x18\x02 \x01(\tR\rinitialPrompt\"^\n\x12NewSessionResponse\x12\x1d\n\nsession_id\x18\x01 \x01(\tR\tsessionId\x12)\n\x10initial_response\x18\x02 \x01(\tR\x0finitialResponse\"5\n\x14\x44\x65leteSessionRequest\x12\x1d\n\nsession_id\x18\x01 \x01(\tR\tsessionId\"6\n\x15\x44\x65leteSessionResponse\x12\x1d\n\nsession_id\x18\x01 \x01(\tR\tsessionId\"D\n\x0b\x43hatRequest\x12\x1d\n\nsession_id\x18\x01 \x01(\tR\tsessionId\x12\x16\n\x06prompt\x18\x02 \x01(\tR\x06prompt\"*\n\x0c\x43hatResponse\x12\x1a\n\x08response\x18\x02 \x01(\tR\x08response\"J\n\x10\x42\x61tchChatRequest\x12\x36\n\x05items\x18\x01 \x03(\x0b\x32 .muvtuber.chatbot.v2.ChatRequestR\x05items\"z\n\x0f\x42\x61tchChatResult\x12\x1d\n\nsession_id\x18\x01 \x01(\tR\tsessionId\x12\x1a\n\x08response\x18\x02 \x01(\tR\x08response\x12\x12\n\x04\x63ode\x18\x03 \x01(\x05R\x04\x63ode\x12\x18\n\x07\x64\x65tails\x18\x04 \x01(\tR\x07\x64\x65tails\"S\n\x11\x42\x61tchChatResponse\x12>\n\x07results\x18\x01 \x03(\x0b\x32$.muvtuber.chatbot.v2.BatchChatResultR\x07results\"\x13\n\x11LoadReportRequest\"\x99\x02\n\x12LoadReportResponse\x12\'\n\x0f\x61\x63tive_sessions\x18\x01 \x01(\x05R\x0e\x61\x63tiveSessions\x12!\n\x0cmax_sessions\x18\x02 \x01(\x05R\x0bmaxSessions\x12#\n\rfree_sessions\x18\x03 \x01(\x05R\x0c\x66reeSessions\x12\x1f\n\x0bqueue_depth\x18\x04 \x01(\x05R\nqueueDepth\x12\x1a\n\x08inflight\x18\x05 \x01(\x05R\x08inflight\x12.\n\x13p95_latency_seconds\x18\x06 \x01(\x01R\x11p95LatencySeconds\x12%\n\x0eoverload_level\x18\x07 \x01(\tR\roverloadLevel2\xdf\x03\n\x0e\x43hatbotService\x12]\n\nNewSession\x12&.muvtuber.chatbot.v2.NewSessionRequest\x1a\'.muvtuber.chatbot.v2.NewSessionResponse\x12K\n\x04\x43hat\x12 .muvtuber.chatbot.v2.ChatRequest\x1a!.muvtuber.chatbot.v2.ChatResponse\x12\x66\n\rDeleteSession\x12).muvtuber.chatbot.v2.DeleteSessionRequest\x1a*.muvtuber.chatbot.v2.DeleteSessionResponse\x12Z\n\tBatchChat\x12%.muvtuber.chatbot.v2.BatchChatRequest\x1a&.muvtuber.chatbot.v2.BatchChatResponse\x12]\n\nLoadReport\x12&.muvtuber.chatbot.v2.LoadReportRequest\x1a\'.muvtuber.chatbot.v2.LoadReportResponseB\xc7\x01\n\x17\x63om.muvtuber.chatbot.v2B\x0c\x43hatbotProtoP\x01Z0muvtuberdriver/gen/muvtuber/chatbot/v2;chatbotv2\xa2\x02\x03MCX\xaa\x02\x13Muvtuber.Chatbot.V2\xca\x02\x13Muvtuber\\Chatbot\\V2\xe2\x02\x1fMuvtuber\\Chatbot\\V2\\GPBMetadata\xea\x02\x15Muvtuber::Chatbot::V2b\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -34,6 +34,16 @@ if _descriptor._USE_C_DESCRIPTORS == False:
   _globals['_CHATREQUEST']._serialized_end=417
   _globals['_CHATRESPONSE']._serialized_start=419
   _globals['_CHATRESPONSE']._serialized_end=461
-  _globals['_CHATBOTSERVICE']._serialized_start=464
-  _globals['_CHATBOTSERVICE']._serialized_end=756
+  _globals['_BATCHCHATREQUEST']._serialized_start=463
+  _globals['_BATCHCHATREQUEST']._serialized_end=537
+  _globals['_BATCHCHATRESULT']._serialized_start=539
+  _globals['_BATCHCHATRESULT']._serialized_end=661
+  _globals['_BATCHCHATRESPONSE']._serialized_start=663
+  _globals['_BATCHCHATRESPONSE']._serialized_end=746
+  _globals['_LOADREPORTREQUEST']._serialized_start=748
+  _globals['_LOADREPORTREQUEST']._serialized_end=767
+  _globals['_LOADREPORTRESPONSE']._serialized_start=770
+  _globals['_LOADREPORTRESPONSE']._serialized_end=1051
+  _globals['_CHATBOTSERVICE']._serialized_start=1054
+  _globals['_CHATBOTSERVICE']._serialized_end=1533
 # @@protoc_insertion_point(module_scope)
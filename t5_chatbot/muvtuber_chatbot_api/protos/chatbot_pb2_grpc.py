@@ -29,6 +29,16 @@ class ChatbotServiceStub(object):
                 request_serializer=muvtuber_dot_chatbot_dot_v2_dot_chatbot__pb2.DeleteSessionRequest.SerializeToString,
                 response_deserializer=muvtuber_dot_chatbot_dot_v2_dot_chatbot__pb2.DeleteSessionResponse.FromString,
                 )
+        self.BatchChat = channel.unary_unary(
+                '/muvtuber.chatbot.v2.ChatbotService/BatchChat',
+                request_serializer=muvtuber_dot_chatbot_dot_v2_dot_chatbot__pb2.BatchChatRequest.SerializeToString,
+                response_deserializer=muvtuber_dot_chatbot_dot_v2_dot_chatbot__pb2.BatchChatResponse.FromString,
+                )
+        self.LoadReport = channel.unary_unary(
+                '/muvtuber.chatbot.v2.ChatbotService/LoadReport',
+                request_serializer=muvtuber_dot_chatbot_dot_v2_dot_chatbot__pb2.LoadReportRequest.SerializeToString,
+                response_deserializer=muvtuber_dot_chatbot_dot_v2_dot_chatbot__pb2.LoadReportResponse.FromString,
+                )
 
 
 class ChatbotServiceServicer(object):
@@ -61,6 +71,26 @@ class ChatbotServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def BatchChat(self, request, context):
+        """BatchChat sends many (session_id, prompt) pairs in one call.
+        Input: items (repeated ChatRequest).
+        Output: results (repeated BatchChatResult), one per item, in order,
+        each with its own status code.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def LoadReport(self, request, context):
+        """LoadReport reports the load of this server (replica),
+        for client-side load balancing across replicas.
+        Input: none.
+        Output: sessions, queue depth, recent p95 latency and free capacity.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_ChatbotServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -79,6 +109,16 @@ def add_ChatbotServiceServicer_to_server(servicer, server):
                     request_deserializer=muvtuber_dot_chatbot_dot_v2_dot_chatbot__pb2.DeleteSessionRequest.FromString,
                     response_serializer=muvtuber_dot_chatbot_dot_v2_dot_chatbot__pb2.DeleteSessionResponse.SerializeToString,
             ),
+            'BatchChat': grpc.unary_unary_rpc_method_handler(
+                    servicer.BatchChat,
+                    request_deserializer=muvtuber_dot_chatbot_dot_v2_dot_chatbot__pb2.BatchChatRequest.FromString,
+                    response_serializer=muvtuber_dot_chatbot_dot_v2_dot_chatbot__pb2.BatchChatResponse.SerializeToString,
+            ),
+            'LoadReport': grpc.unary_unary_rpc_method_handler(
+                    servicer.LoadReport,
+                    request_deserializer=muvtuber_dot_chatbot_dot_v2_dot_chatbot__pb2.LoadReportRequest.FromString,
+                    response_serializer=muvtuber_dot_chatbot_dot_v2_dot_chatbot__pb2.LoadReportResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'muvtuber.chatbot.v2.ChatbotService', rpc_method_handlers)
@@ -139,3 +179,37 @@ class ChatbotService(object):
             muvtuber_dot_chatbot_dot_v2_dot_chatbot__pb2.DeleteSessionResponse.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def BatchChat(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/muvtuber.chatbot.v2.ChatbotService/BatchChat',
+            muvtuber_dot_chatbot_dot_v2_dot_chatbot__pb2.BatchChatRequest.SerializeToString,
+            muvtuber_dot_chatbot_dot_v2_dot_chatbot__pb2.BatchChatResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def LoadReport(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/muvtuber.chatbot.v2.ChatbotService/LoadReport',
+            muvtuber_dot_chatbot_dot_v2_dot_chatbot__pb2.LoadReportRequest.SerializeToString,
+            muvtuber_dot_chatbot_dot_v2_dot_chatbot__pb2.LoadReportResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
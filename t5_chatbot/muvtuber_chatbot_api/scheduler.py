@@ -0,0 +1,285 @@
+# FairScheduler: 推理请求的调度器，挡在 MultiChatbot 前面。
+#
+# gRPC 的 worker 线程按到达顺序直接调模型的话，一个刷屏的直播间就能占满所有线程，
+# 别的会话全都得等。FairScheduler 做按会话的加权公平排队（WFQ）：
+#  - 同时最多 max_concurrency 个请求在推理；
+#  - 每个会话最多 max_inflight_per_session 个在推理，最多排 max_queue_per_session 个；
+#  - 空出来的推理位置给 (priority, 虚拟开始时间) 最小的会话队头
+#    (start-time fair queuing)，权重越大的会话虚拟时间走得越慢，分到的份额越多；
+#  - 排队时过了 deadline 或者客户端断开的请求直接丢掉。
+#
+# BatchChat 的一批请求用一张票（run_batch）：票同时排在每个涉及的会话的队列里，
+# 要在所有这些队列都排到队头、每个会话都没超 max_inflight_per_session 时才放行；
+# 放行后只占一个推理位置（一次批量 generate），但按每个会话各自的权重和条数推进虚拟时间，
+# 并算进每个会话的 inflight。
+#
+# report_interval 秒打一次 info 日志（stats() 的汇总：排队、推理、丢弃、等得最久的会话）。
+
+from collections import deque
+from dataclasses import dataclass, field
+import logging
+from threading import Condition, Timer
+import time
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from .chatbot import DeadlineExceeded, RequestCancelled
+from .metrics import Counters, LatencyWindow
+
+PRIORITY_HIGH = 0  # e.g. 主播发起的 prompt
+PRIORITY_NORMAL = 1
+
+
+@dataclass(eq=False)  # tickets are compared by identity
+class _Ticket:
+    session_ids: Tuple[str, ...]  # distinct sessions, one for run()
+    priority: int
+    tag: float  # virtual start time
+    deadline: Optional[float]
+    enqueue_at: float = field(default_factory=time.time)
+    granted: bool = False
+    dropped: bool = False
+
+
+class _SessionStats:
+    def __init__(self):
+        self.served = 0
+        self.waits = LatencyWindow(maxlen=200)
+
+
+class FairScheduler:
+    """Per-session weighted fair queuing in front of inference.
+
+    Callers (gRPC worker threads) call run(); it blocks until the request
+    is granted a slot and then runs the work on the calling thread.
+    """
+
+    # 排队时多久检查一次 is_active()
+    poll_interval = 0.1
+
+    def __init__(self, max_concurrency=2, max_inflight_per_session=1, max_queue_per_session=4,
+                 report_interval: Optional[float] = None):
+        self.max_concurrency = max_concurrency
+        self.max_inflight_per_session = max_inflight_per_session
+        self.max_queue_per_session = max_queue_per_session
+
+        self._cond = Condition()
+        self._queues: Dict[str, Deque[_Ticket]] = {}
+        self._inflight: Dict[str, int] = {}
+        self._finish: Dict[str, float] = {}  # last virtual finish time per session
+        self._vtime = 0.0
+        self._running = 0
+        self._stats: Dict[str, _SessionStats] = {}
+
+        # dropped requests: {"expired": n, "cancelled": n, "rejected": n}
+        self.dropped = Counters()
+
+        self.report_interval = report_interval
+        if report_interval:
+            self._served_reported = 0
+            self._schedule_report()
+
+    def run(self, session_id: str, work: Callable, weight: float = 1.0, priority: int = PRIORITY_NORMAL,
+            deadline: Optional[float] = None, is_active: Optional[Callable[[], bool]] = None):
+        """Wait for a slot, then return work().
+
+        Raises:
+            TooManyRequests: the session's queue is full
+            DeadlineExceeded: deadline passed while queued
+            RequestCancelled: is_active() turned False while queued
+        """
+        return self._run({session_id: 1.0 / max(weight, 1e-6)}, work,
+                         priority, deadline, is_active)
+
+    def run_batch(self, session_ids: List[str], work: Callable, weights: Dict[str, float] = None,
+                  priority: int = PRIORITY_NORMAL, deadline: Optional[float] = None,
+                  is_active: Optional[Callable[[], bool]] = None):
+        """Wait until every session of a batch may run, then return work().
+
+        session_ids has one entry per item of the batch (repeats allowed):
+        each session is charged (its items) / (its weight in weights, default 1)
+        and holds one of its max_inflight_per_session while work() runs.
+
+        Raises:
+            TooManyRequests: the queue of one of the sessions is full
+            DeadlineExceeded: deadline passed while queued
+            RequestCancelled: is_active() turned False while queued
+        """
+        if not session_ids:
+            return work()
+        weights = weights or {}
+        costs: Dict[str, float] = {}
+        for session_id in session_ids:
+            costs[session_id] = costs.get(session_id, 0.0) + \
+                1.0 / max(weights.get(session_id, 1.0), 1e-6)
+        return self._run(costs, work, priority, deadline, is_active)
+
+    def _run(self, costs, work, priority, deadline, is_active):
+        ticket = self._enqueue(costs, priority, deadline)
+        try:
+            self._wait(ticket, is_active)
+            return work()
+        finally:
+            if ticket.granted:
+                self._release(ticket)
+
+    def _enqueue(self, costs: Dict[str, float], priority, deadline) -> _Ticket:
+        """costs: {session_id: virtual time charged to the session}"""
+        with self._cond:
+            for session_id in costs:
+                if len(self._queues.get(session_id, ())) >= self.max_queue_per_session:
+                    self.dropped.inc("rejected")
+                    raise TooManyRequests(session_id, self.max_queue_per_session)
+
+            tag = max([self._vtime] + [self._finish.get(s, 0.0) for s in costs])
+            for session_id, cost in costs.items():
+                self._finish[session_id] = tag + cost
+            ticket = _Ticket(tuple(costs), priority, tag, deadline)
+            for session_id in costs:
+                self._queues.setdefault(session_id, deque()).append(ticket)
+            self._dispatch()
+            return ticket
+
+    def _wait(self, ticket: _Ticket, is_active):
+        with self._cond:
+            while not ticket.granted:
+                if ticket.dropped or (ticket.deadline is not None and time.time() >= ticket.deadline):
+                    self._drop(ticket)
+                    self.dropped.inc("expired")
+                    raise DeadlineExceeded(ticket.deadline)
+                if is_active is not None and not is_active():
+                    self._drop(ticket)
+                    self.dropped.inc("cancelled")
+                    raise RequestCancelled()
+
+                timeout = self.poll_interval
+                if ticket.deadline is not None:
+                    timeout = min(timeout, max(0.0, ticket.deadline - time.time()))
+                self._cond.wait(timeout)
+
+            waited = time.time() - ticket.enqueue_at
+            for session_id in ticket.session_ids:
+                stats = self._stats.setdefault(session_id, _SessionStats())
+                stats.waits.add(waited)
+                stats.served += 1
+        logging.debug(
+            f'FairScheduler: session {",".join(ticket.session_ids)} waited {waited:.3f}s')
+
+    def _remove(self, ticket: _Ticket):
+        """take the ticket out of all its queues"""
+        for session_id in ticket.session_ids:
+            queue = self._queues.get(session_id)
+            if queue is not None and ticket in queue:
+                queue.remove(ticket)
+
+    def _drop(self, ticket: _Ticket):
+        self._remove(ticket)
+        self._dispatch()
+
+    def _release(self, ticket: _Ticket):
+        with self._cond:
+            self._running -= 1
+            for session_id in ticket.session_ids:
+                self._inflight[session_id] -= 1
+            self._dispatch()
+
+    def _ready(self, ticket: _Ticket) -> bool:
+        """at the head of all its queues, and no session at its inflight limit"""
+        return all(self._queues[s][0] is ticket and
+                   self._inflight.get(s, 0) < self.max_inflight_per_session
+                   for s in ticket.session_ids)
+
+    def _dispatch(self):
+        """Grant free slots to the queue heads with the smallest (priority, tag).
+        Must hold self._cond.
+        """
+        granted = False
+        while self._running < self.max_concurrency:
+            best: Optional[_Ticket] = None
+            now = time.time()
+            for session_id, queue in self._queues.items():
+                # 队头已经过期的直接丢掉，等待的线程醒来后会抛 DeadlineExceeded
+                while queue and queue[0].deadline is not None and now >= queue[0].deadline:
+                    head = queue[0]
+                    self._remove(head)
+                    head.dropped = True
+                    granted = True
+                if not queue or not self._ready(queue[0]):
+                    continue
+                head = queue[0]
+                if best is None or (head.priority, head.tag) < (best.priority, best.tag):
+                    best = head
+            if best is None:
+                break
+
+            self._remove(best)
+            best.granted = True
+            granted = True
+            self._running += 1
+            for session_id in best.session_ids:
+                self._inflight[session_id] = self._inflight.get(session_id, 0) + 1
+            self._vtime = max(self._vtime, best.tag)
+        if granted:
+            self._cond.notify_all()
+
+    def forget(self, session_id: str):
+        """Drop the bookkeeping of a deleted session (its queued requests are left to expire)."""
+        with self._cond:
+            if not self._queues.get(session_id) and not self._inflight.get(session_id):
+                self._queues.pop(session_id, None)
+                self._inflight.pop(session_id, None)
+                self._finish.pop(session_id, None)
+                self._stats.pop(session_id, None)
+
+    def queue_depth(self) -> int:
+        """number of requests waiting in all the queues"""
+        with self._cond:
+            return sum(len(q) for q in self._queues.values())
+
+    def inflight(self) -> int:
+        """number of requests running inference"""
+        with self._cond:
+            return self._running
+
+    def stats(self) -> Dict[str, Dict]:
+        """{session_id: {queued, inflight, served, mean_wait, p95_wait}}"""
+        with self._cond:
+            session_ids = set(self._queues) | set(self._stats)
+            result = {}
+            for session_id in session_ids:
+                stats = self._stats.get(session_id, _SessionStats())
+                result[session_id] = {
+                    'queued': len(self._queues.get(session_id, ())),
+                    'inflight': self._inflight.get(session_id, 0),
+                    'served': stats.served,
+                    'mean_wait': stats.waits.mean(),
+                    'p95_wait': stats.waits.percentile(95),
+                }
+            return result
+
+    def _report_loop(self):
+        try:
+            stats = self.stats()
+            served = sum(s['served'] for s in stats.values())
+            if served != self._served_reported:  # 闲着的时候不刷日志
+                self._served_reported = served
+                slowest = sorted(stats.items(), key=lambda kv: kv[1]['p95_wait'], reverse=True)[:3]
+                slowest = ', '.join(f'{session_id} {s["p95_wait"]:.3f}s' for session_id, s in slowest)
+                logging.info(f'FairScheduler: {len(stats)} sessions, '
+                             f'queued {sum(s["queued"] for s in stats.values())}, '
+                             f'inflight {self.inflight()}, served {served}, '
+                             f'dropped {self.dropped.snapshot()}, p95 wait: {slowest}')
+        finally:
+            self._schedule_report()
+
+    def _schedule_report(self):
+        timer = Timer(self.report_interval, self._report_loop)
+        timer.daemon = True
+        timer.start()
+
+
+class TooManyRequests(Exception):
+    def __init__(self, session_id: str, max_queue: int):
+        self.session_id = session_id
+        self.max_queue = max_queue
+        self.message = f"Too many queued requests for session {session_id}, max {max_queue}"
+        super().__init__(self.message)
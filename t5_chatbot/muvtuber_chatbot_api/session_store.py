@@ -0,0 +1,134 @@
+# SessionStore: MultiChatbot 的会话落盘。
+#
+# 闲置的会话（以及重启前的所有会话）只以一个很小的 SessionState 存在盘上，
+# 不占 Chatbot 的内存；下次 Chat 时再按 config 重新创建 Chatbot（懒恢复）。
+#
+# directory/
+#   <session_id>.json   SessionState，mtime = touch_at（过期清理只看 mtime，不用读文件）
+#
+# 写盘都是先写临时文件再 os.replace，写到一半被杀掉也不会留下坏文件。
+
+from dataclasses import asdict, dataclass, field
+import json
+import logging
+import os
+import time
+from typing import Dict, Iterable, List, Optional
+import uuid
+
+from .metrics import Counters
+
+
+@dataclass
+class SessionState:
+    """The serializable part of a session (ChatbotProxy): enough to re-create it"""
+    session_id: str
+    config: Dict  # dataclasses.asdict(ChatbotConfig)
+    create_at: float = 0.0
+    touch_at: float = 0.0
+    initial_response: str = ""
+    history: List[List[str]] = field(default_factory=list)  # [[prompt, response], ...]
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self), ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, json_str: str) -> 'SessionState':
+        return cls(**json.loads(json_str))
+
+
+class SessionStore:
+    """One small JSON file per session in a local directory"""
+
+    def __init__(self, directory: str, ttl: float = 60*60*24):
+        """
+        Args:
+            directory: where the session files go, created if missing
+            ttl: seconds since the last touch after which a stored session is deleted
+        """
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+        # {"saved": n, "loaded": n, "deleted": n, "expired": n}
+        self.counters = Counters()
+
+    def _path(self, session_id: str) -> Optional[str]:
+        # session_id 来自客户端，只接受 uuid，免得拼出别的路径
+        try:
+            if str(uuid.UUID(session_id)) != session_id:
+                return None
+        except (ValueError, TypeError, AttributeError):
+            return None
+        return os.path.join(self.directory, session_id + '.json')
+
+    def save(self, state: SessionState):
+        path = self._path(state.session_id)
+        if path is None:
+            raise ValueError(f'bad session_id: {state.session_id!r}')
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(state.to_json())
+        os.utime(tmp, (state.touch_at, state.touch_at))
+        os.replace(tmp, path)
+        self.counters.inc("saved")
+
+    def load(self, session_id: str) -> Optional[SessionState]:
+        """The stored state, None if there is none"""
+        path = self._path(session_id)
+        if path is None:
+            return None
+        try:
+            with open(path, encoding='utf-8') as f:
+                state = SessionState.from_json(f.read())
+        except FileNotFoundError:
+            return None
+        self.counters.inc("loaded")
+        return state
+
+    def contains(self, session_id: str) -> bool:
+        path = self._path(session_id)
+        return path is not None and os.path.exists(path)
+
+    def delete(self, session_id: str) -> bool:
+        """Delete a stored session, False if there was none"""
+        path = self._path(session_id)
+        if path is None:
+            return False
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        self.counters.inc("deleted")
+        return True
+
+    def session_ids(self) -> List[str]:
+        return [name[:-len('.json')] for name in os.listdir(self.directory)
+                if name.endswith('.json')]
+
+    def count(self) -> int:
+        return len(self.session_ids())
+
+    def expire(self, keep: Iterable[str] = ()) -> List[str]:
+        """Delete the sessions not touched for ttl seconds, return their ids
+
+        keep: session ids never expired here (e.g. the ones live in memory,
+        whose files are not updated on every touch)
+        """
+        expired = []
+        now = time.time()
+        keep = set(keep)
+        for session_id in self.session_ids():
+            if session_id in keep:
+                continue
+            path = os.path.join(self.directory, session_id + '.json')
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+                    expired.append(session_id)
+            except FileNotFoundError:
+                continue
+        if expired:
+            self.counters.inc("expired", len(expired))
+            logging.info(f'SessionStore.expire: deleted {len(expired)} stored sessions')
+        return expired
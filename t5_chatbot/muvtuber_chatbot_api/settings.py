@@ -0,0 +1,14 @@
+import json
+from typing import Dict
+
+
+def load_settings(path: str, section: str) -> Dict:
+    """load_settings: the section object of a JSON settings file (e.g. written by autotune).
+
+        {"serve_grpc": {"max_workers": 16, ...}, "t5": {...}}
+
+    Returns {} if there is no such section.
+    """
+    with open(path, encoding='utf-8') as f:
+        settings = json.load(f)
+    return settings.get(section) or {}
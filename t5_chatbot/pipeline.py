@@ -0,0 +1,240 @@
+"""
+Pipelined request processing: pre-process -> batched model execution -> post-process
+
+一个请求原本在一个线程里依次做 jieba 分词、model.generate、decode 拼字符串，
+做分词的时候 torch 的算子闲着。这里拆成三段，各自有 worker 线程，中间用有界队列连起来：
+
+    submit() -> [pre workers] -> queue -> [model worker] -> queue -> [post workers] -> wait()
+
+  - model worker 只做模型计算：把队列里现成的、batch_key 相同的请求合成一批执行，
+    分词和 decode 这种 Python 字符串活都在别的线程里做（torch 算子执行时会释放 GIL）；
+  - 队列有界，下游忙不过来时 submit() 会阻塞（背压），不会无限堆积；
+  - 排队时已经过了 deadline / 客户端断开的请求，model worker 直接丢掉不算；
+  - stats() 给出每段的利用率（忙碌时间 / (worker 数 * 运行时间)）、处理数和队列长度，
+    report_interval 秒打一次 info 日志。
+"""
+
+from collections import deque
+import logging
+from queue import Empty, Queue
+from threading import Event, Lock, Thread, Timer
+import time
+from typing import Any, Callable, Dict, List, Optional
+import muvtuber_chatbot_api
+from muvtuber_chatbot_api.metrics import Counters, LatencyWindow
+
+
+class PipelineJob:
+    """A request going through the Pipeline"""
+
+    def __init__(self, request, deadline: Optional[float] = None, is_active: Optional[Callable[[], bool]] = None):
+        self.request = request
+        self.deadline = deadline
+        self.is_active = is_active
+
+        self.data = None  # preprocess(request)
+        self.output = None  # execute(...) for this job
+
+        self._result = None
+        self._error: Optional[BaseException] = None
+        self._done = Event()
+
+    def finish(self, result):
+        self._result = result
+        self._done.set()
+
+    def fail(self, error: BaseException):
+        self._error = error
+        self._done.set()
+
+    def wait(self):
+        """Block until done: return the result or raise the error of any stage"""
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class _StageStats:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._lock = Lock()
+        self._started_at = time.perf_counter()
+        self._busy = 0.0
+        self._items = 0
+
+    def add(self, seconds: float, items: int = 1):
+        with self._lock:
+            self._busy += seconds
+            self._items += items
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            elapsed = time.perf_counter() - self._started_at
+            return {'workers': self.workers,
+                    'items': self._items,
+                    'busy_seconds': self._busy,
+                    'utilization': self._busy / (self.workers * elapsed) if elapsed else 0.0}
+
+
+class Pipeline:
+    """Three stages with their own worker threads, connected by bounded queues.
+
+    Args:
+        preprocess: request -> data (e.g. tokenize)
+        execute: [PipelineJob] -> [output], one output per job (e.g. generate);
+            jobs in a call have the same batch_key(request)
+        postprocess: (request, output) -> result (e.g. detokenize)
+        batch_key: request -> hashable, only requests with equal keys are batched
+        size: data -> number of rows it adds to a batch
+        max_batch: max rows per execute call
+    """
+
+    def __init__(self, preprocess: Callable, execute: Callable, postprocess: Callable,
+                 batch_key: Callable = lambda request: None, size: Callable = lambda data: 1,
+                 pre_workers=1, post_workers=1, queue_size=16, max_batch=32,
+                 name='pipeline', report_interval: Optional[float] = 60.0):
+        self.preprocess = preprocess
+        self.execute = execute
+        self.postprocess = postprocess
+        self.batch_key = batch_key
+        self.size = size
+        self.max_batch = max_batch
+        self.name = name
+        self.report_interval = report_interval
+
+        self._pre_queue: Queue = Queue(maxsize=queue_size)
+        self._model_queue: Queue = Queue(maxsize=queue_size)
+        self._post_queue: Queue = Queue(maxsize=queue_size)
+
+        self._stats = {'pre': _StageStats(pre_workers),
+                       'model': _StageStats(1),
+                       'post': _StageStats(post_workers)}
+        self.batch_sizes = LatencyWindow(maxlen=500)
+        self.dropped = Counters()
+
+        for i in range(pre_workers):
+            Thread(target=self._pre_loop, name=f'{name}-pre-{i}', daemon=True).start()
+        Thread(target=self._model_loop, name=f'{name}-model', daemon=True).start()
+        for i in range(post_workers):
+            Thread(target=self._post_loop, name=f'{name}-post-{i}', daemon=True).start()
+
+        if report_interval:
+            self._items_reported = 0
+            self._schedule_report()
+
+    def submit(self, request, deadline=None, is_active=None) -> PipelineJob:
+        """Enqueue a request, blocks while the pre-process queue is full"""
+        job = PipelineJob(request, deadline, is_active)
+        self._pre_queue.put(job)
+        return job
+
+    def run(self, request, deadline=None, is_active=None) -> Any:
+        """submit and wait"""
+        return self.submit(request, deadline, is_active).wait()
+
+    def _pre_loop(self):
+        while True:
+            job = self._pre_queue.get()
+            start = time.perf_counter()
+            try:
+                job.data = self.preprocess(job.request)
+            except Exception as e:
+                job.fail(e)
+                continue
+            finally:
+                self._stats['pre'].add(time.perf_counter() - start)
+            self._model_queue.put(job)
+
+    def _next_batch(self, held: deque) -> List[PipelineJob]:
+        """Block for a job, then add the compatible jobs already queued"""
+        first = held.popleft() if held else self._model_queue.get()
+        key = self.batch_key(first.request)
+        batch, size = [first], self.size(first.data)
+        while size < self.max_batch:
+            if held:
+                job = held.popleft()
+            else:
+                try:
+                    job = self._model_queue.get_nowait()
+                except Empty:
+                    break
+            if self.batch_key(job.request) != key or size + self.size(job.data) > self.max_batch:
+                held.appendleft(job)  # 下一批再做
+                break
+            batch.append(job)
+            size += self.size(job.data)
+        return batch
+
+    def _model_loop(self):
+        held = deque()
+        while True:
+            batch = []
+            for job in self._next_batch(held):
+                try:
+                    muvtuber_chatbot_api.check_cancelled(job.deadline, job.is_active)
+                except muvtuber_chatbot_api.ChatbotError as e:
+                    self.dropped.inc(type(e).__name__)
+                    job.fail(e)
+                    continue
+                batch.append(job)
+            if not batch:
+                continue
+
+            start = time.perf_counter()
+            try:
+                outputs = self.execute(batch)
+            except Exception as e:
+                for job in batch:
+                    job.fail(e)
+                continue
+            finally:
+                self._stats['model'].add(time.perf_counter() - start, len(batch))
+            self.batch_sizes.add(sum(self.size(job.data) for job in batch))
+
+            for job, output in zip(batch, outputs):
+                job.output = output
+                self._post_queue.put(job)
+
+    def _post_loop(self):
+        while True:
+            job = self._post_queue.get()
+            start = time.perf_counter()
+            try:
+                result = self.postprocess(job.request, job.output)
+            except Exception as e:
+                job.fail(e)
+                continue
+            finally:
+                self._stats['post'].add(time.perf_counter() - start)
+            job.finish(result)
+
+    def stats(self) -> Dict:
+        """{stage: {workers, items, busy_seconds, utilization}, queues, mean_batch_size, dropped}"""
+        return {
+            'stages': {stage: s.snapshot() for stage, s in self._stats.items()},
+            'queues': {'pre': self._pre_queue.qsize(),
+                       'model': self._model_queue.qsize(),
+                       'post': self._post_queue.qsize()},
+            'mean_batch_size': self.batch_sizes.mean(),
+            'dropped': self.dropped.snapshot(),
+        }
+
+    def _report_loop(self):
+        try:
+            stats = self.stats()
+            items = stats['stages']['model']['items']
+            if items != self._items_reported:  # 闲着的时候不刷日志
+                self._items_reported = items
+                utilization = ', '.join(f'{stage} {s["utilization"]:.0%}'
+                                        for stage, s in stats['stages'].items())
+                logging.info(f'Pipeline {self.name}: utilization {utilization}, '
+                             f'queues {stats["queues"]}, '
+                             f'mean batch {stats["mean_batch_size"]:.1f}')
+        finally:
+            self._schedule_report()
+
+    def _schedule_report(self):
+        timer = Timer(self.report_interval, self._report_loop)
+        timer.daemon = True
+        timer.start()
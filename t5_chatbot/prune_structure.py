@@ -0,0 +1,362 @@
+"""
+Structured pruning (attention heads, FFN units) for T5 Pegasus chatbot models
+
+闲聊的回复很短，微调后的 T5 Pegasus 有不少 attention head 和 FFN 神经元几乎没用，
+但 T5Chatbot.ask 的每个 decode step 都要把它们全算一遍。这个工具：
+
+  1. 在 LUGE valid 的一部分上给每个 head、每个 FFN 神经元打分（一阶泰勒近似：
+     去掉它 loss 会变多少。head 用 head mask 的梯度 |dL/dm|，
+     FFN 神经元用 |激活 * 梯度|）；
+  2. 把分最低的（--head-ratio 比例的 head，每层 --ffn-ratio 比例的 FFN 神经元）
+     从 q/k/v/o 和 wi/wo 的权重里真正删掉，模型变小、变快；
+  3. 在 train 上短暂微调（--finetune-steps 步）恢复效果；
+  4. 保存成普通的 torch.save 模型，服务照常加载。
+
+    python prune_structure.py --model chat --output chat_pruned
+    # => ./model/chat_pruned.pt + ./model/chat_pruned_prune_report.json
+
+之后创建会话时用 {"model": "chat_pruned"}（tokenizer 不变）。
+报告里是剪枝前后的 head / FFN 数、参数量、文件大小、回复延迟、test 上的 ROUGE，
+以及 valid loss（原模型、剪完、微调后；用 valid 里没参与打分的另一部分算）。
+延迟和 ROUGE 都用贪心解码测，剪枝前后可比。
+
+head 按种类（encoder / decoder self-attention、cross-attention）剪：同一种的每一层
+剪掉同样的几个 head（分数取各层平均）。transformers 的 T5 里 position bias 只在第一层
+按这一层的 head 数算一次，给后面所有层共用，所以同一个 stack 里各层的 head 数必须一样，
+第一层的 relative_attention_bias 也要跟着删掉对应的列。
+每种 attention 至少留一个 head，每层至少留一个 FFN 神经元。
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from transformers.modeling_utils import prune_linear_layer
+from corpus import load_data_luge
+from evaluation import compute_rouges
+from model_manager import ModelManager
+from t5 import T5Chatbot, T5ChatbotConfig, load_model
+
+_this_dir = os.path.dirname(os.path.realpath(__file__))
+
+# head_mask 的三种 attention，和 MT5ForConditionalGeneration.forward 的参数对应
+ATTENTION_KINDS = {
+    'encoder': 'head_mask',
+    'decoder': 'decoder_head_mask',
+    'cross': 'cross_attn_head_mask',
+}
+
+
+def attentions(model):
+    """{"encoder" / "decoder" / "cross": [the attention module of each layer]}"""
+    return {
+        'encoder': [block.layer[0].SelfAttention for block in model.encoder.block],
+        'decoder': [block.layer[0].SelfAttention for block in model.decoder.block],
+        'cross': [block.layer[1].EncDecAttention for block in model.decoder.block],
+    }
+
+
+def feed_forwards(model):
+    """the DenseReluDense (FFN) module of each encoder, then decoder layer"""
+    return [block.layer[-1].DenseReluDense
+            for block in list(model.encoder.block) + list(model.decoder.block)]
+
+
+def encode_pairs(tokenizer, pairs, max_len=128):
+    """LUGE (answer, question) pairs => [(input_ids, decoder_input_ids)], like train.py"""
+    return [(tokenizer.encode(q, max_length=max_len, truncation='only_first'),
+             tokenizer.encode(a, max_length=max_len, truncation='only_first'))
+            for a, q in pairs]
+
+
+def batches(features, batch_size):
+    """padded tensor dicts for model(**batch)"""
+    for i in range(0, len(features), batch_size):
+        chunk = features[i:i + batch_size]
+        inputs = [torch.tensor(x) for x, _ in chunk]
+        decoder_inputs = [torch.tensor(y) for _, y in chunk]
+        yield {
+            'input_ids': pad_sequence(inputs, batch_first=True),
+            'attention_mask': pad_sequence([torch.ones_like(x) for x in inputs], batch_first=True),
+            'decoder_input_ids': pad_sequence(decoder_inputs, batch_first=True),
+            'decoder_attention_mask': pad_sequence([torch.ones_like(y) for y in decoder_inputs],
+                                                   batch_first=True),
+        }
+
+
+def lm_loss(model, batch, **kwargs):
+    """the training loss of train.py: predict decoder_input_ids[1:]"""
+    prob = model(**batch, use_cache=False, **kwargs)[0]
+    mask = batch['decoder_attention_mask'][:, 1:].reshape(-1).bool()
+    prob = prob[:, :-1]
+    prob = prob.reshape((-1, prob.size(-1)))[mask]
+    labels = batch['decoder_input_ids'][:, 1:].reshape(-1)[mask]
+    return torch.nn.functional.cross_entropy(prob, labels)
+
+
+def valid_loss(model, features, batch_size=32):
+    model.eval()
+    total, n = 0.0, 0
+    with torch.no_grad():
+        for batch in batches(features, batch_size):
+            total += lm_loss(model, batch).item() * batch['input_ids'].shape[0]
+            n += batch['input_ids'].shape[0]
+    return total / max(n, 1)
+
+
+def score_importance(model, features, batch_size=32):
+    """Importance of each head and FFN unit on features.
+
+    Returns:
+        head_scores: {"encoder" / "decoder" / "cross": tensor [layers, heads]}
+        ffn_scores: [tensor [d_ff] of each FFN (see feed_forwards)]
+    """
+    model.eval()  # 不要 dropout
+    modules = attentions(model)
+    head_masks = {kind: torch.ones(len(layers), layers[0].n_heads, requires_grad=True)
+                  for kind, layers in modules.items()}
+    head_scores = {kind: torch.zeros_like(mask) for kind, mask in head_masks.items()}
+
+    ffns = feed_forwards(model)
+    ffn_scores = [torch.zeros(ffn.wo.in_features) for ffn in ffns]
+
+    def ffn_hook(i):
+        def hook(module, inputs):
+            h = inputs[0].detach()
+
+            def accumulate(grad):
+                ffn_scores[i] += (h * grad).sum(dim=(0, 1)).abs()
+
+            if inputs[0].requires_grad:
+                inputs[0].register_hook(accumulate)
+        return hook
+
+    handles = [ffn.wo.register_forward_pre_hook(ffn_hook(i)) for i, ffn in enumerate(ffns)]
+    try:
+        for batch in batches(features, batch_size):
+            masks = {ATTENTION_KINDS[kind]: mask for kind, mask in head_masks.items()}
+            lm_loss(model, batch, **masks).backward()
+            for kind, mask in head_masks.items():
+                head_scores[kind] += mask.grad.abs()
+                mask.grad = None
+            model.zero_grad()
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    # 各层梯度的量级差很多，按层归一化后再全局比较（Michel et al. 2019）
+    for kind, scores in head_scores.items():
+        head_scores[kind] = scores / scores.norm(dim=-1, keepdim=True).clamp(min=1e-12)
+    return head_scores, ffn_scores
+
+
+def select_heads(head_scores, ratio):
+    """{kind: [heads to prune in every layer]}: the lowest ratio of all heads
+
+    A head of a kind is scored by its mean (per-layer normalized) score over the layers:
+    the same heads are pruned in every layer of a stack (see the module docstring).
+    """
+    candidates = []
+    for kind, scores in head_scores.items():
+        for head, score in enumerate(scores.mean(dim=0).tolist()):
+            candidates.append((score, kind, head))
+    candidates.sort()
+
+    n_prune = int(len(candidates) * ratio)
+    remaining = {kind: scores.shape[1] for kind, scores in head_scores.items()}
+    to_prune = {kind: [] for kind in head_scores}
+    for _, kind, head in candidates:
+        if n_prune == 0:
+            break
+        if remaining[kind] <= 1:
+            continue
+        remaining[kind] -= 1
+        to_prune[kind].append(head)
+        n_prune -= 1
+    return {kind: sorted(heads) for kind, heads in to_prune.items()}
+
+
+def select_ffn_units(ffn_scores, ratio):
+    """[sorted unit indices to keep] of each FFN: the top (1 - ratio) of each layer"""
+    keep = []
+    for scores in ffn_scores:
+        n_keep = max(1, len(scores) - int(len(scores) * ratio))
+        keep.append(sorted(scores.topk(n_keep).indices.tolist()))
+    return keep
+
+
+def prune_heads(model, to_prune):
+    """Remove heads {kind: [heads]} from every layer of that kind (in place)"""
+    modules = attentions(model)
+    for kind, heads in to_prune.items():
+        if not heads:
+            continue
+        for module in modules[kind]:
+            keep = [h for h in range(module.n_heads) if h not in heads]
+            module.prune_heads(heads)
+            # 新版 transformers 会按 pruned_heads 从共用的 position bias 里挑 head，
+            # 这里 bias 本身已经删好了列，不能再挑一遍
+            module.pruned_heads = set()
+            if module.has_relative_attention_bias:
+                old = module.relative_attention_bias
+                module.relative_attention_bias = torch.nn.Embedding(
+                    old.num_embeddings, len(keep)).to(old.weight.device, old.weight.dtype)
+                module.relative_attention_bias.weight.data = old.weight.data[:, keep].clone()
+    return model
+
+
+def prune_ffn_units(model, keep):
+    """Keep only the FFN units keep[i] of each FFN (in place)"""
+    for ffn, units in zip(feed_forwards(model), keep):
+        index = torch.tensor(units, dtype=torch.long)
+        if hasattr(ffn, 'wi_0'):  # gated-gelu (mT5 / T5 Pegasus)
+            ffn.wi_0 = prune_linear_layer(ffn.wi_0, index, dim=0)
+            ffn.wi_1 = prune_linear_layer(ffn.wi_1, index, dim=0)
+        else:
+            ffn.wi = prune_linear_layer(ffn.wi, index, dim=0)
+        ffn.wo = prune_linear_layer(ffn.wo, index, dim=1)
+    return model
+
+
+def count_structure(model):
+    """{"heads": n, "ffn_units": n, "params": n}"""
+    return {
+        'heads': sum(m.n_heads for layers in attentions(model).values() for m in layers),
+        'ffn_units': sum(ffn.wo.in_features for ffn in feed_forwards(model)),
+        'params': sum(p.numel() for p in model.parameters()),
+    }
+
+
+def finetune(model, features, steps, batch_size=16, lr=1e-4, seed=42):
+    """A short fine-tune on features to recover from pruning"""
+    if steps <= 0:
+        return model
+    rng = random.Random(seed)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=lr)
+    model.train()
+    step = 0
+    while step < steps:
+        features = features[:]
+        rng.shuffle(features)
+        for batch in batches(features, batch_size):
+            loss = lm_loss(model, batch)
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            step += 1
+            if step % 50 == 0 or step == steps:
+                print(f'finetune step {step}/{steps}: loss {loss.item():.4f}')
+            if step >= steps:
+                break
+    model.eval()
+    return model
+
+
+def measure(config, prompts, references):
+    """seconds per reply and ROUGE of T5Chatbot(config) on prompts"""
+    # 自己的 ModelManager：不和别的 T5Chatbot 共用已经加载的模型
+    chatbot = T5Chatbot(config, models=ModelManager(loader=load_model))
+    # 贪心解码：不受模型配置里 beam search / sampling 的影响，剪枝前后可比
+    chatbot.ask('', prompts[0], greedy=True)  # 预热：加载模型
+    start = time.perf_counter()
+    responses = [chatbot.ask('', p, greedy=True) for p in prompts]
+    seconds = (time.perf_counter() - start) / max(len(prompts), 1)
+    return {'seconds_per_reply': seconds,
+            'rouge': compute_rouges(responses, references),
+            'file_bytes': os.path.getsize(config.model_path())}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--model", type=str, default="chat",
+                        help="model to prune: ./model/<model>.pt")
+    parser.add_argument("--output", type=str, default="chat_pruned",
+                        help="output: ./model/<output>.pt")
+    parser.add_argument("--tokenizer", type=str, default=None,
+                        help="tokenizer of the model (T5ChatbotConfig.tokenizer), default: pretrained")
+    parser.add_argument("--data", type=str, default="./data/luge_Diamante/",
+                        help="LUGE Diamante data dir (train.txt, valid.txt, test.txt)")
+    parser.add_argument("--head-ratio", type=float, default=0.25,
+                        help="fraction of all attention heads to remove")
+    parser.add_argument("--ffn-ratio", type=float, default=0.25,
+                        help="fraction of the FFN units of each layer to remove")
+    parser.add_argument("--score-samples", type=int, default=1000,
+                        help="valid pairs used to score importance (the first ones)")
+    parser.add_argument("--loss-samples", type=int, default=500,
+                        help="valid pairs used for the reported valid loss (the ones after the scoring pairs)")
+    parser.add_argument("--finetune-steps", type=int, default=300,
+                        help="fine-tune steps after pruning, 0: no fine-tune")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--lr", type=float, default=1e-4)
+    parser.add_argument("--max-len", type=int, default=128,
+                        help="max tokens of a question / answer")
+    parser.add_argument("--eval-samples", type=int, default=200,
+                        help="test prompts for the latency / ROUGE report")
+    args = parser.parse_args()
+
+    original_config = T5ChatbotConfig(model=args.model, tokenizer=args.tokenizer)
+    pruned_config = T5ChatbotConfig(model=args.output, tokenizer=args.tokenizer)
+    tokenizer = T5Chatbot(original_config).tokenizer
+
+    # 打分和报告 loss 用 valid 里不重叠的两部分：在打分的数据上算 loss 会偏乐观
+    valid_pairs = load_data_luge(os.path.join(args.data, 'valid.txt'), shuffle=False)
+    score_pairs = valid_pairs[:args.score_samples]
+    loss_pairs = valid_pairs[args.score_samples:args.score_samples + args.loss_samples]
+    if not loss_pairs:
+        raise SystemExit(f'valid.txt has only {len(valid_pairs)} pairs, '
+                         f'none left for the valid loss: lower --score-samples')
+    scoring = encode_pairs(tokenizer, score_pairs, args.max_len)
+    valid = encode_pairs(tokenizer, loss_pairs, args.max_len)
+    # 微调只用得到 finetune_steps * batch_size 条，先抽样再分词，不用把整个 train 都分一遍
+    train_pairs = load_data_luge(os.path.join(args.data, 'train.txt'), shuffle=False)
+    n_train = min(len(train_pairs), args.finetune_steps * args.batch_size)
+    train = encode_pairs(tokenizer, random.Random(42).sample(train_pairs, n_train), args.max_len)
+    test = load_data_luge(os.path.join(args.data, 'test.txt'), shuffle=False)[:args.eval_samples]
+    prompts, references = [q for _, q in test], [a for a, _ in test]
+
+    model = torch.load(original_config.model_path())
+    before = count_structure(model)
+    losses = [valid_loss(model, valid)]
+
+    head_scores, ffn_scores = score_importance(model, scoring, args.batch_size)
+    to_prune = select_heads(head_scores, args.head_ratio)
+    prune_heads(model, to_prune)
+    prune_ffn_units(model, select_ffn_units(ffn_scores, args.ffn_ratio))
+    after = count_structure(model)
+    print(f'heads: {before["heads"]} -> {after["heads"]}, '
+          f'ffn units: {before["ffn_units"]} -> {after["ffn_units"]}, '
+          f'params: {before["params"]} -> {after["params"]}')
+    losses.append(valid_loss(model, valid))
+
+    finetune(model, train, args.finetune_steps, args.batch_size, args.lr)
+    losses.append(valid_loss(model, valid))
+
+    torch.save(model, pruned_config.model_path())
+    print(f'saved: {pruned_config.model_path()}')
+
+    original_measured = measure(original_config, prompts, references)
+    pruned_measured = measure(pruned_config, prompts, references)
+    report = {
+        'heads': [before['heads'], after['heads']],
+        'ffn_units': [before['ffn_units'], after['ffn_units']],
+        'params': [before['params'], after['params']],
+        'file_bytes': [original_measured['file_bytes'], pruned_measured['file_bytes']],
+        'seconds_per_reply': [original_measured['seconds_per_reply'],
+                              pruned_measured['seconds_per_reply']],
+        'rouge': [original_measured['rouge'], pruned_measured['rouge']],
+        'valid_loss': {'original': losses[0], 'pruned': losses[1], 'finetuned': losses[2]},
+        'pruned_heads': to_prune,
+        'args': vars(args),
+    }
+    report_file = os.path.join(_this_dir, 'model', args.output + '_prune_report.json')
+    with open(report_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+Vocabulary pruning for T5 Pegasus chatbot models
+
+T5 Pegasus 的词表（5 万多）比中文闲聊实际用到的大得多，
+而 T5Chatbot.ask 每个 decode step 都要对整个词表做一次 LM-head 投影。
+这个工具扫描语料，只保留用到的 token，重写 tokenizer 的 vocab.txt，
+并把模型的 shared embedding / lm_head 切成对应的行，保存成一个更小的模型。
+
+语料上出现过的 token 全部保留，所以语料上的分词结果和原来完全一致。
+
+    python prune_vocab.py --model chat --output chat_small
+    # => ./model/chat_small.pt + ./model/chat_small_tokenizer/ + ./model/chat_small_parity.json
+
+之后创建会话时用 {"model": "chat_small", "tokenizer": "chat_small_tokenizer"}。
+"""
+
+import argparse
+from collections import Counter
+import json
+import os
+import shutil
+import time
+import torch
+from corpus import load_data_luge
+from evaluation import compute_rouges
+from t5 import T5Chatbot, T5ChatbotConfig
+
+_this_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+def count_tokens(tokenizer, texts):
+    """Counter {token: freq} of the tokenized texts"""
+    counter = Counter()
+    for text in texts:
+        counter.update(tokenizer.tokenize(text))
+    return counter
+
+
+_CONFIG_SPECIAL_IDS = ('pad_token_id', 'eos_token_id', 'decoder_start_token_id')
+
+
+def config_special_ids(model_config):
+    """The special token ids the model config refers to (pad / eos / decoder_start)"""
+    ids = set()
+    for attr in _CONFIG_SPECIAL_IDS:
+        i = getattr(model_config, attr, None)
+        if i is not None:
+            ids.add(i)
+    return ids
+
+
+def _is_char(token):
+    # 单字，或者 wordpiece 的续接单字 ##x
+    return len(token) == 1 or (len(token) == 3 and token.startswith('##'))
+
+
+def build_vocab(tokenizer, counter, min_freq=1, keep_chars=True, special_ids=()):
+    """Old ids to keep, in the original order.
+
+    Special tokens (the tokenizer's and special_ids, e.g. config_special_ids(model.config))
+    are always kept. keep_chars keeps every single character token (and its ##x
+    continuation) so that unseen words still fall back to characters rather than [UNK].
+    """
+    keep = set(tokenizer.all_special_ids) | set(special_ids)
+    for token, i in tokenizer.vocab.items():
+        if counter[token] >= min_freq:
+            keep.add(i)
+        elif keep_chars and _is_char(token):
+            keep.add(i)
+    return sorted(keep)
+
+
+def prune_model(model, keep_ids):
+    """Slice the shared embedding and lm_head of an MT5ForConditionalGeneration
+    to keep_ids (in place). Returns the model.
+
+    Raises PrunedSpecialToken if keep_ids misses a special token the config refers to.
+    """
+    keep = torch.tensor(keep_ids, dtype=torch.long)
+    old_to_new = {old: new for new, old in enumerate(keep_ids)}
+    missing = config_special_ids(model.config) - set(old_to_new)
+    if missing:
+        raise PrunedSpecialToken(f'special token ids {sorted(missing)} not in keep_ids')
+
+    embedding = model.get_input_embeddings()
+    new_embedding = torch.nn.Embedding(len(keep_ids), embedding.embedding_dim)
+    new_embedding.weight.data = embedding.weight.data[keep].clone()
+    model.set_input_embeddings(new_embedding)
+
+    lm_head = model.get_output_embeddings()
+    new_lm_head = torch.nn.Linear(
+        lm_head.in_features, len(keep_ids), bias=False)
+    new_lm_head.weight.data = lm_head.weight.data[keep].clone()
+    model.set_output_embeddings(new_lm_head)
+    if getattr(model.config, 'tie_word_embeddings', False):
+        model.tie_weights()
+
+    model.config.vocab_size = len(keep_ids)
+    for attr in _CONFIG_SPECIAL_IDS:
+        old = getattr(model.config, attr, None)
+        if old is not None:
+            setattr(model.config, attr, old_to_new[old])
+    return model
+
+
+def save_tokenizer(tokenizer, keep_ids, src_dir, out_dir):
+    """vocab.txt with only keep_ids (+ tokenizer configs copied from src_dir)"""
+    os.makedirs(out_dir, exist_ok=True)
+    ids_to_tokens = {i: t for t, i in tokenizer.vocab.items()}
+    with open(os.path.join(out_dir, 'vocab.txt'), 'w', encoding='utf-8') as f:
+        for i in keep_ids:
+            f.write(ids_to_tokens[i] + '\n')
+    for name in ('tokenizer_config.json', 'special_tokens_map.json'):
+        if os.path.exists(os.path.join(src_dir, name)):
+            shutil.copy(os.path.join(src_dir, name), out_dir)
+
+
+def _param_bytes(chatbot):
+    with chatbot.models.acquire(chatbot.model_path) as model:
+        return sum(p.numel() * p.element_size() for p in model.parameters())
+
+
+def _ask_all(chatbot, prompts):
+    """responses, seconds per reply"""
+    start = time.perf_counter()
+    responses = [chatbot.ask('', p) for p in prompts]
+    return responses, (time.perf_counter() - start) / max(len(prompts), 1)
+
+
+def parity_report(original: T5Chatbot, pruned: T5Chatbot, prompts, references):
+    """Compare the original and pruned chatbot on the same prompts"""
+    original_responses, original_latency = _ask_all(original, prompts)
+    pruned_responses, pruned_latency = _ask_all(pruned, prompts)
+
+    same_tokens = sum(original.tokenizer.tokenize(p) == pruned.tokenizer.tokenize(p)
+                      for p in prompts)
+    same_responses = sum(a == b for a, b in zip(
+        original_responses, pruned_responses))
+
+    return {
+        'prompts': len(prompts),
+        'vocab_size': [len(original.tokenizer.vocab), len(pruned.tokenizer.vocab)],
+        'param_bytes': [_param_bytes(original), _param_bytes(pruned)],
+        'seconds_per_reply': [original_latency, pruned_latency],
+        'same_tokenization': same_tokens / max(len(prompts), 1),
+        'same_response': same_responses / max(len(prompts), 1),
+        'rouge': [compute_rouges(original_responses, references),
+                  compute_rouges(pruned_responses, references)],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--model", type=str, default="chat",
+                        help="model to prune: ./model/<model>.pt")
+    parser.add_argument("--output", type=str, default="chat_small",
+                        help="output: ./model/<output>.pt and ./model/<output>_tokenizer/")
+    parser.add_argument("--data", type=str, default="./data/luge_Diamante/",
+                        help="LUGE Diamante data dir (train.txt, valid.txt, test.txt)")
+    parser.add_argument("--min-freq", type=int, default=1,
+                        help="keep tokens seen at least min-freq times")
+    parser.add_argument("--no-keep-chars", action="store_true",
+                        help="do not keep unseen single character tokens")
+    parser.add_argument("--parity-samples", type=int, default=200,
+                        help="number of valid prompts used for the parity report")
+    args = parser.parse_args()
+
+    original_config = T5ChatbotConfig(model=args.model)
+    tokenizer_src_dir = original_config.tokenizer_path()
+    original = T5Chatbot(original_config)
+
+    data = []
+    for name in ('train.txt', 'valid.txt', 'test.txt'):
+        data.extend(load_data_luge(os.path.join(args.data, name), shuffle=False))
+    counter = count_tokens(original.tokenizer,
+                           (text for pair in data for text in pair))
+
+    model = torch.load(original_config.model_path())
+    keep_ids = build_vocab(original.tokenizer, counter,
+                           min_freq=args.min_freq, keep_chars=not args.no_keep_chars,
+                           special_ids=config_special_ids(model.config))
+    print(f'vocab: {len(original.tokenizer.vocab)} -> {len(keep_ids)}')
+
+    pruned_config = T5ChatbotConfig(
+        model=args.output, tokenizer=args.output + '_tokenizer')
+    save_tokenizer(original.tokenizer, keep_ids,
+                   tokenizer_src_dir, pruned_config.tokenizer_path())
+    model = prune_model(model, keep_ids)
+    torch.save(model, pruned_config.model_path())
+    print(f'saved: {pruned_config.model_path()}, {pruned_config.tokenizer_path()}')
+
+    valid = load_data_luge(os.path.join(args.data, 'valid.txt'), shuffle=False)
+    valid = valid[:args.parity_samples]
+    report = parity_report(original, T5Chatbot(pruned_config),
+                           prompts=[q for _, q in valid],
+                           references=[a for a, _ in valid])
+    report_file = os.path.join(_this_dir, 'model', args.output + '_parity.json')
+    with open(report_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+class PrunedSpecialToken(Exception):
+    pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""
+Replay captured traffic against a local server
+
+    python replay.py capture.jsonl.gz --stub                    # 桩模型：只测框架（调度、排队）
+    python replay.py capture.jsonl.gz --config '{"model": "chat"}' --speed 2
+    python replay.py capture.jsonl.gz --address localhost:50053 # 已经在跑的服务
+
+capture 是 MuvtuberGrpcServerConfig(capture_file=...) 录下来的线上流量（见 muvtuber_chatbot_api/capture.py）。
+按录制时的时间间隔（--speed 倍速）把 Chat / BatchChat 请求原样发出去（open loop，不等上一个返回），
+每个录到的会话对应一个新会话（用录到的 NewSession 配置，没录到就用 --config）。
+同样的 capture 和参数，每次发出去的请求序列都一样。
+
+不给 --address 时在进程里起一个 serve_grpc：--stub 用桩模型（按 prompt 长度 sleep，带一个精确匹配的回复缓存），
+否则用 T5Chatbot。
+
+报告（JSON）：延迟分位数、错误码、实际 / 录制时的吞吐量、发送延误，
+录制时线上的延迟分位数（对比用），prompt 重复率，以及服务端缓存命中率
+（桩模型的回复缓存；真模型的检索索引、ModelManager）。
+"""
+
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import socket
+import threading
+import time
+import grpc
+import muvtuber_chatbot_api
+from muvtuber_chatbot_api import LatencyWindow, Counters, read_capture, placeholder_prompt
+from muvtuber_chatbot_api.protos import chatbot_pb2, chatbot_pb2_grpc
+
+PERCENTILES = (50, 90, 95, 99, 100)
+
+
+class StubChatbot(muvtuber_chatbot_api.Chatbot):
+    """sleeps base + per_char * len(prompt), answers the reversed prompt"""
+
+    def __init__(self, factory: 'StubChatbotFactory'):
+        super().__init__()
+        self.factory = factory
+
+    def ask(self, session_id, prompt, **kwargs):
+        return self.factory.cached_answer(prompt)
+
+
+class StubChatbotFactory(muvtuber_chatbot_api.ChatbotFactory):
+    def __init__(self, base=0.05, per_char=0.002, cache_size=1024):
+        self.base = base
+        self.per_char = per_char
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # {"hits": n, "misses": n}
+        self.counters = Counters()
+
+    def cached_answer(self, prompt):
+        with self._lock:
+            if prompt in self._cache:
+                self._cache.move_to_end(prompt)
+                self.counters.inc("hits")
+                return self._cache[prompt]
+        self.counters.inc("misses")
+        time.sleep(self.base + self.per_char * len(prompt))
+        answer = prompt[::-1]
+        with self._lock:
+            self._cache[prompt] = answer
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return answer
+
+    def create_chatbot(self, config):
+        return StubChatbot(self)
+
+    def cache_stats(self):
+        c = self.counters.snapshot()
+        total = c.get('hits', 0) + c.get('misses', 0)
+        return {'stub_cache': dict(c, hit_ratio=c.get('hits', 0) / total if total else 0.0)}
+
+
+def capture_records(capture, limit=None):
+    """Yields the records of a capture by time: NewSessions, and the first limit
+    requests (Chat, or an item of BatchChat)
+    """
+    n = 0
+    for record in sorted(read_capture(capture), key=lambda r: r['t']):
+        if record['k'] != 'n':
+            if limit and n >= limit:
+                break
+            n += 1
+        yield record
+
+
+def load_events(capture, limit=None):
+    """(sessions {recorded id: config or None}, events [(t, kind, [(session, prompt, high)])])
+
+    The items of a recorded BatchChat (same "b" batch id in the same recording)
+    become one event.
+    """
+    sessions, events = {}, []
+    batches = {}  # batch id -> its event
+    for record in capture_records(capture, limit):
+        if record['k'] == 'n':
+            sessions[record['s']] = record.get('cfg')
+            continue
+        sessions.setdefault(record['s'], None)
+        item = (record['s'], placeholder_prompt(record), bool(record.get('hi')))
+        if record['k'] == 'b':
+            # batch id 每次录制（重启后追加到同一个文件）从头编号；旧的 capture 没有 batch id：同一时刻的算一批
+            key = (record['rec'], record['b']) if 'b' in record else ('t', record['t'])
+            if key in batches:
+                batches[key][2].append(item)
+                continue
+            batches[key] = (record['t'], 'b', [item])
+            events.append(batches[key])
+        else:
+            events.append((record['t'], record['k'], [item]))
+    return sessions, events
+
+
+def recorded_stats(capture, limit=None):
+    """latency percentiles and request rate of the capture itself (the same requests as load_events)"""
+    window = LatencyWindow(maxlen=1 << 24)
+    times = []
+    for record in capture_records(capture, limit):
+        if record['k'] == 'n':
+            continue
+        times.append(record['t'])
+        if 'l' in record:
+            window.add(record['l'])
+    span = max(times) - min(times) if times else 0.0
+    return {'requests': len(times),
+            'seconds': span,
+            'requests_per_second': len(times) / span if span else 0.0,
+            'latency': {f'p{p}': window.percentile(p) for p in PERCENTILES}}
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def start_local_server(factory, config_class, max_sessions, max_workers):
+    address = f'localhost:{_free_port()}'
+    config = muvtuber_chatbot_api.MuvtuberGrpcServerConfig(
+        chatbot_factory=factory,
+        chatbot_config_class=config_class,
+        max_sessions=max_sessions,
+        address=address,
+        add_reflection_service=False,
+        max_workers=max_workers,
+        max_concurrency=2)
+    threading.Thread(target=muvtuber_chatbot_api.serve_grpc,
+                     args=(config,), daemon=True).start()
+    grpc.channel_ready_future(grpc.insecure_channel(address)).result(timeout=60)
+    return address
+
+
+def replay(stub, sessions, events, default_config, speed=1.0, max_inflight=64, timeout=None):
+    # 先把会话都建好，不算在压测时间里
+    session_ids = {}
+    for recorded, config in sessions.items():
+        resp = stub.NewSession(chatbot_pb2.NewSessionRequest(
+            config=config or default_config))
+        session_ids[recorded] = resp.session_id
+
+    latencies = LatencyWindow(maxlen=1 << 24)
+    codes = Counters()
+    seen = set()
+    repeats = 0
+    max_lag = 0.0
+
+    def call(kind, items, scheduled):
+        metadata = (('muvtuber-priority', 'high'),) if any(hi for _, _, hi in items) else None
+        if kind == 'b':
+            try:
+                resp = stub.BatchChat(chatbot_pb2.BatchChatRequest(items=[
+                    chatbot_pb2.ChatRequest(session_id=session_ids[s], prompt=p)
+                    for s, p, _ in items]), timeout=timeout, metadata=metadata)
+                item_codes = [r.code for r in resp.results]
+            except grpc.RpcError as e:
+                item_codes = [e.code().value[0]] * len(items)
+        else:
+            session, prompt, _ = items[0]
+            try:
+                stub.Chat(chatbot_pb2.ChatRequest(session_id=session_ids[session], prompt=prompt),
+                          timeout=timeout, metadata=metadata)
+                item_codes = [grpc.StatusCode.OK.value[0]]
+            except grpc.RpcError as e:
+                item_codes = [e.code().value[0]]
+        # 从计划发出的时间算：发晚了（客户端线程不够）的等待也算进延迟，免得漏掉排队（coordinated omission）
+        latency = time.time() - scheduled
+        for code in item_codes:
+            latencies.add(latency)
+            codes.inc(_code_name(code))
+
+    t0 = events[0][0] if events else 0.0
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max_inflight) as pool:
+        for t, kind, items in events:
+            scheduled = start + (t - t0) / speed
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            max_lag = max(max_lag, time.time() - scheduled)
+            for _, prompt, _ in items:
+                repeats += prompt in seen
+                seen.add(prompt)
+            pool.submit(call, kind, items, scheduled)
+    seconds = time.time() - start
+
+    n = sum(len(items) for _, _, items in events)
+    return {'requests': n,
+            'seconds': seconds,
+            'requests_per_second': n / seconds if seconds else 0.0,
+            'max_dispatch_lag': max_lag,
+            'codes': codes.snapshot(),
+            'latency': {f'p{p}': latencies.percentile(p) for p in PERCENTILES},
+            'prompt_repeat_ratio': repeats / n if n else 0.0}
+
+
+def _code_name(code: int) -> str:
+    for status in grpc.StatusCode:
+        if status.value[0] == code:
+            return status.name
+    return str(code)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("capture", type=str, help="capture file (.jsonl.gz)")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed, 2: twice as fast as recorded")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="replay only the first N requests")
+    parser.add_argument("--address", type=str, default=None,
+                        help="replay against a running server (default: start one in-process)")
+    parser.add_argument("--stub", action="store_true",
+                        help="in-process server with a stub model instead of T5Chatbot")
+    parser.add_argument("--stub-latency", type=float, nargs=2, default=(0.05, 0.002),
+                        metavar=('BASE', 'PER_CHAR'), help="stub model seconds: base + per_char * len(prompt)")
+    parser.add_argument("--config", type=str, default='{"model": "chat"}',
+                        help="session config for sessions whose NewSession was not captured")
+    parser.add_argument("--max-inflight", type=int, default=64,
+                        help="max requests in flight (client threads)")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="per request gRPC deadline, seconds")
+    parser.add_argument("--output", type=str, default=None,
+                        help="write the report JSON here too")
+    args = parser.parse_args()
+
+    sessions, events = load_events(args.capture, args.limit)
+    print(f'{sum(len(items) for _, _, items in events)} requests from {len(sessions)} sessions')
+
+    factory = None
+    address = args.address
+    if address is None:
+        if args.stub:
+            factory = StubChatbotFactory(*args.stub_latency)
+            config_class = muvtuber_chatbot_api.ChatbotConfig
+        else:
+            from t5 import T5ChatbotFactory, T5ChatbotConfig
+            factory = T5ChatbotFactory()
+            config_class = T5ChatbotConfig
+        address = start_local_server(factory, config_class,
+                                     max_sessions=len(sessions) + 1,
+                                     max_workers=args.max_inflight + 8)
+
+    stub = chatbot_pb2_grpc.ChatbotServiceStub(grpc.insecure_channel(address))
+    report = {'replay': replay(stub, sessions, events, args.config, speed=args.speed,
+                               max_inflight=args.max_inflight, timeout=args.timeout),
+              'recorded': recorded_stats(args.capture, args.limit),
+              'speed': args.speed}
+
+    if isinstance(factory, StubChatbotFactory):
+        report['cache'] = factory.cache_stats()
+    elif factory is not None:
+        report['cache'] = _t5_cache_stats(factory, sessions, args.config)
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+def _t5_cache_stats(factory, sessions, default_config):
+    """retrieval index hit rates (load_index is shared per index) and ModelManager counters"""
+    from retrieval import load_index
+    from t5 import T5ChatbotConfig
+    stats = {'model_manager': factory.models.counters.snapshot()}
+    for config in set(sessions.values()) | {None}:
+        config = T5ChatbotConfig.from_json(config or default_config)
+        if config.retrieval_index:
+            stats[f'retrieval:{config.retrieval_index}'] = load_index(
+                config.retrieval_index).stats()
+    return stats
+
+
+if __name__ == "__main__":
+    main()
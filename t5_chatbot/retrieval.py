@@ -0,0 +1,318 @@
+"""
+Retrieval-based fast answers ahead of generation
+
+很多聊天 prompt 在 LUGE Diamante 训练集里都有（近似）重复。
+离线把 prompt -> response 建成一个紧凑的索引，在线时先查索引：
+高置信度命中就直接返回（微秒级），否则再交给 T5Chatbot.ask 生成。
+
+索引：
+  - prompt 精确匹配：排好序的 64 位 prompt 哈希，二分查找；
+  - 近似匹配：字符 n-gram（哈希到固定桶数）TF-IDF 向量的余弦相似度，
+    倒排表召回候选 + 正排表精确打分，全部是 numpy 向量化操作。
+所有数组都存成 .npy，加载时 mmap，多个会话、多个进程共享同一份内存。
+
+    python retrieval.py build --output luge_index   # => ./model/luge_index/
+    python retrieval.py bench --index luge_index    # 在 valid 集上测命中率和延迟
+
+会话配置里加上 {"retrieval_index": "luge_index"} 即可启用。
+"""
+
+import argparse
+from functools import lru_cache
+import hashlib
+import json
+import os
+import time
+import zlib
+import numpy as np
+from corpus import load_data_luge
+from evaluation import compute_rouges
+from muvtuber_chatbot_api.metrics import Counters
+
+_this_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+def index_path(name):
+    """name="luge_index" => ./model/luge_index"""
+    return os.path.join(_this_dir, "model", name)
+
+
+def normalize(text: str) -> str:
+    return ''.join(text.split()).lower()
+
+
+def prompt_hash(text: str) -> int:
+    """stable 64-bit hash of the normalized prompt"""
+    digest = hashlib.blake2b(normalize(text).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def char_ngrams(text: str, ngram_range=(1, 2)):
+    text = normalize(text)
+    for n in range(ngram_range[0], ngram_range[1] + 1):
+        for i in range(len(text) - n + 1):
+            yield text[i:i + n]
+
+
+def _bucket_counts(text, n_buckets, ngram_range):
+    """sorted unique buckets, counts"""
+    buckets = [zlib.crc32(g.encode('utf-8')) % n_buckets
+               for g in char_ngrams(text, ngram_range)]
+    return np.unique(np.array(buckets, dtype=np.int64), return_counts=True)
+
+
+def _csr(rows, cols, values, n_rows):
+    """(indptr, cols, values) of the triplets grouped by row"""
+    order = np.argsort(rows, kind='stable')
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+    return indptr, cols[order], values[order]
+
+
+def _gather(indptr, rows):
+    """flat positions of rows in a CSR (indptr), and which row each one belongs to"""
+    starts, ends = indptr[rows], indptr[rows + 1]
+    lengths = ends - starts
+    owner = np.repeat(np.arange(len(rows)), lengths)
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(lengths.sum()), owner
+
+
+def build_index(pairs, output_dir, n_buckets=1 << 18, ngram_range=(1, 2), threshold=0.9):
+    """Build the index from (response, prompt) pairs (as load_data_luge returns).
+
+    The first response of each (normalized) prompt is kept.
+    """
+    responses = {}
+    for response, prompt in pairs:
+        key = normalize(prompt)
+        if key and key not in responses:
+            responses[key] = (prompt, response)
+    prompts = [p for p, _ in responses.values()]
+    answers = [r for _, r in responses.values()]
+    n_docs = len(prompts)
+
+    # doc -> (bucket, tf)
+    doc_ids, buckets, tfs = [], [], []
+    for i, prompt in enumerate(prompts):
+        b, c = _bucket_counts(prompt, n_buckets, ngram_range)
+        doc_ids.append(np.full(len(b), i, dtype=np.int64))
+        buckets.append(b)
+        tfs.append(c)
+    doc_ids = np.concatenate(doc_ids)
+    buckets = np.concatenate(buckets)
+    tfs = np.concatenate(tfs).astype(np.float32)
+
+    df = np.bincount(buckets, minlength=n_buckets)
+    idf = (np.log((1 + n_docs) / (1 + df)) + 1).astype(np.float32)
+    weights = tfs * idf[buckets]
+    norms = np.sqrt(np.bincount(doc_ids, weights=weights * weights, minlength=n_docs))
+    weights = (weights / norms[doc_ids]).astype(np.float32)
+
+    os.makedirs(output_dir, exist_ok=True)
+    save = lambda name, a: np.save(os.path.join(output_dir, name + '.npy'), a)
+
+    # 正排：doc -> buckets（每个 doc 内部已经按 bucket 排好序）
+    doc_indptr, doc_buckets, doc_weights = _csr(doc_ids, buckets, weights, n_docs)
+    save('doc_indptr', doc_indptr)
+    save('doc_buckets', doc_buckets.astype(np.int32))
+    save('doc_weights', doc_weights)
+
+    # 倒排：bucket -> docs
+    post_indptr, post_docs, post_weights = _csr(buckets, doc_ids, weights, n_buckets)
+    save('post_indptr', post_indptr)
+    save('post_docs', post_docs.astype(np.int32))
+    save('post_weights', post_weights)
+    save('idf', idf)
+
+    hashes = np.array([prompt_hash(p) for p in prompts], dtype=np.uint64)
+    order = np.argsort(hashes)
+    save('hashes', hashes[order])
+    save('hash_docs', order.astype(np.int32))
+
+    encoded = [r.encode('utf-8') for r in answers]
+    offsets = np.zeros(n_docs + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    save('response_offsets', offsets)
+    with open(os.path.join(output_dir, 'responses.bin'), 'wb') as f:
+        f.write(b''.join(encoded))
+
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as f:
+        json.dump({'n_docs': n_docs, 'n_buckets': n_buckets,
+                   'ngram_range': list(ngram_range), 'threshold': threshold}, f)
+    return n_docs
+
+
+class RetrievalIndex:
+    """A prompt -> response index built by build_index, loaded by mmap.
+
+    Thread-safe: lookups only read the mmapped arrays.
+    """
+
+    def __init__(self, path, max_candidate_df=0.01, n_candidates=32):
+        """
+        Args:
+            max_candidate_df: only n-grams in at most this fraction of
+                the docs are used to recall candidates (common characters
+                would recall half the index).
+            n_candidates: candidates rescored with the exact cosine
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.n_docs = meta['n_docs']
+        self.n_buckets = meta['n_buckets']
+        self.ngram_range = tuple(meta['ngram_range'])
+        self.threshold = meta['threshold']
+
+        load = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        self.doc_indptr = load('doc_indptr')
+        self.doc_buckets = load('doc_buckets')
+        self.doc_weights = load('doc_weights')
+        self.post_indptr = load('post_indptr')
+        self.post_docs = load('post_docs')
+        self.post_weights = load('post_weights')
+        self.idf = load('idf')
+        self.hashes = load('hashes')
+        self.hash_docs = load('hash_docs')
+        self.response_offsets = load('response_offsets')
+        self.responses = np.memmap(os.path.join(path, 'responses.bin'), dtype=np.uint8, mode='r') \
+            if self.response_offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+
+        self.max_candidate_postings = max(1, int(max_candidate_df * self.n_docs))
+        self.n_candidates = n_candidates
+
+        # lookups, hits, exact_hits, lookup_ns
+        self.counters = Counters()
+
+    def response(self, doc: int) -> str:
+        start, end = self.response_offsets[doc], self.response_offsets[doc + 1]
+        return bytes(self.responses[start:end]).decode('utf-8')
+
+    def _exact(self, prompt):
+        h = np.uint64(prompt_hash(prompt))
+        i = np.searchsorted(self.hashes, h)
+        if i < len(self.hashes) and self.hashes[i] == h:
+            return int(self.hash_docs[i])
+        return None
+
+    def _nearest(self, prompt):
+        """(doc, cosine) of the nearest prompt, (None, 0.0) if no candidate"""
+        buckets, counts = _bucket_counts(prompt, self.n_buckets, self.ngram_range)
+        if len(buckets) == 0:
+            return None, 0.0
+        q = counts.astype(np.float32) * self.idf[buckets]
+        q /= np.sqrt(np.dot(q, q))
+
+        # 召回：稀有 n-gram 的倒排表
+        rare = (self.post_indptr[buckets + 1] - self.post_indptr[buckets]) \
+            <= self.max_candidate_postings
+        positions, owner = _gather(self.post_indptr, buckets[rare])
+        if len(positions) == 0:
+            return None, 0.0
+        candidates, inverse = np.unique(self.post_docs[positions], return_inverse=True)
+        partial = np.bincount(
+            inverse, weights=self.post_weights[positions] * q[rare][owner])
+        if len(candidates) > self.n_candidates:
+            top = np.argpartition(-partial, self.n_candidates)[:self.n_candidates]
+            candidates = candidates[top]
+
+        # 精确打分：候选的正排向量和 q 的点积
+        positions, owner = _gather(self.doc_indptr, candidates)
+        doc_buckets = self.doc_buckets[positions]
+        pos = np.searchsorted(buckets, doc_buckets)
+        pos[pos >= len(buckets)] = 0
+        match = buckets[pos] == doc_buckets
+        scores = np.bincount(owner[match],
+                             weights=self.doc_weights[positions][match] * q[pos[match]],
+                             minlength=len(candidates))
+        best = int(np.argmax(scores))
+        best_doc, best_score = int(candidates[best]), float(scores[best])
+        return best_doc, best_score
+
+    def lookup(self, prompt: str, threshold: float = None):
+        """Response of a high-confidence match, None if there is none.
+
+        threshold: min cosine similarity, defaults to the one built into the index.
+        """
+        if threshold is None:
+            threshold = self.threshold
+        start = time.perf_counter_ns()
+
+        response = None
+        doc = self._exact(prompt)
+        if doc is not None:
+            self.counters.inc('exact_hits')
+        else:
+            doc, score = self._nearest(prompt)
+            if score < threshold:
+                doc = None
+        if doc is not None:
+            response = self.response(doc)
+            self.counters.inc('hits')
+
+        self.counters.inc('lookups')
+        self.counters.inc('lookup_ns', time.perf_counter_ns() - start)
+        return response
+
+    def stats(self):
+        """{lookups, hits, exact_hits, hit_ratio, mean_lookup_us}"""
+        c = self.counters.snapshot()
+        lookups = c.get('lookups', 0)
+        return {
+            'lookups': lookups,
+            'hits': c.get('hits', 0),
+            'exact_hits': c.get('exact_hits', 0),
+            'hit_ratio': c.get('hits', 0) / lookups if lookups else 0.0,
+            'mean_lookup_us': c.get('lookup_ns', 0) / lookups / 1000 if lookups else 0.0,
+        }
+
+
+@lru_cache(maxsize=None)
+def load_index(name) -> RetrievalIndex:
+    """Shared RetrievalIndex of ./model/<name>"""
+    return RetrievalIndex(index_path(name))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("command", choices=["build", "bench"])
+    parser.add_argument("--data", type=str, default="./data/luge_Diamante/",
+                        help="LUGE Diamante data dir")
+    parser.add_argument("--output", "--index", dest="index", type=str, default="luge_index",
+                        help="index name: ./model/<index>/")
+    parser.add_argument("--threshold", type=float, default=0.9,
+                        help="min cosine similarity to answer from the index")
+    parser.add_argument("--n-buckets", type=int, default=1 << 18,
+                        help="n-gram hash buckets (build)")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start = time.time()
+        pairs = load_data_luge(os.path.join(args.data, 'train.txt'), shuffle=False)
+        n = build_index(pairs, index_path(args.index),
+                        n_buckets=args.n_buckets, threshold=args.threshold)
+        print(f'built {index_path(args.index)}: {n} prompts in {time.time() - start:.1f}s')
+        return
+
+    index = load_index(args.index)
+    valid = load_data_luge(os.path.join(args.data, 'valid.txt'), shuffle=False)
+    latencies, hits, references = [], [], []
+    for response, prompt in valid:
+        start = time.perf_counter()
+        answer = index.lookup(prompt, threshold=args.threshold)
+        latencies.append(time.perf_counter() - start)
+        if answer is not None:
+            hits.append(answer)
+            references.append(response)
+    latencies = np.array(latencies) * 1e6
+    print(json.dumps({
+        **index.stats(),
+        'p50_us': float(np.percentile(latencies, 50)),
+        'p99_us': float(np.percentile(latencies, 99)),
+        'hit_rouge': compute_rouges(hits, references) if hits else None,
+    }, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# Speculative decoding:
+# 一个很小的 draft 模型（train.py 的 distill 模式蒸馏出来的）先贪心地猜 k 个 token，
+# 大模型再用一次 decoder 前向把这 k 个 token 一起验证掉。
+# 只接受和大模型 argmax 一致的前缀，所以输出和贪心的 model.generate 完全相同，
+# 只是大模型的 decoder 前向次数变少了。
+
+import logging
+import torch
+
+
+def is_plain_greedy(config) -> bool:
+    """model.generate() with this config is plain greedy (argmax) decoding.
+
+    Speculative decoding only reproduces that. Beam search, sampling,
+    repetition penalties & co. change what generate() returns.
+    """
+    return ((getattr(config, 'num_beams', 1) or 1) == 1
+            and not getattr(config, 'do_sample', False)
+            and not getattr(config, 'no_repeat_ngram_size', 0)
+            and (getattr(config, 'repetition_penalty', 1.0) or 1.0) == 1.0
+            and not getattr(config, 'bad_words_ids', None)
+            and not getattr(config, 'min_length', 0)
+            and not getattr(config, 'encoder_no_repeat_ngram_size', 0)
+            and getattr(config, 'forced_bos_token_id', None) is None
+            and getattr(config, 'forced_eos_token_id', None) is None)
+
+
+def _decoder_step(model, encoder_outputs, past_key_values, tokens, device):
+    """Run decoder over new tokens (with cache), returns (logits [len(tokens), vocab], new cache)."""
+    decoder_input_ids = torch.tensor([tokens], dtype=torch.long, device=device)
+    out = model(encoder_outputs=encoder_outputs,
+                decoder_input_ids=decoder_input_ids,
+                past_key_values=past_key_values,
+                use_cache=True,
+                return_dict=True)
+    return out.logits[0], out.past_key_values
+
+
+def _crop_cache(past_key_values, length):
+    """Keep the first `length` decoder positions in the self-attention cache.
+
+    Each layer is (self_k, self_v, cross_k, cross_v) of [batch, heads, seq, dim].
+    Cross-attention cache depends only on the encoder, keep it as is.
+    """
+    return tuple((layer[0][:, :, :length], layer[1][:, :, :length]) + tuple(layer[2:])
+                 for layer in past_key_values)
+
+
+@torch.no_grad()
+def speculative_generate(model, draft_model, input_ids, decoder_start_token_id, eos_token_id,
+                         max_length=30, k=4):
+    """Greedy decoding of one prompt, accelerated by draft_model.
+
+    Same result as model.generate(input_ids, decoder_start_token_id=...,
+    eos_token_id=..., max_length=...)[0] with greedy decoding.
+
+    Args:
+        model: the main MT5ForConditionalGeneration
+        draft_model: a much smaller model sharing the tokenizer/vocab
+        input_ids: [1, seq_len] encoded prompt
+        max_length: max output length, decoder_start_token included (as in generate)
+        k: number of tokens the draft model proposes per verification
+
+    Returns:
+        torch.LongTensor: [out_len] output ids, starts with decoder_start_token_id
+    """
+    device = input_ids.device
+    encoder_outputs = model.get_encoder()(input_ids=input_ids, return_dict=True)
+    draft_encoder_outputs = draft_model.get_encoder()(
+        input_ids=input_ids, return_dict=True)
+
+    output = [decoder_start_token_id]
+    past, past_len = None, 0  # 大模型 cache 覆盖了 output[:past_len]
+    draft_past, draft_len = None, 0
+
+    while len(output) < max_length and output[-1] != eos_token_id:
+        # draft: 贪心猜 n 个
+        n = min(k, max_length - len(output))
+        proposal = []
+        for _ in range(n):
+            seq = output + proposal
+            logits, draft_past = _decoder_step(
+                draft_model, draft_encoder_outputs, draft_past, seq[draft_len:], device)
+            draft_len = len(seq)
+            token = int(logits[-1].argmax())
+            proposal.append(token)
+            if token == eos_token_id:
+                break
+
+        # verify: 大模型一次前向算出每个位置的 argmax
+        seq = output + proposal
+        logits, past = _decoder_step(
+            model, encoder_outputs, past, seq[past_len:], device)
+        predictions = logits.argmax(-1).tolist()
+        # predictions[offset + i] 是大模型对 proposal[i] 这个位置的预测
+        offset = len(output) - past_len - 1
+
+        accepted = []
+        matched = 0
+        for i, token in enumerate(proposal):
+            target = predictions[offset + i]
+            accepted.append(target)
+            if target != token:
+                break
+            matched += 1
+            if token == eos_token_id:
+                break
+        else:
+            # 全部猜中，顺便白赚大模型对下一个位置的预测
+            if len(seq) < max_length:
+                accepted.append(predictions[offset + len(proposal)])
+
+        # cache 里只有和新 output 一致的前缀还能用
+        valid_len = len(output) + matched
+        past, past_len = _crop_cache(past, valid_len), valid_len
+        draft_len = min(draft_len, valid_len)
+        draft_past = _crop_cache(draft_past, draft_len)
+
+        output.extend(accepted)
+        logging.debug(
+            f'speculative_generate: proposed {len(proposal)}, accepted {matched}')
+
+    return torch.tensor(output[:max_length], dtype=torch.long)
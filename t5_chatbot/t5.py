@@ -1,11 +1,21 @@
 # 这个文件是将 muvtuber_chatbot_api 的框架作用于 t5_demo.py 产生的。
 # 可以直接运行：REPL or --muvtuber-grpc-service
 
+from dataclasses import dataclass
+import logging
 import os
+import threading
+import time
+from typing import Dict, List
 import torch
+from torch.nn.utils.rnn import pad_sequence
 from tokenizer import T5PegasusTokenizer
 from transformers.models.mt5.modeling_mt5 import MT5ForConditionalGeneration
 import muvtuber_chatbot_api
+from speculative import is_plain_greedy, speculative_generate
+from retrieval import load_index
+from model_manager import ModelManager, ModelBudgetExceeded
+from pipeline import Pipeline
 
 _this_dir = os.path.dirname(os.path.realpath(__file__))
 
@@ -13,42 +23,327 @@ pretrained_tokenizer_model_path = os.path.join(
     _this_dir, "model", "pretrained-imxly-t5-pegasus-small")
 
 
+@dataclass
 class T5ChatbotConfig(muvtuber_chatbot_api.ChatbotConfig):
+    # speculative decoding: draft="chat_draft" => ./model/chat_draft.pt
+    # (train.py 的 distill 模式训练出来的小模型)。None 则不用。
+    draft_model: str = None
+    speculative_k: int = 4  # draft 每次猜几个 token
+    # tokenizer="chat_small_tokenizer" => ./model/chat_small_tokenizer/
+    # (prune_vocab.py 裁剪过词表的模型要配套用裁剪后的 tokenizer)。None 则用预训练的。
+    tokenizer: str = None
+    # 检索优先：retrieval_index="luge_index" => ./model/luge_index/ (retrieval.py build)。
+    # 高置信度命中就直接回答，不走生成。threshold 为 None 则用索引自带的。
+    retrieval_index: str = None
+    retrieval_threshold: float = None
+
     def model_path(self):
         """self.model="chat" => ./model/chat.pt"""
         return os.path.join(_this_dir, "model", self.model + ".pt")
 
+    def tokenizer_path(self):
+        """self.tokenizer="chat_small_tokenizer" => ./model/chat_small_tokenizer"""
+        if not self.tokenizer:
+            return pretrained_tokenizer_model_path
+        return os.path.join(_this_dir, "model", self.tokenizer)
+
+    def draft_model_path(self):
+        """self.draft_model="chat_draft" => ./model/chat_draft.pt"""
+        return os.path.join(_this_dir, "model", self.draft_model + ".pt")
+
+
+device = torch.device("cpu")  # 不要用 mps，用 mps 更慢且效果巨差
+
+# 每个 decoder step 之前检查请求是否还有人要：
+# 超时或客户端断开就抛异常，中断 generate。
+# 模型是所有会话共用的，deadline / is_active 按线程记。
+_cancellation = threading.local()
+
+
+def _check_cancelled_hook(module, inputs):
+    muvtuber_chatbot_api.check_cancelled(
+        getattr(_cancellation, 'deadline', None),
+        getattr(_cancellation, 'is_active', None))
+
+
+def load_model(path):
+    """ModelManager loader: torch.load, to device, eval, cancellation hook"""
+    model = torch.load(path)
+    model.to(device)
+    model.eval()
+    model.get_decoder().register_forward_pre_hook(_check_cancelled_hook)
+    return model
+
+
+# autotune.py 默认写到这里，__main__.py 启动时有就读
+autotune_settings_path = os.path.join(_this_dir, "model", "autotune.json")
+
+# 没有给 T5ChatbotFactory 预算时用的：不限内存，但同一个模型也只加载一份
+default_model_manager = ModelManager(loader=load_model)
+
+
+@dataclass
+class _GenerateRequest:
+    prompts: List[str]
+    max_length: int = 30
+    greedy: bool = False
+
+
+class T5Generator:
+    """tokenize -> generate -> decode for one (model, draft model, tokenizer),
+    run as a Pipeline shared by all the T5Chatbots of it.
+    """
+
+    _shared: Dict[tuple, 'T5Generator'] = {}
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, models: ModelManager, model_path, draft_model_path, tokenizer_path, speculative_k,
+               max_batch=32):
+        key = (id(models), model_path, draft_model_path,
+               tokenizer_path, speculative_k, max_batch)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(models, model_path, draft_model_path,
+                                       tokenizer_path, speculative_k, max_batch)
+            return cls._shared[key]
+
+    def __init__(self, models: ModelManager, model_path, draft_model_path, tokenizer_path, speculative_k,
+                 max_batch=32):
+        self.models = models
+        self.model_path = model_path
+        self.draft_model_path = draft_model_path
+        self.speculative_k = speculative_k
+        self.tokenizer = T5PegasusTokenizer.from_pretrained(tokenizer_path)
+
+        # speculative decoding 只在一批只有一个 prompt 时用（逐个 token 验证没有 batch 版本）。
+        # {"used": n, "batch_bypassed": n, "draft_unavailable": n}
+        self.speculative = muvtuber_chatbot_api.Counters()
+
+        # 分词、decode 在 pre / post 线程里做，model 线程只跑 generate
+        self.pipeline = Pipeline(self._tokenize, self._execute, self._detokenize,
+                                 batch_key=lambda request: (request.max_length, request.greedy),
+                                 size=len, max_batch=max_batch,
+                                 name=os.path.basename(model_path))
+
+    def stats(self) -> Dict:
+        """Pipeline.stats(), plus the speculative decoding counters if there is a draft model"""
+        stats = self.pipeline.stats()
+        if self.draft_model_path is not None:
+            stats['speculative'] = self.speculative.snapshot()
+        return stats
+
+    def generate(self, prompts, max_length=30, greedy=False, deadline=None, is_active=None) -> List[str]:
+        return self.pipeline.run(_GenerateRequest(prompts, max_length, greedy),
+                                 deadline=deadline, is_active=is_active)
+
+    def _tokenize(self, request: _GenerateRequest):
+        return [torch.tensor(self.tokenizer.encode(prompt)) for prompt in request.prompts]
+
+    def _execute(self, jobs):
+        """one generate for all the prompts of the jobs"""
+        request = jobs[0].request  # 同一批的 max_length, greedy 相同
+        ids = [t for job in jobs for t in job.data]
+
+        # 整批只有在所有请求都没人要了才中断
+        deadlines = [job.deadline for job in jobs]
+        actives = [job.is_active for job in jobs]
+        deadline = None if None in deadlines else max(deadlines)
+        is_active = None if None in actives else (
+            lambda: any(is_active() for is_active in actives))
+
+        _cancellation.deadline = deadline
+        _cancellation.is_active = is_active
+        try:
+            with self.models.acquire(self.model_path, deadline) as model:
+                outputs = None
+                if self.draft_model_path is not None:
+                    outputs = self._speculative(model, ids, request, deadline)
+                if outputs is None:
+                    outputs = self._generate(model, ids, request.max_length, request.greedy)
+        finally:
+            _cancellation.deadline = None
+            _cancellation.is_active = None
+
+        results, i = [], 0
+        for job in jobs:
+            results.append(outputs[i:i + len(job.data)])
+            i += len(job.data)
+        return results
+
+    def _speculative(self, model, ids, request, deadline):
+        """outputs of speculative decoding, None if it can't be used for this batch"""
+        if len(ids) > 1:
+            # 有并发时一批里是多个 prompt：走普通的 batched generate
+            if not self.speculative.snapshot().get("batch_bypassed"):
+                logging.info(f'T5Generator: batches of more than one prompt skip speculative '
+                             f'decoding with {os.path.basename(self.draft_model_path)}')
+            self.speculative.inc("batch_bypassed")
+            return None
+        try:
+            # 不为 draft 模型等内存：拿着大模型等下去不如直接普通生成
+            with self.models.acquire(self.draft_model_path, deadline=time.time()) as draft_model:
+                self.speculative.inc("used")
+                return self._generate(model, ids, request.max_length, request.greedy,
+                                      draft_model=draft_model)
+        except (ModelBudgetExceeded, muvtuber_chatbot_api.DeadlineExceeded):
+            self.speculative.inc("draft_unavailable")
+            logging.debug(f'T5Generator: {self.draft_model_path} not available, '
+                          f'generating without it')
+            return None
+
+    def _generate(self, model, ids, max_length=30, greedy=False, draft_model=None):
+        if len(ids) == 1:
+            input_ids = ids[0].unsqueeze(0).to(device)
+            attention_mask = None
+        else:
+            input_ids = pad_sequence(ids, batch_first=True,
+                                     padding_value=self.tokenizer.pad_token_id).to(device)
+            lengths = torch.tensor([len(t) for t in ids])
+            attention_mask = (torch.arange(input_ids.shape[1])[None, :]
+                              < lengths[:, None]).long().to(device)
+
+        if draft_model is not None and len(ids) == 1:
+            output = speculative_generate(model, draft_model, input_ids,
+                                          decoder_start_token_id=self.tokenizer.cls_token_id,
+                                          eos_token_id=self.tokenizer.sep_token_id,
+                                          max_length=max_length,
+                                          k=self.speculative_k).cpu()
+            return [output.numpy()]
+
+        # greedy: 不管模型配置里的 beam search / sampling
+        greedy_kwargs = {'num_beams': 1, 'do_sample': False} if greedy else {}
+        outputs = model.generate(input_ids,
+                                 attention_mask=attention_mask,
+                                 decoder_start_token_id=self.tokenizer.cls_token_id,
+                                 eos_token_id=self.tokenizer.sep_token_id,
+                                 max_length=max_length,
+                                 **greedy_kwargs).cpu()
+        return list(outputs.numpy())
+
+    def _detokenize(self, request, outputs):
+        return [self._decode(output) for output in outputs]
+
+    def _decode(self, output):
+        """[CLS] xxx [SEP] [PAD]... => xxx
+
+        截到第一个 [SEP]（batch 里短的回复后面是 [PAD]）。以前是 output[1:-1]，
+        回复长到 max_length、没有 [SEP] 时会丢掉最后一个字；线上的 Chat 回复也走这里。
+        """
+        output = list(output[1:])
+        if self.tokenizer.sep_token_id in output:
+            output = output[:output.index(self.tokenizer.sep_token_id)]
+        return ''.join(self.tokenizer.decode(output)).replace(' ', '')
+
 
 class T5Chatbot(muvtuber_chatbot_api.Chatbot):
-    def __init__(self, config: T5ChatbotConfig) -> None:
+    batch_shareable = True  # 没有会话状态，同样配置的会话可以合成一个 batch
+
+    def __init__(self, config: T5ChatbotConfig, models: ModelManager = None, max_batch=32) -> None:
         super().__init__()
 
-        self.tokenizer = T5PegasusTokenizer.from_pretrained(
-            pretrained_tokenizer_model_path)
+        # 模型不常驻在会话里：每次生成时从 ModelManager 借用，
+        # 这样没人用的模型可以被卸载。
+        self.models = models or default_model_manager
+        self.model_path = config.model_path()
+
+        draft_model_path = None
+        if config.draft_model:
+            with self.models.acquire(self.model_path) as model:
+                plain_greedy = is_plain_greedy(model.config)
+            if plain_greedy:
+                draft_model_path = config.draft_model_path()
+                if not os.path.exists(draft_model_path):
+                    raise FileNotFoundError(draft_model_path)
+            else:
+                logging.warning(
+                    f'T5Chatbot: {config.model} does not decode greedily, '
+                    f'speculative decoding with {config.draft_model} disabled.')
+        elif not os.path.exists(self.model_path):
+            raise FileNotFoundError(self.model_path)
+
+        self.generator = T5Generator.shared(self.models, self.model_path, draft_model_path,
+                                            config.tokenizer_path(), config.speculative_k,
+                                            max_batch=max_batch)
+        self.tokenizer = self.generator.tokenizer
+
+        self.retrieval = None
+        self.retrieval_threshold = config.retrieval_threshold
+        if config.retrieval_index:
+            self.retrieval = load_index(config.retrieval_index)
+
+    def ask(self, session_id, prompt, deadline=None, is_active=None, **kwargs):
+        return self.ask_batch([session_id], [prompt],
+                              deadline=deadline, is_active=is_active, **kwargs)[0]
+
+    def ask_batch(self, session_ids, prompts, deadline=None, is_active=None,
+                  max_length=30, greedy=False, retrieval_only=False, **kwargs):
+        """Ask many prompts at once: one batched model.generate for all of them
+        (together with the concurrent asks of other sessions, see T5Generator).
 
-        self.model = torch.load(config.model_path())
-        self.device = torch.device("cpu")  # 不要用 mps，用 mps 更慢且效果巨差
-        self.model.to(self.device)
-        self.model.eval()
+        max_length / greedy / retrieval_only: generation budget under load
+        (see muvtuber_chatbot_api.OverloadController).
 
-    def ask(self, session_id, prompt, **kwargs):
-        ids = self.tokenizer.encode(
-            prompt, return_tensors='pt').to(self.device)
-        output = self.model.generate(ids,
-                                     decoder_start_token_id=self.tokenizer.cls_token_id,
-                                     eos_token_id=self.tokenizer.sep_token_id,
-                                     max_length=30).cpu()
-        output = output.numpy()[0]
+        Returns the responses in the order of prompts.
 
-        response_text = ''.join(self.tokenizer.decode(
-            output[1:-1])  # [CLS] xxx [SEP]
-        ).replace(' ', '')
-        return response_text
+        Raises:
+            Overloaded: retrieval_only and some prompt has no retrieval hit
+        """
+        responses = [None] * len(prompts)
+        if self.retrieval is not None:
+            responses = [self.retrieval.lookup(p, threshold=self.retrieval_threshold)
+                         for p in prompts]
+
+        todo = [i for i, r in enumerate(responses) if r is None]
+        if not todo:
+            return responses
+        if retrieval_only:
+            raise muvtuber_chatbot_api.Overloaded(
+                'Overloaded: only answering from the retrieval index')
+
+        generated = self.generator.generate([prompts[i] for i in todo],
+                                            max_length=max_length, greedy=greedy,
+                                            deadline=deadline, is_active=is_active)
+        for i, response in zip(todo, generated):
+            responses[i] = response
+        return responses
+
+
+def set_torch_threads(torch_threads: int = None, torch_interop_threads: int = None):
+    """torch intra-op / inter-op threads of this process, None: torch's default"""
+    if torch_threads:
+        torch.set_num_threads(torch_threads)
+    if torch_interop_threads:
+        try:
+            torch.set_num_interop_threads(torch_interop_threads)
+        except RuntimeError as e:  # 只能在进程里第一次并行计算之前设置
+            logging.warning(f'set_torch_threads: {e}')
 
 
 class T5ChatbotFactory(muvtuber_chatbot_api.ChatbotFactory):
+    def __init__(self, model_memory_budget: int = None, settings_file: str = None, max_batch=32):
+        """
+        Args:
+            model_memory_budget: bytes, max total size of the loaded models
+                (LRU idle models are evicted), None: no limit
+            settings_file: JSON whose "t5" object sets torch_threads,
+                torch_interop_threads and max_batch (e.g. written by autotune.py)
+            max_batch: max prompts per model.generate of the pipeline
+        """
+        self.models = default_model_manager
+        if model_memory_budget is not None:
+            self.models = ModelManager(model_memory_budget, loader=load_model)
+
+        self.max_batch = max_batch
+        if settings_file:
+            settings = muvtuber_chatbot_api.load_settings(settings_file, 't5')
+            logging.info(f'T5ChatbotFactory: settings from {settings_file}: {settings}')
+            set_torch_threads(settings.get('torch_threads'),
+                              settings.get('torch_interop_threads'))
+            self.max_batch = settings.get('max_batch', max_batch)
+
     def create_chatbot(self, config: T5ChatbotConfig):
-        return T5Chatbot(config)
+        return T5Chatbot(config, models=self.models, max_batch=self.max_batch)
 
 
 if __name__ == '__main__':
@@ -3,18 +3,27 @@
 # - 摘要：正文 (content / text) -> 标题 (title / summary)
 # - chat： question -> answer
 
+import copy
+import json
+import math
 import re
 import random
-from torch.utils.data import DataLoader, Dataset
+import resource
+import sys
+import time
+from torch.utils.data import DataLoader, Dataset, Subset
 import torch
 import numpy as np
 from bert4torch.models import *
-import rouge
 from transformers import MT5ForConditionalGeneration
+from transformers.optimization import Adafactor
 import jieba
 from transformers import BertTokenizer
 import collections.abc as container_abcs
 import warnings
+from corpus import load_data_tsv, load_data_luge
+from evaluation import compute_rouges
+from checkpoint import CheckpointManager
 
 string_classes = (str, bytes)
 int_classes = int
@@ -28,36 +37,6 @@ random.seed(42)
 # torch.set_num_threads(8)
 # torch.set_num_interop_threads(8)
 
-def load_data_tsv(filename):
-    """加载数据
-    单条格式：(标题, 正文)
-    """
-    D = []
-    with open(filename, encoding='utf-8') as f:
-        for l in f:
-            title, content = l.strip().split('\t')
-            D.append((title, content))
-    return D
-
-
-def load_data_luge(filename):
-    """加载 luge 的数据
-    {"id": "dialogue-00000", "conversation": [{"role": "speaker1", "utterance": "你的朋友会找你讨论感情问题吗，我现在一个头两个大", "response_candidates": ["不会，我都是直接把我的感情经历讲给他们听", "会，而且都是找我诉苦", ...]}, ...]}
-    """
-    D = []
-    with open(filename, encoding='utf-8') as f:
-        for l in f:
-            data = json.loads(l)
-            for conversation in data['conversation']:
-                # role = conversation['role']
-                utterance  = conversation['utterance']
-                response_candidates = conversation['response_candidates']
-
-                for response in response_candidates:
-                    D.append((response, utterance))  # 注意是反过来的，A 在前 Q 在后
-    random.shuffle(D)
-    return D
-
 # args to config
 
 train_data = None
@@ -92,9 +71,40 @@ device = torch.device('cpu')  # 'mps' 总之用不了，可能是精度丢失还
 
 save_file = './model/chat.pt'
 
-# end args
+# 蒸馏模式：用训练好的 teacher 蒸馏出一个很小的 draft 模型，
+# 给 t5.py 的 speculative decoding 用（T5ChatbotConfig.draft_model）。
+# draft 和 teacher 共用 tokenizer/vocab，只是层数少得多。
+distill = False
+teacher_file = './model/chat.pt'
+draft_num_layers = 2  # encoder 层数
+draft_num_decoder_layers = 1  # decoder 层数：每个 token 都要跑，越少越快
+distill_temperature = 2.0
+distill_alpha = 0.5  # loss = alpha * 真实标签 CE + (1 - alpha) * KL(teacher || student)
+
+if distill:
+    save_file = './model/chat_draft.pt'
+
+# 省内存模式：CPU 训练机内存有限，max_len 512 + batch 128 会被 OOM kill。
+# - gradient checkpointing：encoder / decoder 每个 block 的激活不存，反向时重算
+#   （多跑一遍前向，换掉大部分激活内存）；
+# - 梯度累积：每次只前向 micro_batch_size 条，累积满 batch_size 条再 step，等效 batch 不变。
+memory_saving = False
+micro_batch_size = 16
+# 'adam' / 'adafactor'：Adafactor 的二阶矩是分解存的，优化器状态比 Adam（参数量的 2 倍）小得多
+optimizer_name = 'adam'
+
+# 每个 epoch 的峰值内存和吞吐量，追加写到这里，方便对比不同设置
+train_report_file = save_file[:-len('.pt')] + '_train_report.jsonl'
+
+epochs = 6
+# 断点续训：每 checkpoint_steps 步（优化器更新次数）存一个 checkpoint（模型、优化器、数据位置），
+# 后台线程写盘，训练不停。重新运行 train.py 会从 checkpoint_dir 里最新的 checkpoint 接着训。
+checkpoint_dir = save_file[:-len('.pt')] + '_checkpoints'
+checkpoint_steps = 200
+keep_last_checkpoints = 3  # 另外 ROUGE-L 最好的那个也一直留着
+eval_steps = 1000  # 每多少步在 valid 上算一次 ROUGE（每个 epoch 结束也会算）。None: 只在 epoch 结束时
 
-rouge = rouge.Rouge()
+# end args
 
 
 def sequence_padding(inputs, length=None, padding=0):
@@ -211,13 +221,111 @@ def create_data(data):
 train_data = create_data(train_data)
 
 train_data = KeyDataset(train_data)
-train_data = DataLoader(train_data, batch_size=batch_size,
-                        collate_fn=default_collate)
-
-model = MT5ForConditionalGeneration.from_pretrained(model_path)
+accumulation_steps = 1
+if memory_saving:
+    accumulation_steps = max(1, batch_size // micro_batch_size)
+loader_batch_size = batch_size // accumulation_steps
+n_batches = math.ceil(len(train_data) / loader_batch_size)
+
+
+def make_loader(first_batch=0):
+    """DataLoader of train_data from the first_batch-th batch (数据顺序是固定的，续训时跳过已经训过的)"""
+    dataset = train_data
+    if first_batch:
+        dataset = Subset(train_data, range(
+            first_batch * loader_batch_size, len(train_data)))
+    return DataLoader(dataset, batch_size=loader_batch_size,
+                      collate_fn=default_collate)
+
+
+def make_draft_model(teacher):
+    """一个层数很少的 MT5，用 teacher 的 embedding / lm_head 和均匀挑出的层初始化"""
+    config = copy.deepcopy(teacher.config)
+    config.num_layers = draft_num_layers
+    config.num_decoder_layers = draft_num_decoder_layers
+    draft = MT5ForConditionalGeneration(config)
+
+    draft.shared.load_state_dict(teacher.shared.state_dict())
+    draft.lm_head.load_state_dict(teacher.lm_head.state_dict())
+    for draft_stack, teacher_stack in ((draft.encoder, teacher.encoder), (draft.decoder, teacher.decoder)):
+        # 第 0 层带 relative_attention_bias，挑的层总是包括 teacher 的第 0 层
+        picks = np.linspace(0, len(teacher_stack.block) - 1,
+                            len(draft_stack.block)).round().astype(int)
+        for draft_block, i in zip(draft_stack.block, picks):
+            draft_block.load_state_dict(teacher_stack.block[i].state_dict())
+        draft_stack.final_layer_norm.load_state_dict(
+            teacher_stack.final_layer_norm.state_dict())
+    return draft
+
+
+if distill:
+    teacher = torch.load(teacher_file)
+    teacher.to(device)
+    teacher.eval()
+    model = make_draft_model(teacher)
+    print(f'distill: teacher {sum(p.numel() for p in teacher.parameters())} params, '
+          f'draft {sum(p.numel() for p in model.parameters())} params')
+else:
+    model = MT5ForConditionalGeneration.from_pretrained(model_path)
 
 model.to(device)
-adam = torch.optim.Adam(model.parameters(), lr=lr)
+if memory_saving:
+    # 每个 MT5Block 用 torch.utils.checkpoint 包起来（只在 model.train() 时生效）
+    model.gradient_checkpointing_enable()
+
+if optimizer_name == 'adafactor':
+    optimizer = Adafactor(model.parameters(), lr=lr,
+                          scale_parameter=False, relative_step=False, warmup_init=False)
+else:
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+
+
+def process_peak_rss_mib():
+    """整个进程到目前为止的峰值常驻内存 (MiB)，包括加载模型、数据和之前的 epoch"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss: Linux 上是 KiB，macOS 上是字节
+    return rss / (1 << 20) if sys.platform == 'darwin' else rss / (1 << 10)
+
+
+def reset_peak_rss():
+    """清零 Linux 的 VmHWM（写 5 到 /proc/self/clear_refs），之后的 epoch_peak_rss_mib 只算这之后的峰值"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def epoch_peak_rss_mib():
+    """reset_peak_rss 之后的峰值常驻内存 (MiB)，读不到（非 Linux）时是 None"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / (1 << 10)  # kB
+    except OSError:
+        pass
+    return None
+
+
+def report_training(epoch, seconds, n_samples, n_tokens, peak_reset):
+    report = {
+        'epoch': epoch,
+        'memory_saving': memory_saving,
+        'batch_size': batch_size,
+        'micro_batch_size': batch_size // accumulation_steps,
+        'accumulation_steps': accumulation_steps,
+        'optimizer': optimizer_name,
+        'max_len': max_len,
+        'samples_per_second': n_samples / seconds,
+        'tokens_per_second': n_tokens / seconds,
+        'epoch_peak_rss_mib': epoch_peak_rss_mib() if peak_reset else None,
+        'process_peak_rss_mib': process_peak_rss_mib(),
+    }
+    print(report)
+    with open(train_report_file, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(report) + '\n')
 
 
 def generate(text, max_length=30):
@@ -235,66 +343,124 @@ def generate(text, max_length=30):
     return gen
 
 
-def compute_rouge(source, target):
-    """计算rouge-1、rouge-2、rouge-l
-    """
-    source, target = ' '.join(source), ' '.join(target)
-    try:
-        scores = rouge.get_scores(hyps=source, refs=target)
-        return {
-            'rouge-1': scores[0]['rouge-1']['f'],
-            'rouge-2': scores[0]['rouge-2']['f'],
-            'rouge-l': scores[0]['rouge-l']['f'],
-        }
-    except ValueError:
-        return {
-            'rouge-1': 0.0,
-            'rouge-2': 0.0,
-            'rouge-l': 0.0,
-        }
-
-
-def compute_rouges(sources, targets):
-    scores = {
-        'rouge-1': 0.0,
-        'rouge-2': 0.0,
-        'rouge-l': 0.0,
-    }
-    for source, target in zip(sources, targets):
-        score = compute_rouge(source, target)
-        for k, v in scores.items():
-            scores[k] = v + score[k]
-
-    return {k: v / len(targets) for k, v in scores.items()}
+def evaluate():
+    model.eval()
+    gens = []
+    summaries = []
+    for (title, content) in valid_data:
+        gen = generate(content, max_length=40)
+        gens.append(gen)
+        summaries.append(title)
+    scores = compute_rouges(gens, summaries)
+    print(f'step {global_step}: {scores}')
+    model.train()
+    return scores
 
 
+checkpoints = CheckpointManager(checkpoint_dir, keep_last=keep_last_checkpoints)
 best = 0
-for _ in range(6):
+global_step = 0
+last_eval_step = None
+start_epoch, start_batch = 0, 0
+
+resume = checkpoints.load_latest()
+if resume is not None:
+    model.load_state_dict(resume['model'])
+    optimizer.load_state_dict(resume['optimizer'])
+    torch.set_rng_state(resume['rng'])
+    start_epoch, start_batch = resume['epoch'], resume['batch']
+    global_step, best = resume['global_step'], resume['best']
+    last_eval_step = resume.get('last_eval_step')
+    # 数据位置按样本数算：micro batch 大小变了（比如打开了 memory_saving）也能接上，
+    # 只要断点正好落在新的 batch 边界上
+    sample = resume.get('sample', start_batch * loader_batch_size)
+    if sample >= len(train_data):
+        start_batch = n_batches
+    elif sample % loader_batch_size == 0:
+        start_batch = sample // loader_batch_size
+    else:
+        raise SystemExit(f'cannot resume: checkpoint is at sample {sample} of epoch {start_epoch}, '
+                         f'not a multiple of the batch size {loader_batch_size}. '
+                         f'Use a batch size that divides it, or delete {checkpoint_dir}')
+    print(f'resume from step {global_step}: epoch {start_epoch}, batch {start_batch}/{n_batches}')
+
+
+def save_checkpoint(epoch, next_batch, rouge_l=None, save_best=False):
+    """next_batch: where to resume in epoch. save_best: also (in the same background write) save_file"""
+    checkpoints.save(global_step, {
+        'model': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'rng': torch.get_rng_state(),
+        'epoch': epoch,
+        'batch': next_batch,
+        'sample': min(next_batch * loader_batch_size, len(train_data)),
+        'global_step': global_step,
+        'last_eval_step': last_eval_step,
+        'best': best,
+    }, rouge_l=rouge_l, model=model if save_best else None, model_path=save_file)
+
+
+def evaluate_and_save(epoch, next_batch):
+    global best, last_eval_step
+    rouge_l = evaluate()['rouge-l']
+    last_eval_step = global_step
+    save_best = rouge_l > best
+    if save_best:
+        best = rouge_l
+    save_checkpoint(epoch, next_batch, rouge_l, save_best=save_best)
+
+
+for epoch in range(start_epoch, epochs):
+    first_batch = start_batch if epoch == start_epoch else 0
+    if first_batch >= n_batches:  # 上次在 epoch 的最后存的
+        continue
     model.train()
-    for cur in train_data:
+    epoch_start = time.perf_counter()
+    peak_reset = reset_peak_rss()
+    n_samples, n_tokens = 0, 0
+    for step, cur in enumerate(make_loader(first_batch), start=first_batch):
         cur = {k: v.to(device) for k, v in cur.items()}
-        prob = model(**cur)[0]
+        # 训练不需要 decoder 的 kv cache（checkpointing 也不能和它一起用）
+        prob = model(**cur, use_cache=False)[0]
         mask = cur['decoder_attention_mask'][:, 1:].reshape(-1).bool()
         prob = prob[:, :-1]
         prob = prob.reshape((-1, prob.size(-1)))[mask]
         labels = cur['decoder_input_ids'][:, 1:].reshape(-1)[mask]
         loss_fct = torch.nn.CrossEntropyLoss(ignore_index=-100)
         loss = loss_fct(prob, labels)
-        loss.backward()
-        adam.step()
-        adam.zero_grad()
+        if distill:
+            with torch.no_grad():
+                teacher_prob = teacher(**cur)[0][:, :-1]
+                teacher_prob = teacher_prob.reshape(
+                    (-1, teacher_prob.size(-1)))[mask]
+            t = distill_temperature
+            kd_loss = torch.nn.functional.kl_div(
+                torch.log_softmax(prob / t, dim=-1),
+                torch.softmax(teacher_prob / t, dim=-1),
+                reduction='batchmean') * t * t
+            loss = distill_alpha * loss + (1 - distill_alpha) * kd_loss
+        # 累积 accumulation_steps 个 micro batch 的梯度再 step；
+        # epoch 末尾不满的一组按实际的 micro batch 数平均
+        group_start = step - step % accumulation_steps
+        (loss / min(accumulation_steps, n_batches - group_start)).backward()
+
+        n_samples += cur['input_ids'].shape[0]
+        n_tokens += int(cur['attention_mask'].sum() +
+                        cur['decoder_attention_mask'].sum())
+
+        if (step + 1) % accumulation_steps == 0 or step + 1 == n_batches:
+            optimizer.step()
+            optimizer.zero_grad()
+            global_step += 1
+            # 只在 optimizer.step() 之后存，checkpoint 里没有累积了一半的梯度
+            if eval_steps and global_step % eval_steps == 0:
+                evaluate_and_save(epoch, step + 1)
+            elif global_step % checkpoint_steps == 0:
+                save_checkpoint(epoch, step + 1)
+    report_training(epoch, time.perf_counter() - epoch_start, n_samples, n_tokens, peak_reset)
 
     # 测试
-    model.eval()
-    gens = []
-    summaries = []
-    for (title, content) in valid_data:
-        gen = generate(content, max_length=40)
-        gens.append(gen)
-        summaries.append(title)
-    scores = compute_rouges(gens, summaries)
-    print(scores)
-    rouge_l = scores['rouge-l']
-    if rouge_l > best:
-        best = rouge_l
-        torch.save(model, save_file)
+    if last_eval_step != global_step:
+        evaluate_and_save(epoch + 1, 0)
+
+checkpoints.wait()
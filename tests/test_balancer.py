@@ -0,0 +1,109 @@
+# ReplicaBalancer against several local serve_grpc processes (stub chatbots, no model needed).
+#
+#     python -m unittest tests.test_balancer
+
+import os
+import socket
+import subprocess
+import sys
+import unittest
+
+import grpc
+
+_t5_chatbot_dir = os.path.join(os.path.dirname(
+    os.path.dirname(os.path.realpath(__file__))), 't5_chatbot')
+sys.path.insert(0, _t5_chatbot_dir)
+
+from muvtuber_chatbot_api import NoReplicaAvailable, ReplicaBalancer  # noqa: E402
+
+# 每个副本是一个单独的进程：回声 Chatbot，回复带上自己的端口，方便看是哪个副本答的
+_SERVER = '''
+import sys
+import muvtuber_chatbot_api as m
+
+class Echo(m.Chatbot):
+    def ask(self, session_id, prompt, **kwargs):
+        return f"{sys.argv[1]}:{prompt}"
+
+class EchoFactory(m.ChatbotFactory):
+    def create_chatbot(self, config):
+        return Echo()
+
+m.serve_grpc(m.MuvtuberGrpcServerConfig(
+    chatbot_factory=EchoFactory(), chatbot_config_class=m.ChatbotConfig,
+    max_sessions=int(sys.argv[2]), address=f"localhost:{sys.argv[1]}",
+    add_reflection_service=False))
+'''
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+class ReplicaBalancerTest(unittest.TestCase):
+    replicas = 3
+    max_sessions = 2
+
+    def setUp(self):
+        self.ports = [_free_port() for _ in range(self.replicas)]
+        self.processes = [
+            subprocess.Popen([sys.executable, '-c', _SERVER, str(port), str(self.max_sessions)],
+                             cwd=_t5_chatbot_dir,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            for port in self.ports]
+        for port in self.ports:
+            with grpc.insecure_channel(f'localhost:{port}') as channel:
+                grpc.channel_ready_future(channel).result(timeout=30)
+        self.balancer = ReplicaBalancer(
+            [f'localhost:{port}' for port in self.ports], refresh_interval=0)
+
+    def tearDown(self):
+        self.balancer.close()
+        for p in self.processes:
+            p.kill()
+            p.wait()
+
+    def replica_port(self, session_id):
+        return int(self.balancer.chat(session_id, 'hi').split(':')[0])
+
+    def test_spreads_sessions_and_sticks(self):
+        sessions = [self.balancer.new_session('{}') for _ in range(self.replicas)]
+        ports = [self.replica_port(s) for s in sessions]
+        self.assertEqual(sorted(ports), sorted(self.ports))
+
+        # 之后的请求都回到创建它的副本
+        for session_id, port in zip(sessions, ports):
+            self.assertEqual(self.balancer.chat(session_id, '你好'), f'{port}:你好')
+
+        self.balancer.delete_session(sessions[0])
+        with self.assertRaises(KeyError):
+            self.balancer.chat(sessions[0], 'hi')
+
+    def test_full_replicas(self):
+        n = self.replicas * self.max_sessions
+        sessions = [self.balancer.new_session('{}') for _ in range(n)]
+        self.assertEqual(len(set(sessions)), n)
+        for port in self.ports:
+            self.assertEqual(
+                sum(self.replica_port(s) == port for s in sessions), self.max_sessions)
+
+        with self.assertRaises(NoReplicaAvailable):
+            self.balancer.new_session('{}')
+
+    def test_dead_replica(self):
+        self.processes[0].kill()
+        self.processes[0].wait()
+
+        sessions = [self.balancer.new_session('{}') for _ in range(4)]
+        ports = {self.replica_port(s) for s in sessions}
+        self.assertNotIn(self.ports[0], ports)
+        self.assertEqual(ports, set(self.ports[1:]))
+
+        unhealthy = [r.address for r in self.balancer.replicas if not r.healthy]
+        self.assertEqual(unhealthy, [f'localhost:{self.ports[0]}'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# prune_structure on a tiny random MT5: the pruned model must still run (forward, generate)
+# and answer exactly like the original with the same heads / FFN units masked out.
+#
+#     python -m unittest tests.test_prune_structure
+
+import copy
+import os
+import sys
+import unittest
+
+import torch
+from transformers import MT5Config, MT5ForConditionalGeneration
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.dirname(os.path.realpath(__file__))), 't5_chatbot'))
+
+import prune_structure  # noqa: E402
+
+
+def tiny_model():
+    torch.manual_seed(0)
+    config = MT5Config(vocab_size=64, d_model=32, d_ff=48, d_kv=8, num_heads=4,
+                       num_layers=3, num_decoder_layers=3, decoder_start_token_id=0,
+                       pad_token_id=0, eos_token_id=1, dropout_rate=0.0)
+    return MT5ForConditionalGeneration(config).eval()
+
+
+def head_masks(model, to_prune):
+    """forward kwargs masking the heads to_prune {kind: [heads]} in every layer"""
+    masks = {}
+    for kind, layers in prune_structure.attentions(model).items():
+        mask = torch.ones(len(layers), layers[0].n_heads)
+        mask[:, to_prune.get(kind, [])] = 0
+        masks[prune_structure.ATTENTION_KINDS[kind]] = mask
+    return masks
+
+
+class PruneStructureTest(unittest.TestCase):
+    to_prune = {'encoder': [1], 'decoder': [0, 2], 'cross': [3]}
+
+    def setUp(self):
+        self.original = tiny_model()
+        # 输入带 padding：mask 会加进各层共用的 position bias 里
+        self.inputs = {
+            'input_ids': torch.tensor([[5, 6, 7, 8, 9, 1], [10, 11, 12, 1, 0, 0]]),
+            'attention_mask': torch.tensor([[1, 1, 1, 1, 1, 1], [1, 1, 1, 1, 0, 0]]),
+        }
+        self.decoder_input_ids = torch.tensor([[0, 3, 4, 5], [0, 6, 7, 8]])
+
+        # 对照：原模型上把要剪的 FFN 神经元的输出置零
+        self.keep = [list(range(0, ffn.wo.in_features, 2))
+                     for ffn in prune_structure.feed_forwards(self.original)]
+        self.reference = copy.deepcopy(self.original)
+        for ffn, units in zip(prune_structure.feed_forwards(self.reference), self.keep):
+            dropped = [u for u in range(ffn.wo.in_features) if u not in units]
+            ffn.wo.weight.data[:, dropped] = 0
+
+        self.pruned = copy.deepcopy(self.original)
+        prune_structure.prune_heads(self.pruned, self.to_prune)
+        prune_structure.prune_ffn_units(self.pruned, self.keep)
+
+    def test_structure(self):
+        counts = prune_structure.count_structure(self.pruned)
+        self.assertEqual(counts['heads'], 3 * (4 - 1) + 3 * (4 - 2) + 3 * (4 - 1))
+        self.assertEqual(counts['ffn_units'], 6 * 24)
+        self.assertLess(counts['params'], prune_structure.count_structure(self.original)['params'])
+
+    def test_forward(self):
+        with torch.no_grad():
+            pruned = self.pruned(**self.inputs, decoder_input_ids=self.decoder_input_ids).logits
+            expected = self.reference(**self.inputs, decoder_input_ids=self.decoder_input_ids,
+                                      **head_masks(self.reference, self.to_prune)).logits
+        self.assertTrue(torch.allclose(pruned, expected, atol=1e-5))
+
+    def test_generate(self):
+        with torch.no_grad():
+            pruned = self.pruned.generate(**self.inputs, max_length=10, num_beams=1, do_sample=False)
+            expected = self.reference.generate(**self.inputs, max_length=10, num_beams=1, do_sample=False,
+                                               **head_masks(self.reference, self.to_prune))
+        self.assertTrue(torch.equal(pruned, expected))
+
+    def test_select_heads(self):
+        scores = {kind: torch.rand(3, 4) for kind in prune_structure.ATTENTION_KINDS}
+        scores['cross'][:, 2] = -1  # 每层都最不重要
+        to_prune = prune_structure.select_heads(scores, ratio=0.25)
+        self.assertEqual(sum(len(heads) for heads in to_prune.values()), 3)
+        self.assertIn(2, to_prune['cross'])
+
+        # 每种 attention 至少留一个 head
+        to_prune = prune_structure.select_heads(scores, ratio=1.0)
+        for heads in to_prune.values():
+            self.assertEqual(len(heads), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()